@@ -1,14 +1,171 @@
 import subprocess
 import os
-import time
+import sys
+import threading
+
+import archive
+import formats
+import telemetry
+import throttle
+import ytdlp_engine
+from pipeline import Pipeline, Stage
 
 # --- CONFIG ---
 COOKIE_FILE = "tiktok_cookies.txt"
 LINKS_FILE = "links.txt"
 OUTPUT_DIR = "tiktok_final_exports"
+CONCURRENCY = throttle.CONCURRENCY  # download workers
+# Single pass: ffmpeg fetches the streams and muxes them straight into MOV,
+# so each video is written to disk once. ffmpeg has no impersonation, so a
+# job whose CDN refuses it is retried through the impersonated
+# download-to-MP4 + remux stage (and the run stays on that path from then on).
+# Set False to always use that stage.
+DIRECT_MOV = True
+REMUX_WORKERS = 2
+REMUX_QUEUE = 4  # max finished temp MP4s waiting for ffmpeg
 # --------------
 
-def process_videos():
+direct_mov_refused = threading.Event()  # set once a CDN refused ffmpeg's direct fetch
+
+def ffmpeg_fetch_failed(result):
+    """ True if yt-dlp failed in its ffmpeg downloader rather than in extraction. """
+    return any("ERROR" in line and "ffmpeg" in line.lower() for line in result.stderr.splitlines())
+
+def download_cmd(job, access_args, selection, direct):
+    video_id = os.path.splitext(os.path.basename(job['final_mov']))[0]
+    if direct:
+        output_args = [
+            "--downloader", "ffmpeg",
+            "--downloader-args", "ffmpeg_o:-f mov",
+            "--merge-output-format", "mov",
+            "-o", job['partial_mov'],
+            "-o", f"description:{os.path.join(OUTPUT_DIR, video_id)}.%(ext)s",
+        ]
+    else:
+        output_args = ["-o", job['temp_mp4']]
+    return [*access_args, *selection.args, "--write-description", *output_args, job['link']]
+
+def download_link(job):
+    """
+    Stage 1: downloads one link. With DIRECT_MOV the job is finished here;
+    otherwise (or after falling back) returns the job with its temp MP4 and
+    job['remux'] set for the remux stage. None on failure.
+    """
+    index, link, total, store = job['index'], job['link'], job['total'], job['store']
+    print(f"\n--- [{index}/{total}] Target: {link} ---")
+
+    # Name files by TikTok's video ID so editing links.txt doesn't orphan
+    # earlier work; short links without an ID fall back to the position.
+    job['platform'], job['video_id'] = archive.video_key(link)
+    if store.is_done(job['platform'], job['video_id']):
+        print(f"⏭️ [{index}] Already archived. Skipping.")
+        return None
+    video_id = f"tiktok_{job['video_id']}" if job['video_id'].isdigit() else f"tiktok_{index}"
+    job['temp_mp4'] = os.path.join(OUTPUT_DIR, f"{video_id}_temp.mp4")
+    job['final_mov'] = os.path.join(OUTPUT_DIR, f"{video_id}.mov")
+    # Temp name in the same directory, so the final rename is atomic
+    job['partial_mov'] = os.path.join(OUTPUT_DIR, f"{video_id}.partial.mov")
+
+    access_args = [
+        "--impersonate", "chrome",
+        "--cookies", COOKIE_FILE,
+        # Using a custom API hostname helps bypass regional extraction blocks
+        "--extractor-args", "tiktok:api_hostname=api16-normal-c-useast1a.tiktokv.com",
+    ]
+    # 1. DOWNLOAD THE SMALLEST FORMAT THAT MEETS THE PHONE TARGET + CAPTION
+    # (formats.py policy; FORMAT_POLICY=best restores "bv*+ba/b")
+    selection = formats.select_for(link, access_args, "bv*+ba/b", label=f"[{index}]")
+
+    try:
+        # The shared controller paces requests per host (token bucket instead
+        # of the old fixed 5s sleep), adapts concurrency and retries with jitter.
+        # Progress is streamed live; a stalled transfer is killed and retried
+        deadline = ytdlp_engine.job_deadline()
+
+        def fetch(direct, attempts=throttle.MAX_ATTEMPTS):
+            cmd_download = download_cmd(job, access_args, selection, direct)
+            return throttle.run_with_retries(
+                link, lambda: ytdlp_engine.download(cmd_download, label=f"[{index}]", deadline=deadline),
+                max_attempts=attempts, label=f"[{index}]"
+            )
+
+        # One direct attempt; any retry goes through the impersonated download + remux
+        direct = DIRECT_MOV and not direct_mov_refused.is_set()
+        result, outcome = fetch(direct, 1 if direct else throttle.MAX_ATTEMPTS)
+        missing = result.returncode == 0 and not os.path.exists(job['partial_mov'])
+        if direct and (missing or (result.returncode != 0 and outcome in throttle.RETRYABLE)):
+            refused = missing or ffmpeg_fetch_failed(result)
+            if refused:
+                print(f"↩️ [{index}] ffmpeg could not fetch the streams directly; retrying with download + remux")
+            if os.path.exists(job['partial_mov']):
+                os.remove(job['partial_mov'])
+            direct = False
+            result, outcome = fetch(direct)
+            if refused and result.returncode == 0 and not direct_mov_refused.is_set():
+                direct_mov_refused.set()
+                print(f"↩️ The CDN refuses ffmpeg's direct fetch; using download + remux for the rest of this run")
+
+        if result.returncode != 0:
+            if outcome == throttle.RATE_LIMITED:
+                print(f"⏳ [{index}] Still rate limited by TikTok after retries. Skipping.")
+            elif outcome == throttle.BLOCKED:
+                print(f"❌ [{index}] Extraction blocked by TikTok for this link. Skipping.")
+            else:
+                print(f"❌ [{index}] Error ({outcome}): {result.stderr.strip()[:100]}")
+            store.mark_failed(job['platform'], job['video_id'], link, result.stderr)
+            return None
+
+        if direct and os.path.exists(job['partial_mov']):
+            os.replace(job['partial_mov'], job['final_mov'])
+            store.mark_done(job['platform'], job['video_id'], link, job['final_mov'])
+            selection.finished(job['final_mov'])
+            size_mb = os.path.getsize(job['final_mov']) / 1e6
+            print(f"✅ [{index}] Success! Saved to {job['final_mov']} ({size_mb:.1f} MB written once)")
+            return job
+        if os.path.exists(job['temp_mp4']):
+            selection.finished(job['temp_mp4'])
+            job['remux'] = True
+            return job
+    except Exception as e:
+        print(f"⚠️ [{index}] Unexpected error: {e}")
+    finally:
+        selection.close()
+    return None
+
+def remux_to_mov(job):
+    """ Stage 2: stream-copies the temp MP4 into the final MOV and removes the temp file. """
+    if not job.get('remux'):
+        return job  # already written as MOV by the direct fetch
+    index, temp_mp4, final_mov, partial_mov = job['index'], job['temp_mp4'], job['final_mov'], job['partial_mov']
+
+    # 2. CONVERT TO MOV (Fast Stream Copy)
+    # Written under the temp name and renamed once complete, so a crash or a
+    # failed remux never leaves a truncated .mov for import_dir to pick up
+    print(f"🔄 [{index}] Converting to MOV...")
+    cmd_convert = [
+        "ffmpeg", "-i", temp_mp4,
+        "-c", "copy", # No quality loss, super fast
+        "-f", "mov",
+        partial_mov,
+        "-y"
+    ]
+    try:
+        with telemetry.span('remux', job['link'], bytes=os.path.getsize(temp_mp4)):
+            subprocess.run(cmd_convert, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        os.replace(partial_mov, final_mov)
+    except Exception as e:
+        print(f"⚠️ [{index}] Conversion failed: {e}")
+        if os.path.exists(partial_mov):
+            os.remove(partial_mov)
+        return None
+
+    # Cleanup temp file
+    os.remove(temp_mp4)
+    job['store'].mark_done(job['platform'], job['video_id'], job['link'], final_mov)
+    print(f"✅ [{index}] Success! Saved to {final_mov}")
+    return job
+
+def process_videos(concurrency=None):
     if not os.path.exists(LINKS_FILE):
         print(f"❌ Error: {LINKS_FILE} not found.")
         return
@@ -18,63 +175,32 @@ def process_videos():
 
     with open(LINKS_FILE, "r") as f:
         links = [line.strip() for line in f.readlines() if line.strip()]
+    # Links to the same video in another form are only fetched once
+    links, duplicates = archive.unique_links(links)
+    if duplicates:
+        print(f"🔁 Skipping {duplicates} duplicate links (same video as an earlier line)")
 
-    print(f"🚀 Processing {len(links)} links. Quality: Max | Output: MOV | Captions: Included")
-
-    for i, link in enumerate(links):
-        print(f"\n--- [{i+1}/{len(links)}] Target: {link} ---")
-        
-        # We use a specific ID to keep track of files during conversion
-        video_id = f"tiktok_{i+1}"
-        description_file = os.path.join(OUTPUT_DIR, f"{video_id}.description")
-        temp_mp4 = os.path.join(OUTPUT_DIR, f"{video_id}_temp.mp4")
-        final_mov = os.path.join(OUTPUT_DIR, f"{video_id}.mov")
-
-        # 1. DOWNLOAD BEST QUALITY + CAPTION
-        cmd_download = [
-            "yt-dlp",
-            "--impersonate", "chrome",
-            "--cookies", COOKIE_FILE,
-            # Using a custom API hostname helps bypass regional extraction blocks
-            "--extractor-args", "tiktok:api_hostname=api16-normal-c-useast1a.tiktokv.com",
-            "-f", "bv*+ba/b", 
-            "--write-description",
-            "-o", temp_mp4,
-            link
-        ]
-        
-        try:
-            # Run download
-            result = subprocess.run(cmd_download, capture_output=True, text=True)
-            
-            if result.returncode != 0:
-                if "Unable to extract" in result.stderr:
-                    print(f"❌ Extraction blocked by TikTok for this link. Skipping.")
-                else:
-                    print(f"❌ Error: {result.stderr.strip()[:100]}")
-                continue
-
-            # 2. CONVERT TO MOV (Fast Stream Copy)
-            if os.path.exists(temp_mp4):
-                print(f"🔄 Converting to MOV...")
-                cmd_convert = [
-                    "ffmpeg", "-i", temp_mp4,
-                    "-c", "copy", # No quality loss, super fast
-                    "-f", "mov",
-                    final_mov,
-                    "-y"
-                ]
-                subprocess.run(cmd_convert, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                
-                # Cleanup temp file
-                os.remove(temp_mp4)
-                print(f"✅ Success! Saved to {final_mov}")
-            
-        except Exception as e:
-            print(f"⚠️ Unexpected error: {e}")
-        
-        # Random delay (3-6s) is critical to avoid being flagged as a bot
-        time.sleep(5)
+    concurrency = concurrency or CONCURRENCY
+    remux = "direct to MOV" if DIRECT_MOV else f"{REMUX_WORKERS} remux workers"
+    print(f"🚀 Processing {len(links)} links with {concurrency} download workers ({remux}). Quality: Max | Output: MOV | Captions: Included")
+
+    # With DIRECT_MOV the remux stage only sees jobs that fell back to download + remux
+    stages = [
+        Stage("download", download_link, workers=concurrency),
+        Stage("remux", remux_to_mov, workers=REMUX_WORKERS, queue_size=REMUX_QUEUE),
+    ]
+    pipeline = Pipeline(stages)
+    store = archive.Archive()
+    store.import_dir(OUTPUT_DIR, 'tiktok')
+    jobs = [{'index': i, 'link': link, 'total': len(links), 'store': store}
+            for i, link in enumerate(links, start=1)]
+    done = pipeline.run(jobs)
+    store.close()
+
+    pipeline.report()
+    ytdlp_engine.report_transfers()
+    formats.report()
+    print(f"\n🏁 Done: {len(done)}/{len(links)} saved to {OUTPUT_DIR}")
 
 if __name__ == "__main__":
-    process_videos()
\ No newline at end of file
+    process_videos(int(sys.argv[1]) if len(sys.argv) > 1 else None)
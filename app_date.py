@@ -1,61 +1,144 @@
 import subprocess
+import heapq
 import json
 import os
 import time
-from datetime import datetime
+from datetime import datetime, timezone
+
+import archive
+import formats
+import metacache
+import telemetry
+import throttle
+import ytdlp_engine
 
 # --- Configuration ---
 VIEW_THRESHOLD = 20000  
 DOWNLOAD_LIMIT = 20      
 START_DATE = "20250301"  # Format: YYYYMMDD (March 1st, 2025)
+PINNED_TOLERANCE = 3     # Old entries allowed before stopping (pinned videos sit on top)
 # ---------------------
 
 OUTPUT_DIR = "tiktok_downloads"
 COOKIE_FILE = os.path.join(os.getcwd(), 'cookies.txt')
 
-def run_yt_dlp(url, options, silent=False):
-    """ Runs yt-dlp with impersonation to bypass blocks. """
+def access_args():
     # Using 'chrome' impersonation to avoid the extraction errors you saw earlier
-    cmd = ['yt-dlp', '--impersonate', 'chrome', url] + options
-    
+    args = ['--impersonate', 'chrome']
     if os.path.exists(COOKIE_FILE):
-        cmd.extend(['--cookies', COOKIE_FILE])
+        args.extend(['--cookies', COOKIE_FILE])
+    return args
 
-    try:
-        process = subprocess.run(
-            cmd, capture_output=True, text=True, check=True, encoding='utf-8'
-        )
-        return process.stdout
-    except subprocess.CalledProcessError as e:
-        if not silent:
-            print(f"\n[ERROR] Extraction failed. Error: {e.stderr}")
-        raise Exception(f"yt-dlp failed: {e.stderr}")
+def build_cmd(url, options):
+    return [url] + options + access_args()
+
+def run_yt_dlp(url, options, silent=False):
+    """ Runs yt-dlp with impersonation to bypass blocks. """
+    cmd = build_cmd(url, options)
 
-def get_metadata(tiktok_url):
-    """ Extracts metadata including upload dates. """
+    deadline = ytdlp_engine.job_deadline()
+    process, outcome = throttle.run_with_retries(
+        url, lambda: ytdlp_engine.download(cmd, label=url, deadline=deadline, encoding='utf-8')
+    )
+    if process.returncode != 0:
+        if not silent:
+            print(f"\n[ERROR] Extraction failed ({outcome}). Error: {process.stderr}")
+        raise Exception(f"yt-dlp failed ({outcome}): {process.stderr}")
+    return process.stdout
+
+def entry_upload_date(data):
+    """ yt-dlp usually provides 'upload_date' (YYYYMMDD); derive it from 'timestamp' if not. """
+    if data.get('upload_date'):
+        return data['upload_date']
+    if data.get('timestamp'):
+        return datetime.fromtimestamp(data['timestamp'], timezone.utc).strftime('%Y%m%d')
+    return None
+
+def get_metadata(tiktok_url, sync=None):
+    """
+    Streams the profile's entries (newest first) and keeps only the top
+    DOWNLOAD_LIMIT candidates by views in a bounded heap. The scan stops as
+    soon as the feed is past START_DATE, instead of walking the whole history,
+    or once it reaches the videos handled on earlier runs (an archive.ProfileSync
+    watermark, which the caller commits after downloading).
+    """
     print(f"STEP 1: Extracting metadata for {tiktok_url}...")
+
+    # A scan only depends on the profile and the filter settings; reuse it
+    # while its view counts are still fresh
+    cache = metacache.MetadataCache()
+    scan_key = f"scan:{tiktok_url.split('?')[0].rstrip('/')}:{START_DATE}:{VIEW_THRESHOLD}:{DOWNLOAD_LIMIT}"
+    cached = cache.get(scan_key, ('entries',))
+    if cached:
+        print(f"Using cached scan ({len(cached['entries'])} candidates).")
+        return cached['entries']
     
     options = ['--dump-json', '--flat-playlist']
-    stdout = run_yt_dlp(tiktok_url, options, silent=False)
-    
-    video_entries = []
-    for line in stdout.splitlines():
-        try:
-            data = json.loads(line)
-            # yt-dlp usually provides 'upload_date' in YYYYMMDD format
-            upload_date = data.get('upload_date') 
+    scan_started = time.time()
+    lines = ytdlp_engine.stream(build_cmd(tiktok_url, options), encoding='utf-8')
+
+    own_store = archive.Archive() if sync is None else None
+    sync = sync or archive.ProfileSync(own_store, tiktok_url)
+    top = []  # min-heap of (view_count, seq, entry)
+    scanned = 0
+    old_streak = 0
+    try:
+        for line in lines:
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            scanned += 1
+
+            if sync.seen(data.get('webpage_url') or data.get('url') or '', data.get('timestamp')):
+                if sync.reached:
+                    print(f"   -> Reached videos seen on the last scan after {scanned} entries. Stopping scan.")
+                    break
+                continue
+
+            upload_date = entry_upload_date(data)
+            if upload_date and upload_date < START_DATE:
+                sync.settle(data.get('webpage_url') or data.get('url') or '')
+                old_streak += 1
+                if old_streak > PINNED_TOLERANCE:
+                    print(f"   -> Reached videos older than {START_DATE} after {scanned} entries. Stopping scan.")
+                    sync.complete = True
+                    break
+                continue
+            old_streak = 0
+
             view_count = data.get('view_count') or 0
-            
-            video_entries.append({
+            if not upload_date or view_count < VIEW_THRESHOLD:
+                sync.settle(data.get('webpage_url') or data.get('url') or '')
+                continue
+
+            entry = {
                 'url': data.get('webpage_url') or data.get('url'),
                 'title': data.get('title', 'Untitled'),
                 'view_count': view_count,
                 'upload_date': upload_date  # e.g., "20250315"
-            })
-        except json.JSONDecodeError:
-            continue
-            
-    print(f"Successfully found {len(video_entries)} total videos.")
+            }
+            if len(top) < DOWNLOAD_LIMIT:
+                heapq.heappush(top, (view_count, scanned, entry))
+            else:
+                # Whatever drops out of the top can't be downloaded this run either
+                _, _, evicted = heapq.heappushpop(top, (view_count, scanned, entry))
+                sync.settle(evicted['url'])
+        else:
+            sync.complete = True
+    except subprocess.CalledProcessError as e:
+        print(f"\n[ERROR] Extraction failed. Error: {e.stderr}")
+        raise Exception(f"yt-dlp failed: {e.stderr}")
+    finally:
+        lines.close()
+        if own_store:
+            own_store.close()
+
+    telemetry.record('scan', scan_started, time.time(), tiktok_url, entries=scanned)
+    video_entries = [entry for _, _, entry in sorted(top, reverse=True)]
+    print(f"Scanned {scanned} videos, kept the top {len(video_entries)} candidates.")
+    cache.put(scan_key, {'entries': video_entries})
+    cache.report()
     return video_entries
 
 def filter_and_sort(video_entries):
@@ -84,7 +167,7 @@ def filter_and_sort(video_entries):
     return final_list
 
 def download_videos(final_list):
-    """ Downloads the final filtered list. """
+    """ Downloads the final filtered list and records each file in the archive. """
     print("\n" + "="*60)
     print(f"STEP 3: Downloading {len(final_list)} videos...")
     print("="*60)
@@ -92,32 +175,48 @@ def download_videos(final_list):
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
 
+    store = archive.Archive()
     for i, video in enumerate(final_list):
         date_str = video['upload_date'] if video['upload_date'] else "UnknownDate"
         print(f"\n[{i + 1}/{len(final_list)}] [{date_str}] Downloading: {video['title'][:40]}...")
-        
+
+        # Already downloaded on an earlier run: skip the format probe and the download
+        platform, video_id = archive.video_key(video['url'])
+        if store.is_done(platform, video_id):
+            print(f"    -> Already archived. Skipping.")
+            continue
+
         output_template = os.path.join(
             OUTPUT_DIR, 
             f"viral_{i+1:02d}_%(view_count)s_%(upload_date)s_%(id)s.%(ext)s"
         )
 
-        options = [
-            '-o', output_template,
-            '-f', 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]', 
-        ]
-        
+        # Smallest formats meeting the phone target (formats.py), else the MP4 "best" selector
+        selection = formats.select_for(video['url'], access_args(),
+                                       'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]', label=f"{i + 1}")
+        options = ['-o', output_template, *selection.args]
+
         try:
             run_yt_dlp(video['url'], options, silent=True)
+            output = archive.find_output(OUTPUT_DIR, f"viral_{i+1:02d}_", video_id)
+            if output:
+                store.mark_done(platform, video_id, video['url'], output)
+            selection.finished(output)
             print(f"    -> Success!")
         except Exception:
             print(f"    -> Skipping video {i+1}. It might be private or region-locked.")
+        finally:
+            selection.close()
+    store.close()
 
 def main():
     tiktok_url = input("Enter TikTok Profile URL: ").strip()
     if not tiktok_url: return
 
+    store = archive.Archive()
     try:
-        all_videos = get_metadata(tiktok_url)
+        sync = archive.ProfileSync(store, tiktok_url)
+        all_videos = get_metadata(tiktok_url, sync)
         if not all_videos:
             print("No metadata found.")
             return
@@ -128,10 +227,16 @@ def main():
             return
 
         download_videos(viral_videos)
+        # Only after the downloads: failed or cut-off videos stay behind the watermark
+        sync.commit()
+        ytdlp_engine.report_transfers()
+        formats.report()
         print(f"\nPROCESS COMPLETE. Check the '{OUTPUT_DIR}' folder.")
         
     except Exception as e:
         print(f"\n[ERROR] {e}")
+    finally:
+        store.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
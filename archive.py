@@ -0,0 +1,410 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+# --- Configuration ---
+ARCHIVE_DB = os.environ.get("DOWNLOAD_ARCHIVE", "download_archive.sqlite3")
+MEDIA_EXTS = ('.mp4', '.mov', '.mkv', '.webm', '.m4a')
+# Incremental profile sync: scans stop once they run into content seen last time.
+# INCREMENTAL_SYNC=0 forces full scans (the watermark is still refreshed).
+INCREMENTAL_SYNC = os.environ.get("INCREMENTAL_SYNC", "1") != "0"
+WATERMARK_IDS = 30  # newest video IDs remembered per profile
+KNOWN_STREAK = 4    # consecutive known items that end a scan (pinned posts can precede new ones)
+# ---------------------
+
+# Output names written by the runners, with the %(id)s part captured:
+#   insta_filter: video_{index}_%(id)s    instagram: reel_{index}_%(id)s
+#   app:          tiktok_%(id)s           app_date:  viral_NN_%(view_count)s_%(upload_date)s_%(id)s
+FILENAME_PATTERNS = [
+    re.compile(r'^viral_\d+_\d+_\d{8}_(?P<id>.+)$'),
+    re.compile(r'^(?:video|reel)_\d+_(?P<id>.+)$'),
+    re.compile(r'^tiktok_(?P<id>\d{8,})$'),
+]
+
+URL_PATTERNS = [
+    ('tiktok', re.compile(r'/video/(?P<id>\d+)')),
+    ('instagram', re.compile(r'/(?:reel|reels|p|tv)/(?P<id>[A-Za-z0-9_-]+)')),
+    ('facebook', re.compile(r'/(?:videos|reel)/(?:[^/]+/)?(?P<id>\d+)')),
+]
+
+# One URL per video, whatever form it was found in (/p/ vs /reel/, profile-scoped
+# reels, video.php?v= vs /videos/ vs /reel/ on Facebook)
+CANONICAL_URLS = {
+    'instagram': "https://www.instagram.com/reel/{id}/",
+    'facebook': "https://www.facebook.com/watch/?v={id}",
+}
+
+
+def platform_of(url):
+    host = (urlparse(url).hostname or "").lower()
+    for platform in ('tiktok', 'instagram', 'facebook'):
+        if platform in host or (platform == 'facebook' and 'fb.watch' in host):
+            return platform
+    return host or 'unknown'
+
+
+def _parsed_id(platform, url):
+    """ The video ID carried by the URL itself, or None. """
+    parsed = urlparse(url)
+    for name, pattern in URL_PATTERNS:
+        if name == platform:
+            match = pattern.search(parsed.path)
+            if match:
+                return match.group('id')
+    if platform == 'facebook':
+        # video.php?v=<id>, watch/?v=<id>
+        video_id = parse_qs(parsed.query).get('v', [''])[0]
+        if video_id.isdigit():
+            return video_id
+    return None
+
+
+def video_key(url):
+    """
+    Returns (platform, video_id) parsed from the URL without any network work.
+    URLs without a recognisable ID (short links etc.) are keyed by the URL itself.
+    """
+    platform = platform_of(url)
+    return platform, _parsed_id(platform, url) or url.split('?')[0].rstrip('/')
+
+
+def canonical_url(url):
+    """
+    The one URL used for a video however it was linked, so variants of the
+    same video key (and download) once. URLs without a recognisable ID are
+    returned unchanged; TikTok URLs only lose their query string.
+    """
+    platform = platform_of(url) if url else None
+    video_id = url and _parsed_id(platform, url)
+    if not video_id:
+        return url
+    if platform in CANONICAL_URLS:
+        return CANONICAL_URLS[platform].format(id=video_id)
+    return url.split('?')[0]
+
+
+def unique_links(links):
+    """ Canonical URLs of `links` with repeats of the same video dropped (first one wins). Returns (links, dropped). """
+    keys, unique = set(), []
+    for link in links:
+        platform = platform_of(link)
+        # Without an ID only the exact same URL counts as a repeat
+        key = (platform, _parsed_id(platform, link) or link)
+        if key not in keys:
+            keys.add(key)
+            unique.append(canonical_url(link))
+    return unique, len(links) - len(unique)
+
+
+def link_file(source, target):
+    """ Makes `target` a hardlink to `source`, atomically replacing it. False if the filesystem can't. """
+    tmp = f"{target}.link.tmp"
+    try:
+        os.link(source, tmp)
+        os.replace(tmp, target)
+        return True
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Archive:
+    """ SQLite record of every (platform, video_id) we have tried to fetch. """
+
+    def __init__(self, path=ARCHIVE_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS downloads (
+                platform    TEXT NOT NULL,
+                video_id    TEXT NOT NULL,
+                url         TEXT,
+                status      TEXT NOT NULL,
+                output_path TEXT,
+                size        INTEGER,
+                checksum    TEXT,
+                error       TEXT,
+                updated_at  REAL,
+                PRIMARY KEY (platform, video_id)
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS downloads_checksum ON downloads (checksum)")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS watermarks (
+                profile     TEXT PRIMARY KEY,
+                newest_ids  TEXT NOT NULL,
+                newest_ts   REAL,
+                updated_at  REAL
+            )
+        """)
+        self.db.commit()
+
+    def get(self, platform, video_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT status, output_path, size, checksum FROM downloads WHERE platform = ? AND video_id = ?",
+                (platform, video_id)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('status', 'output_path', 'size', 'checksum'), row))
+
+    def is_done(self, platform, video_id):
+        """ True only if the entry succeeded and its file is still on disk. """
+        entry = self.get(platform, video_id)
+        return bool(
+            entry and entry['status'] == 'done'
+            and entry['output_path'] and os.path.exists(entry['output_path'])
+        )
+
+    def _upsert(self, platform, video_id, **fields):
+        fields['updated_at'] = time.time()
+        columns = ', '.join(fields)
+        placeholders = ', '.join('?' for _ in fields)
+        updates = ', '.join(f"{c} = excluded.{c}" for c in fields)
+        with self.lock:
+            self.db.execute(
+                f"INSERT INTO downloads (platform, video_id, {columns}) VALUES (?, ?, {placeholders}) "
+                f"ON CONFLICT (platform, video_id) DO UPDATE SET {updates}",
+                (platform, video_id, *fields.values())
+            )
+            self.db.commit()
+
+    def mark_done(self, platform, video_id, url, output_path):
+        size, checksum = os.path.getsize(output_path), file_checksum(output_path)
+        self._link_duplicate(output_path, size, checksum)
+        self._upsert(
+            platform, video_id, url=url, status='done', output_path=output_path,
+            size=size, checksum=checksum, error=None
+        )
+
+    def _link_duplicate(self, path, size, checksum):
+        """ If a byte-identical file is already archived elsewhere, replaces `path` with a hardlink to it. """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT output_path FROM downloads WHERE checksum = ? AND size = ? AND status = 'done'",
+                (checksum, size)
+            ).fetchall()
+        for (other,) in rows:
+            if not other or not os.path.exists(other) or os.path.samefile(other, path):
+                continue
+            if link_file(other, path):
+                print(f"[DEDUP] {path} is identical to {other}; hardlinked ({size / 1e6:.1f} MB freed)")
+            return
+
+    def reuse(self, platform, video_id, directory, stem):
+        """
+        Pre-download check. If the video is archived, returns its file in
+        `directory`, hardlinked in as stem + ext when it was downloaded into
+        another output directory. None if it still has to be downloaded.
+        """
+        if not self.is_done(platform, video_id):
+            return None
+        existing = self.get(platform, video_id)['output_path']
+        if os.path.abspath(os.path.dirname(existing)) == os.path.abspath(directory):
+            return existing
+        found = find_output(directory, '', video_id)
+        if found:
+            return found
+        target = os.path.join(directory, stem + os.path.splitext(existing)[1])
+        return target if link_file(existing, target) else existing
+
+    def mark_failed(self, platform, video_id, url, error):
+        self._upsert(platform, video_id, url=url, status='failed', error=(error or '')[:500])
+
+    def watermark(self, profile):
+        """ Returns {'ids': [newest first], 'timestamp': newest upload time or None}, or None. """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT newest_ids, newest_ts FROM watermarks WHERE profile = ?", (profile,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'ids': json.loads(row[0]), 'timestamp': row[1]}
+
+    def set_watermark(self, profile, ids, timestamp):
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO watermarks (profile, newest_ids, newest_ts, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (profile) DO UPDATE SET newest_ids = excluded.newest_ids, "
+                "newest_ts = excluded.newest_ts, updated_at = excluded.updated_at",
+                (profile, json.dumps(ids[:WATERMARK_IDS]), timestamp, time.time())
+            )
+            self.db.commit()
+
+    def import_dir(self, directory, platform):
+        """
+        Registers files already in an output directory (e.g. projector/) by
+        parsing the %(id)s part of their names. Empty files and unfinished
+        '.partial' ones are left out. Returns how many were added.
+        """
+        if not os.path.isdir(directory):
+            return 0
+        added = 0
+        for filename in sorted(os.listdir(directory)):
+            stem, ext = os.path.splitext(filename)
+            if ext.lower() not in MEDIA_EXTS or stem.endswith('.partial'):
+                continue
+            if not os.path.getsize(os.path.join(directory, filename)):
+                continue
+            for pattern in FILENAME_PATTERNS:
+                match = pattern.match(stem)
+                if match:
+                    video_id = match.group('id')
+                    if not self.is_done(platform, video_id):
+                        self.mark_done(platform, video_id, None, os.path.join(directory, filename))
+                        added += 1
+                    break
+        return added
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def profile_key(url):
+    """ 'platform:/path' for a profile/page URL, ignoring query strings and trailing slashes. """
+    parsed = urlparse(url if '//' in url else f"https://{url}")
+    return f"{platform_of(url)}:{parsed.path.rstrip('/').lower()}"
+
+
+class ProfileSync:
+    """
+    One scan of a profile against its stored watermark (the newest IDs and
+    upload time of videos already handled). Feed items go through seen()
+    newest first; once KNOWN_STREAK known items arrive in a row the scan has
+    caught up and `reached` turns true. Scanners set `complete` when they ran
+    out of feed on their own, and settle() items they skip on purpose (e.g.
+    below a view threshold, or cut off by a download limit). Once the downloads have run, commit() moves the
+    watermark up, but only past items that are done in the archive.
+    """
+
+    def __init__(self, store, profile_url):
+        self.store = store
+        self.profile = profile_key(profile_url)
+        mark = store.watermark(self.profile) or {'ids': [], 'timestamp': None}
+        self.previous = mark
+        self.known_ids = set(mark['ids']) if INCREMENTAL_SYNC else set()
+        self.known_before = mark['timestamp'] if INCREMENTAL_SYNC else None
+        self.streak = 0
+        self.new = []  # (platform, video_id, timestamp) of each unknown item, newest first
+        self.settled = set()
+        self.complete = False
+
+    def is_known(self, url, timestamp=None):
+        if video_key(url)[1] in self.known_ids:
+            return True
+        return bool(timestamp and self.known_before and timestamp <= self.known_before)
+
+    def seen(self, url, timestamp=None):
+        """ Records one feed item. Returns True if it was already known. """
+        known = self.is_known(url, timestamp)
+        if known:
+            self.streak += 1
+            return True
+        self.streak = 0
+        platform, video_id = video_key(url)
+        if all(video_id != item[1] for item in self.new):
+            self.new.append((platform, video_id, timestamp))
+        return False
+
+    def settle(self, url):
+        """ Marks an item the scanner decided not to download as handled. """
+        self.settled.add(video_key(url)[1])
+
+    @property
+    def reached(self):
+        return bool(self.known_ids) and self.streak >= KNOWN_STREAK
+
+    def commit(self):
+        """
+        Saves the new watermark; call it after the downloads. Items that are
+        neither done in the archive nor settled (e.g. failed downloads) stay
+        unknown, and so does everything newer than the
+        oldest of them, so the next scan reaches them again. If an earlier
+        watermark exists but this scan stopped before reaching it, the old
+        one is kept so the gap in between is scanned again next time.
+        """
+        if self.previous['ids'] and not (self.reached or self.complete):
+            return
+        pending = [i for i, (platform, video_id, _) in enumerate(self.new)
+                   if video_id not in self.settled and not self.store.is_done(platform, video_id)]
+        handled = self.new[pending[-1] + 1:] if pending else self.new
+        ids = [video_id for _, video_id, _ in handled]
+        ids += [i for i in self.previous['ids'] if i not in ids]
+        timestamp = max([ts for _, _, ts in handled if ts] + [self.previous['timestamp'] or 0]) or None
+        pending_ts = [self.new[i][2] for i in pending if self.new[i][2]]
+        if timestamp and pending_ts and timestamp >= min(pending_ts):
+            timestamp = self.previous['timestamp']
+        self.store.set_watermark(self.profile, ids, timestamp)
+
+
+def find_output(directory, prefix, video_id):
+    """ Finds the finished media file yt-dlp wrote for a '{prefix}..._{id}.ext' template. """
+    if not os.path.isdir(directory):
+        return None
+    for filename in os.listdir(directory):
+        stem, ext = os.path.splitext(filename)
+        if ext.lower() in MEDIA_EXTS and stem.startswith(prefix) and stem.endswith('_' + video_id):
+            return os.path.join(directory, filename)
+    return None
+
+
+def dedupe_dirs(directories):
+    """
+    Hardlinks byte-identical media files across (and within) directories,
+    e.g. projector/, tiktok_final_exports/ and ig_downloads_fixed/. Only
+    files sharing a size are hashed. Returns (files linked, bytes freed).
+    """
+    by_size = {}
+    for directory in directories:
+        if not os.path.isdir(directory):
+            continue
+        for filename in sorted(os.listdir(directory)):
+            path = os.path.join(directory, filename)
+            if os.path.splitext(filename)[1].lower() in MEDIA_EXTS and os.path.isfile(path):
+                by_size.setdefault(os.path.getsize(path), []).append(path)
+
+    linked = freed = 0
+    for size, paths in by_size.items():
+        if len(paths) < 2:
+            continue
+        first = {}
+        for path in paths:
+            checksum = file_checksum(path)
+            original = first.setdefault(checksum, path)
+            if original != path and not os.path.samefile(original, path) and link_file(original, path):
+                linked += 1
+                freed += size
+    return linked, freed
+
+
+if __name__ == "__main__":
+    # python archive.py import <directory> <platform>
+    # python archive.py dedupe <directory> [<directory> ...]
+    if len(sys.argv) >= 3 and sys.argv[1] == 'dedupe':
+        linked, freed = dedupe_dirs(sys.argv[2:])
+        print(f"Hardlinked {linked} duplicate files ({freed / 1e6:.1f} MB freed)")
+        sys.exit(0)
+    if len(sys.argv) != 4 or sys.argv[1] != 'import':
+        print("Usage: python archive.py import <directory> <platform>")
+        print("       python archive.py dedupe <directory> [<directory> ...]")
+        sys.exit(1)
+    archive = Archive()
+    print(f"Imported {archive.import_dir(sys.argv[2], sys.argv[3])} files from {sys.argv[2]} into {ARCHIVE_DB}")
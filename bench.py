@@ -0,0 +1,459 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Configuration ---
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STUB_DIR = os.path.join(REPO_DIR, "bench_stubs")  # fake yt-dlp / ffmpeg / ffprobe
+RESULTS_DIR = "bench_results"
+SCENARIOS = ("app", "insta_filter", "app_date", "mov")
+OPTIONAL_SCENARIOS = ("instagram", "fb_capture")  # need selenium (instagram also Chrome), run only when asked for
+OPEN_BUDGET = (1000.0, 1000)  # token bucket used unless --real-budgets
+OPEN_RETRY_DELAY = 0.5
+LINKS_PER_PAGE = 12  # reels added per fetch on the fixture profile page
+FB_VIDEO_ID_BASE = 10 ** 15  # feed item n is Facebook video FB_VIDEO_ID_BASE + n in /api/graphql
+MEDIA_EXTS = ('.mp4', '.mov', '.mkv', '.webm', '.m4a')
+# ---------------------
+
+# ru_maxrss is kilobytes on Linux, bytes on macOS
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+PROFILE_PAGE = """<!DOCTYPE html>
+<html><head><title>bench profile</title></head><body>
+<div id="feed"></div>
+<script>
+  let page = 0, loading = false;
+  const pages = %(pages)d, feed = document.getElementById('feed');
+  function load() {
+    if (loading || page >= pages) return;
+    loading = true;
+    fetch('/api/feed?page=' + page).then(r => r.json()).then(ids => {
+      for (const id of ids) {
+        const a = document.createElement('a');
+        a.href = '/reel/' + id;
+        a.textContent = id;
+        a.style.display = 'block';
+        a.style.height = '300px';
+        feed.appendChild(a);
+      }
+      page++;
+      loading = false;
+    });
+  }
+  window.addEventListener('scroll', () => {
+    if (window.innerHeight + window.scrollY >= document.body.scrollHeight - 50) load();
+  });
+  load();
+</script>
+</body></html>
+"""
+
+
+def fixture_mp4(size):
+    """ An ftyp box followed by one mdat box of random payload, `size` bytes in total. """
+    ftyp = b"\x00\x00\x00\x18ftypisom\x00\x00\x02\x00isomiso2"
+    payload = max(0, size - len(ftyp) - 8)
+    return ftyp + (payload + 8).to_bytes(4, "big") + b"mdat" + os.urandom(payload)
+
+
+def feed_numbers(page):
+    return range(page * LINKS_PER_PAGE + 1, (page + 1) * LINKS_PER_PAGE + 1)
+
+
+def fixture_views(n):
+    """ Play count the GraphQL fixture reports for feed item n (differs from the stub yt-dlp's). """
+    return 5000 + (n * 104729) % 50000
+
+
+def graphql_page(page):
+    """ A recorded-style Facebook GraphQL response for one feed page: video nodes nested in feed units. """
+    edges = []
+    for n in feed_numbers(page):
+        video_id = FB_VIDEO_ID_BASE + n
+        edges.append({"node": {"__typename": "Story", "attachments": [{"media": {
+            "__typename": "Video",
+            "id": str(video_id),
+            "permalink_url": f"https://www.facebook.com/bench/videos/{video_id}/",
+            "play_count": fixture_views(n),
+            "message": {"text": f"Bench caption {n}"},
+            "publish_time": int(time.time()) - n * 86400,
+        }}]}})
+    return {"data": {"node": {"timeline_list_feed_units": {"edges": edges}}}, "extensions": {"is_final": True}}
+
+
+def make_handler(media, pages, bandwidth):
+    class Handler(BaseHTTPRequestHandler):
+        """
+        /media/<id>.mp4 serves the fixture, /profile and /api/feed the scrolling
+        profile page, /api/graphql the same feed as Facebook GraphQL video nodes.
+        """
+
+        def _send(self, body, content_type):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if not bandwidth:
+                self.wfile.write(body)
+                return
+            chunk = 64 * 1024
+            for start in range(0, len(body), chunk):
+                self.wfile.write(body[start:start + chunk])
+                time.sleep(chunk / bandwidth)
+
+        def do_GET(self):
+            path, _, query = self.path.partition("?")
+            if path.startswith("/media/"):
+                self._send(media, "video/mp4")
+            elif path == "/profile":
+                self._send((PROFILE_PAGE % {"pages": pages}).encode(), "text/html")
+            elif path == "/api/feed":
+                page = int(query.partition("page=")[2] or 0)
+                ids = [f"BENCH{n:05d}" for n in feed_numbers(page)]
+                self._send(json.dumps(ids).encode(), "application/json")
+            elif path == "/api/graphql":
+                page = int(query.partition("page=")[2] or 0)
+                # Facebook prefixes its JSON with an anti-hijacking guard
+                self._send(b"for (;;);" + json.dumps(graphql_page(page)).encode(), "application/json")
+            else:
+                self.send_error(404)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(options):
+    """ Starts the fixture server on a free local port. Returns (server, base URL). """
+    pages = options["videos"] // LINKS_PER_PAGE + 2
+    handler = make_handler(fixture_mp4(options["media_bytes"]), pages, options["bandwidth"])
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def write_links(urls):
+    with open("links.txt", "w") as f:
+        f.write("\n".join(urls) + "\n")
+
+
+# Each scenario prepares its working directory and returns (run, links, output dir).
+# Only run() is measured; it may return a dict of extra metrics.
+
+def scenario_app(options):
+    import app
+    n = options["videos"]
+    write_links([f"https://www.tiktok.com/@bench/video/7{i:018d}" for i in range(1, n + 1)])
+    return lambda: app.process_videos(options["concurrency"]), n, app.OUTPUT_DIR
+
+
+def scenario_insta_filter(options):
+    import insta_filter
+    n = options["videos"]
+    write_links([f"https://www.instagram.com/reel/BENCH{i:05d}" for i in range(1, n + 1)])
+    return lambda: insta_filter.main(options["concurrency"]), n, insta_filter.OUTPUT_DIR
+
+
+def scenario_app_date(options):
+    import app_date
+    n = options["videos"]
+    # The stub's entry k is k days old: twice the limit qualifies, the rest ends the scan
+    app_date.DOWNLOAD_LIMIT = n
+    app_date.VIEW_THRESHOLD = 0
+    app_date.START_DATE = (date.today() - timedelta(days=2 * n)).strftime("%Y%m%d")
+
+    def run():
+        import archive
+        import metacache
+        profile = "https://www.tiktok.com/@bench"
+        store = archive.Archive()
+        try:
+            sync = archive.ProfileSync(store, profile)
+            entries = app_date.get_metadata(profile, sync)
+            app_date.download_videos(app_date.filter_and_sort(entries))
+            sync.commit()
+            # Rerun check: with every candidate downloaded or settled, a second
+            # scan (past the scan cache) should find nothing new
+            shutil.rmtree(metacache.CACHE_DIR, ignore_errors=True)
+            rerun = archive.ProfileSync(store, profile)
+            app_date.get_metadata(profile, rerun)
+            return {"rerun_new": len(rerun.new)}
+        finally:
+            store.close()
+    return run, n, app_date.OUTPUT_DIR
+
+
+def scenario_mov(options):
+    import mov
+    n = options["videos"]
+    os.makedirs(mov.INPUT_DIR, exist_ok=True)
+    media = fixture_mp4(options["media_bytes"])
+    for i in range(1, n + 1):
+        with open(os.path.join(mov.INPUT_DIR, f"bench_{i:05d}.mp4"), "wb") as f:
+            f.write(media)
+    return mov.convert_to_iphone_mov, n, mov.OUTPUT_DIR
+
+
+def scenario_instagram(options):
+    import browser
+    import instagram
+    n = options["videos"]
+    instagram.DOWNLOAD_LIMIT = n
+
+    def run():
+        driver = browser.new_driver(headless=True)
+        try:
+            links = instagram.scrape_clean_links(f"{options['server']}/profile", driver)
+        finally:
+            driver.quit()
+        instagram.download_links(links)
+    return run, n, instagram.OUTPUT_DIR
+
+
+def scenario_fb_capture(options):
+    import archive
+    import browser
+    import ig
+    n = options["videos"]
+    ig.DOWNLOAD_LIMIT = n
+    pages = n // LINKS_PER_PAGE + 2
+
+    def run():
+        # The responses NetworkCapture would read from Chrome's log, fetched
+        # directly so the scenario needs no browser
+        capture = browser.NetworkCapture(None)
+        links, expected = [], {}
+        for page in range(pages):
+            with urllib.request.urlopen(f"{options['server']}/api/feed?page={page}") as response:
+                numbers = [int(feed_id[len("BENCH"):]) for feed_id in json.load(response)]
+            for number in numbers:
+                link = archive.canonical_url(f"https://www.facebook.com/reel/{FB_VIDEO_ID_BASE + number}")
+                links.append(link)
+                expected[archive.video_key(link)] = fixture_views(number)
+            with urllib.request.urlopen(f"{options['server']}/api/graphql?page={page}") as response:
+                for payload in browser.parse_json_body(response.read().decode()):
+                    capture.add_payload(payload)
+
+        # Every page link should get its view count from the captured records
+        captured = {archive.video_key(e['url']): e['view_count'] for e in ig.entries_from_records(capture.records)}
+        mismatched = [key for key, views in expected.items() if captured.get(key) != views]
+        ig.process_page(links, capture.records, ig.OUTPUT_DIR)
+        return {"capture_mismatched": len(mismatched)}
+    return run, n, ig.OUTPUT_DIR
+
+
+SCENARIO_SETUP = {
+    "app": scenario_app,
+    "insta_filter": scenario_insta_filter,
+    "app_date": scenario_app_date,
+    "mov": scenario_mov,
+    "instagram": scenario_instagram,
+    "fb_capture": scenario_fb_capture,
+}
+
+
+def cpu_seconds():
+    """ CPU used by this process plus every child it has waited for (yt-dlp, ffmpeg). """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def output_stats(directory):
+    """ Returns (media files, total bytes) under directory. """
+    count, size = 0, 0
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.lower().endswith(MEDIA_EXTS) and '.part' not in filename:
+                count += 1
+                size += os.path.getsize(os.path.join(dirpath, filename))
+    return count, size
+
+
+def run_scenario(name, options):
+    """ Runs one scenario in the current (child) process and returns its metrics. """
+    sys.path.insert(0, REPO_DIR)
+    import throttle
+    if not options["real_budgets"]:
+        # Measure the scripts, not the politeness delays tuned for the live sites
+        throttle.HOST_BUDGETS.clear()
+        throttle.DEFAULT_BUDGET = OPEN_BUDGET
+        throttle.RATE_LIMIT_PENALTY = 0
+        for category in throttle.RETRY_BASE_DELAY:
+            throttle.RETRY_BASE_DELAY[category] = OPEN_RETRY_DELAY
+
+    run, links, output_dir = SCENARIO_SETUP[name](options)
+    cpu_before = cpu_seconds()
+    started = time.monotonic()
+    extra = run() or {}
+    wall = time.monotonic() - started
+    cpu = cpu_seconds() - cpu_before
+
+    videos, size = output_stats(output_dir)
+    return {
+        **extra,
+        "wall_seconds": round(wall, 3),
+        "links": links,
+        "videos": videos,
+        "links_per_minute": round(links / wall * 60, 2) if wall else None,
+        "bytes": size,
+        "bytes_per_second": round(size / wall) if wall else None,
+        "cpu_seconds": round(cpu, 3),
+        "cpu_seconds_per_video": round(cpu / videos, 4) if videos else None,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT / 1e6, 1),
+        "peak_child_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * RSS_UNIT / 1e6, 1),
+    }
+
+
+def scenario_env(options, workdir):
+    """ Environment for a scenario process: stub tools first on PATH, all state inside workdir. """
+    env = dict(os.environ)
+    env.update({
+        "PATH": STUB_DIR + os.pathsep + env.get("PATH", ""),
+        "YTDLP_BIN": os.path.join(STUB_DIR, "yt-dlp"),
+        "YTDLP_ENGINE": "subprocess",
+        "DOWNLOAD_ARCHIVE": os.path.join(workdir, "download_archive.sqlite3"),
+        "METADATA_CACHE_DIR": os.path.join(workdir, ".metadata_cache"),
+        "DOWNLOAD_CONCURRENCY": str(options["concurrency"]),
+        "BENCH_SERVER": options["server"],
+        "BENCH_LATENCY": str(options["latency"]),
+        "BENCH_FAILURE_RATE": str(options["failure_rate"]),
+        "BENCH_FAILURE_KIND": options["failure_kind"],
+        "BENCH_PROFILE_SIZE": str(options["videos"] * 4),
+        "BENCH_TRANSCODE_RATE": str(options["transcode_rate"]),
+        "BENCH_TRANSCODE_CPU": str(options["transcode_cpu"]),
+    })
+    return env
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_comparison(results, previous_path):
+    """ Prints each metric next to the same metric from an earlier results file. """
+    with open(previous_path) as f:
+        previous = json.load(f)
+    print(f"\n--- Compared with {previous_path} ({previous.get('git_commit')}) ---")
+    for name, metrics in results["scenarios"].items():
+        old = previous.get("scenarios", {}).get(name)
+        if not old or "error" in metrics or "error" in old:
+            continue
+        changes = []
+        for key in ("links_per_minute", "bytes_per_second", "cpu_seconds_per_video", "peak_rss_mb"):
+            if metrics.get(key) and old.get(key):
+                changes.append(f"{key} {(metrics[key] - old[key]) / old[key] * 100:+.1f}%")
+        print(f"   {name:<13} " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the download scripts against stub tools and a local fixture server.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma-separated, from {', '.join(SCENARIOS + OPTIONAL_SCENARIOS)}")
+    parser.add_argument("--videos", type=int, default=40, help="links / files per scenario")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.2, help="stub extractor latency per call (s)")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--failure-kind", default="transient", choices=("transient", "rate_limited", "not_found"))
+    parser.add_argument("--media-bytes", type=int, default=2_000_000, help="size of the fixture MP4")
+    parser.add_argument("--bandwidth", type=float, default=0, help="per-connection bytes/s cap, 0 = unlimited")
+    parser.add_argument("--transcode-rate", type=float, default=0.25, help="share of fixtures ffprobe reports as VP9")
+    parser.add_argument("--transcode-cpu", type=float, default=0.05, help="stub ffmpeg CPU-seconds per MB transcoded")
+    parser.add_argument("--real-budgets", action="store_true", help="keep throttle.py's live per-host budgets")
+    parser.add_argument("--timeout", type=float, default=900, help="per-scenario limit (s)")
+    parser.add_argument("--output", help=f"results file (default {RESULTS_DIR}/bench_<time>.json)")
+    parser.add_argument("--compare", help="earlier results file to print changes against")
+    parser.add_argument("--keep", action="store_true", help="keep the scenario working directories")
+    parser.add_argument("--run-scenario", help=argparse.SUPPRESS)
+    parser.add_argument("--options", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        # Child mode: one scenario per process so CPU and peak RSS are its own
+        options = json.loads(args.options)
+        metrics = run_scenario(args.run_scenario, options)
+        with open("metrics.json", "w") as f:
+            json.dump(metrics, f)
+        return
+
+    options = {k: v for k, v in vars(args).items() if k not in ("run_scenario", "options")}
+    server, options["server"] = start_server(options)
+    root = tempfile.mkdtemp(prefix="bench_")
+    results = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "options": {k: v for k, v in options.items() if k not in ("server", "output", "compare", "keep")},
+        "scenarios": {},
+    }
+
+    print(f"Benchmarking {args.scenarios} with {args.videos} videos each (fixture server {options['server']})")
+    try:
+        for name in [s.strip() for s in args.scenarios.split(",") if s.strip()]:
+            if name not in SCENARIO_SETUP:
+                print(f"   {name}: unknown scenario, skipped")
+                continue
+            workdir = os.path.join(root, name)
+            os.makedirs(workdir)
+            log_path = os.path.join(workdir, "output.log")
+            cmd = [sys.executable, os.path.abspath(__file__), "--run-scenario", name, "--options", json.dumps(options)]
+            process = None
+            try:
+                with open(log_path, "w") as log:
+                    process = subprocess.run(cmd, cwd=workdir, env=scenario_env(options, workdir),
+                                             stdout=log, stderr=subprocess.STDOUT, timeout=args.timeout)
+                with open(os.path.join(workdir, "metrics.json")) as f:
+                    metrics = json.load(f)
+            except subprocess.TimeoutExpired:
+                metrics = {"error": f"timed out after {args.timeout:.0f}s"}
+            except (OSError, ValueError):
+                metrics = {"error": f"exit code {process and process.returncode}, see {log_path}"}
+            results["scenarios"][name] = metrics
+
+            if "error" in metrics:
+                print(f"   {name:<13} FAILED: {metrics['error']}")
+            else:
+                print(f"   {name:<13} {metrics['videos']}/{metrics['links']} videos in {metrics['wall_seconds']:.1f}s  "
+                      f"{metrics['links_per_minute']:.0f} links/min  {metrics['bytes_per_second'] / 1e6:.2f} MB/s  "
+                      f"{metrics['cpu_seconds_per_video'] or 0:.3f} cpu-s/video  peak RSS {metrics['peak_rss_mb']} MB")
+                if metrics.get("capture_mismatched"):
+                    print(f"   {name:<13} CAPTURE: {metrics['capture_mismatched']} page links without their captured view count")
+                if metrics.get("rerun_new"):
+                    print(f"   {name:<13} RERUN: {metrics['rerun_new']} entries still behind the watermark")
+    finally:
+        server.shutdown()
+        if args.keep:
+            print(f"Working directories kept in {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"bench_{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        print_comparison(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
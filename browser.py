@@ -0,0 +1,388 @@
+import contextlib
+import json
+import os
+import queue
+import threading
+import time
+
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.support.ui import WebDriverWait
+
+import archive
+
+# --- Configuration ---
+PAGE_LOAD_TIMEOUT = 60   # Max wait for the first links to render
+SCROLL_TIMEOUT = 10      # Max wait for new content after one scroll
+NETWORK_QUIET_MS = 1500  # No new network requests for this long = page settled
+IDLE_SCROLLS = 2         # Stop after this many scrolls that found nothing new
+MAX_SCROLLS = 200        # Hard safety cap for endless feeds
+POLL_INTERVAL = 0.25
+DRIVER_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "tikdownloader_chromedriver.json")
+DRIVER_CACHE_TTL = 7 * 24 * 3600  # Re-resolve chromedriver once a week
+# ---------------------
+
+# Returns [matching element count, resources loaded so far] in one round trip.
+# The resource-timing buffer stops at 250 entries, so requests are counted by
+# a PerformanceObserver (installed once per page), which sees every one.
+_PAGE_STATE_JS = """
+    if (window.__requestCount === undefined) {
+        window.__requestCount = performance.getEntriesByType('resource').length;
+        new PerformanceObserver(list => { window.__requestCount += list.getEntries().length; })
+            .observe({type: 'resource'});
+        performance.addEventListener('resourcetimingbufferfull', () => performance.clearResourceTimings());
+    }
+    return [document.querySelectorAll(arguments[0]).length, window.__requestCount];
+"""
+
+
+class _NewContentOrQuiet:
+    """
+    WebDriverWait condition: true once more elements match the selector
+    than before, or once the page has stopped issuing network requests
+    for NETWORK_QUIET_MS (nothing more is coming).
+    """
+
+    def __init__(self, selector, baseline):
+        self.selector = selector
+        self.baseline = baseline
+        self.resources = None
+        self.quiet_since = time.monotonic()
+
+    def __call__(self, driver):
+        count, resources = driver.execute_script(_PAGE_STATE_JS, self.selector)
+        if count > self.baseline:
+            return 'new'
+        if resources != self.resources:
+            self.resources = resources
+            self.quiet_since = time.monotonic()
+            return False
+        if (time.monotonic() - self.quiet_since) * 1000 >= NETWORK_QUIET_MS:
+            return 'quiet'
+        return False
+
+
+def wait_for_content(driver, selector, baseline=0, timeout=SCROLL_TIMEOUT):
+    """ Blocks until new elements match `selector` or the network goes quiet. Returns 'new', 'quiet' or 'timeout'. """
+    try:
+        return WebDriverWait(driver, timeout, poll_frequency=POLL_INTERVAL).until(
+            _NewContentOrQuiet(selector, baseline)
+        )
+    except TimeoutException:
+        return 'timeout'
+
+
+def iter_scrolled_links(driver, selector, collect_script, clean=None, max_scrolls=MAX_SCROLLS, sync=None):
+    """
+    Scrolls the current page and yields each new link as soon as it shows up.
+    collect_script is JS returning the page's link list (or a callable taking
+    the driver, e.g. NetworkCapture.poll); clean() normalises each entry.
+    Scrolling stops by itself once IDLE_SCROLLS scrolls in a row add nothing,
+    so the time spent follows how much content the profile has.
+    With an archive.ProfileSync, links it already knows are not yielded and
+    scrolling stops as soon as the feed reaches last run's watermark.
+    """
+    seen = set()
+    wait_for_content(driver, selector, timeout=PAGE_LOAD_TIMEOUT)
+
+    idle = 0
+    for i in range(max_scrolls):
+        before = len(seen)
+        found = collect_script(driver) if callable(collect_script) else driver.execute_script(collect_script)
+        for href in found or []:
+            url = clean(href) if clean else href
+            if url and url not in seen:
+                seen.add(url)
+                if sync and sync.seen(url):
+                    continue
+                yield url
+
+        print(f"   Scroll {i+1}: Found {len(seen)} unique items")
+        if sync and sync.reached:
+            print(f"   Reached content seen on the last run. Stopping scroll.")
+            return
+        idle = idle + 1 if len(seen) == before else 0
+        if idle >= IDLE_SCROLLS:
+            if sync:
+                sync.complete = True
+            break
+
+        count = driver.execute_script(_PAGE_STATE_JS, selector)[0]
+        driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+        wait_for_content(driver, selector, baseline=count)
+
+
+def scroll_and_collect(driver, selector, collect_script, clean=None, max_scrolls=MAX_SCROLLS, sync=None):
+    """ List version of iter_scrolled_links. """
+    return list(iter_scrolled_links(driver, selector, collect_script, clean, max_scrolls, sync))
+
+
+def driver_path():
+    """
+    Returns the chromedriver path, running ChromeDriverManager's lookup only
+    when the cached path is missing, gone from disk or older than DRIVER_CACHE_TTL.
+    """
+    try:
+        with open(DRIVER_CACHE_FILE) as f:
+            cached = json.load(f)
+        if os.path.exists(cached['path']) and time.time() - cached['resolved_at'] < DRIVER_CACHE_TTL:
+            return cached['path']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    from webdriver_manager.chrome import ChromeDriverManager
+    path = ChromeDriverManager().install()
+    os.makedirs(os.path.dirname(DRIVER_CACHE_FILE), exist_ok=True)
+    with open(DRIVER_CACHE_FILE, 'w') as f:
+        json.dump({'path': path, 'resolved_at': time.time()}, f)
+    return path
+
+
+def new_driver(headless=True, window_size="1200,800", extra_args=(), capabilities=None):
+    """ Starts a Chrome instance on the cached driver path. """
+    options = Options()
+    options.add_argument(f"--window-size={window_size}")
+    options.add_argument("--log-level=3")
+    if headless:
+        options.add_argument("--headless=new")
+    for arg in extra_args:
+        options.add_argument(arg)
+    for name, value in (capabilities or {}).items():
+        options.set_capability(name, value)
+    return webdriver.Chrome(service=Service(driver_path()), options=options)
+
+
+class BrowserPool:
+    """
+    N long-lived Chrome instances shared by worker threads. Browsers are
+    started lazily and reused for every profile, so a batch pays the cold
+    start once per browser instead of once per profile.
+    """
+
+    def __init__(self, size, **driver_kwargs):
+        self.size = max(1, size)
+        self.driver_kwargs = driver_kwargs
+        self.idle = queue.Queue()
+        self.started = 0
+        self.lock = threading.Lock()
+        self.all = []
+
+    @contextlib.contextmanager
+    def driver(self):
+        """ Borrows a browser; a crashed one is replaced instead of being returned. """
+        driver = None
+        while driver is None:
+            with self.lock:
+                start_new = self.idle.empty() and self.started < self.size
+                if start_new:
+                    self.started += 1
+            if start_new:
+                try:
+                    driver = new_driver(**self.driver_kwargs)
+                except Exception:
+                    with self.lock:
+                        self.started -= 1
+                    raise
+                with self.lock:
+                    self.all.append(driver)
+            else:
+                # Wait in short steps: a discarded browser frees a slot without
+                # anything arriving on the idle queue
+                try:
+                    driver = self.idle.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    pass
+
+        healthy = True
+        try:
+            yield driver
+        except Exception:
+            healthy = self._alive(driver)
+            raise
+        finally:
+            if healthy:
+                self.idle.put(driver)
+            else:
+                self._discard(driver)
+
+    def _alive(self, driver):
+        try:
+            driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, driver):
+        with self.lock:
+            self.started -= 1
+            if driver in self.all:
+                self.all.remove(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def map(self, fn, items):
+        """ Runs fn(driver, item) for every item on `size` threads. Returns results in input order. """
+        results = [None] * len(items)
+        pending = queue.Queue()
+        for i, item in enumerate(items):
+            pending.put((i, item))
+
+        def worker():
+            while True:
+                try:
+                    i, item = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    with self.driver() as driver:
+                        results[i] = fn(driver, item)
+                except Exception as e:
+                    print(f"   [ERROR] Browser job failed for {item}: {e}")
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self.size, len(items)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def close(self):
+        with self.lock:
+            drivers, self.all = self.all, []
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+
+
+# Chrome capability that turns on the performance (DevTools network) log
+PERFORMANCE_LOGGING = {'goog:loggingPrefs': {'performance': 'ALL'}}
+JSON_URL_HINTS = ('/graphql', '/api/')
+VIEW_COUNT_KEYS = ('play_count', 'ig_play_count', 'video_view_count', 'view_count', 'video_play_count')
+TIMESTAMP_KEYS = ('taken_at', 'publish_time', 'creation_time', 'created_time')
+CAPTION_KEYS = ('caption', 'message', 'description', 'title')
+
+
+def _text(value):
+    if isinstance(value, dict):
+        return value.get('text')
+    return value if isinstance(value, str) else None
+
+
+def _video_record(node):
+    """
+    Recognises a video node in Instagram/Facebook API JSON. Instagram media
+    carry a shortcode ('code'); Facebook nodes are typed '__typename: Video'.
+    Returns a partial record, or None if the dict isn't a video.
+    """
+    if isinstance(node.get('code'), str) and any(k in node for k in VIEW_COUNT_KEYS):
+        url = f"https://www.instagram.com/reel/{node['code']}"
+        video_id = node['code']
+    elif node.get('__typename') == 'Video' and node.get('id'):
+        video_id = str(node['id'])
+        url = node.get('permalink_url') or f"https://www.facebook.com/video.php?v={video_id}"
+    else:
+        return None
+
+    views = next((node[k] for k in VIEW_COUNT_KEYS if isinstance(node.get(k), int)), None)
+    caption = next((_text(node[k]) for k in CAPTION_KEYS if _text(node.get(k))), None)
+    timestamp = next((node[k] for k in TIMESTAMP_KEYS if isinstance(node.get(k), int)), None)
+    return {'id': video_id, 'url': archive.canonical_url(url), 'view_count': views, 'description': caption, 'timestamp': timestamp}
+
+
+def iter_video_records(payload):
+    """ Walks a decoded JSON payload and yields every video record in it. """
+    stack = [payload]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            record = _video_record(node)
+            if record:
+                yield record
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+
+
+def parse_json_body(body):
+    """ Decodes an API response body: strips 'for (;;);' guards and handles one-JSON-per-line streams. """
+    body = body.strip()
+    if body.startswith('for (;;);'):
+        body = body[len('for (;;);'):]
+    try:
+        return [json.loads(body)]
+    except ValueError:
+        pass
+    payloads = []
+    for line in body.splitlines():
+        try:
+            payloads.append(json.loads(line))
+        except ValueError:
+            continue
+    return payloads
+
+
+class NetworkCapture:
+    """
+    Reads the JSON/GraphQL responses the page itself receives, via Chrome's
+    performance log and the DevTools Network.getResponseBody command, and
+    keeps the video records (id, views, caption, timestamp) found in them.
+    The driver must be started with capabilities=PERFORMANCE_LOGGING.
+    """
+
+    def __init__(self, driver, url_hints=JSON_URL_HINTS):
+        self.driver = driver
+        self.url_hints = url_hints
+        self.pending = {}   # requestId -> url, waiting for loadingFinished
+        self.records = {}   # url -> merged record
+
+    def _wanted(self, response):
+        mime = response.get('mimeType', '')
+        url = response.get('url', '')
+        return 'json' in mime or any(h in url for h in self.url_hints)
+
+    def _body(self, request_id):
+        try:
+            result = self.driver.execute_cdp_cmd('Network.getResponseBody', {'requestId': request_id})
+        except Exception:
+            return None  # evicted from Chrome's buffer, or not a text body
+        if result.get('base64Encoded'):
+            return None
+        return result.get('body')
+
+    def add_payload(self, payload):
+        """ Merges every video record in a decoded payload. Returns the URLs seen. """
+        urls = []
+        for record in iter_video_records(payload):
+            merged = self.records.setdefault(record['url'], {})
+            merged.update({k: v for k, v in record.items() if v is not None})
+            urls.append(record['url'])
+        return urls
+
+    def poll(self, driver=None):
+        """ Processes new log entries. Returns the URLs of every record known so far. """
+        for entry in (driver or self.driver).get_log('performance'):
+            try:
+                message = json.loads(entry['message'])['message']
+            except (KeyError, ValueError):
+                continue
+            method, params = message.get('method'), message.get('params', {})
+            if method == 'Network.responseReceived' and self._wanted(params.get('response', {})):
+                self.pending[params['requestId']] = params['response'].get('url')
+            elif method == 'Network.loadingFinished' and params.get('requestId') in self.pending:
+                self.pending.pop(params['requestId'])
+                body = self._body(params['requestId'])
+                for payload in parse_json_body(body) if body else []:
+                    self.add_payload(payload)
+        return list(self.records)
+
+
+def read_profiles(path):
+    """ One profile URL per line; blank lines and # comments are ignored. """
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
@@ -0,0 +1,220 @@
+import json
+import os
+import tempfile
+import threading
+
+import throttle
+import ytdlp_engine
+
+# --- Configuration ---
+# "target": smallest formats that still reach TARGET_HEIGHT and MIN_VIDEO_KBPS
+# "budget": best formats whose estimated size fits BYTES_BUDGET per video
+# "best":   each runner's own selector, without the extra format probe
+FORMAT_POLICY = os.environ.get("FORMAT_POLICY", "target")
+TARGET_HEIGHT = int(os.environ.get("FORMAT_TARGET_HEIGHT", "1080"))  # phone playback
+MIN_VIDEO_KBPS = float(os.environ.get("FORMAT_MIN_VIDEO_KBPS", "0"))
+BYTES_BUDGET = int(float(os.environ.get("FORMAT_BYTES_BUDGET", str(30 * 1024 * 1024))))
+MIN_AUDIO_KBPS = 64  # smallest audio track at or above this; below it only if nothing better exists
+# Codecs phones play without a transcode (yt-dlp codec prefixes); preferred when offered
+PHONE_VCODECS = ('avc', 'h264', 'hvc', 'hev', 'h265', 'hevc', 'bytevc1')
+PHONE_ACODECS = ('mp4a', 'aac', 'mp3')
+# ---------------------
+
+selections = []  # one dict per finished download that went through the policy, for reports
+_selections_lock = threading.Lock()
+
+
+def has_video(fmt):
+    vcodec = fmt.get('vcodec')
+    return vcodec != 'none' and bool(vcodec or fmt.get('height'))
+
+
+def has_audio(fmt):
+    acodec = fmt.get('acodec')
+    return bool(acodec) and acodec != 'none'
+
+
+def estimate_size(fmt, duration):
+    """ Bytes for one format: yt-dlp's size (exact or approximate), else bitrate x duration. None if unknown. """
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return int(size)
+    kbps = fmt.get('tbr') or (fmt.get('vbr') or 0) + (fmt.get('abr') or 0)
+    return int(kbps * 125 * duration) if kbps and duration else None
+
+
+def _kbps(fmt):
+    return fmt.get('vbr') or fmt.get('tbr') or 0
+
+
+def _pick_audio(audios, duration):
+    """ Smallest phone-friendly audio track of at least MIN_AUDIO_KBPS (the best one if none is). """
+    audios = [a for a in audios if estimate_size(a, duration)]
+    pool = [a for a in audios if (a.get('acodec') or '').startswith(PHONE_ACODECS)] or audios
+    enough = [a for a in pool if (a.get('abr') or a.get('tbr') or 0) >= MIN_AUDIO_KBPS]
+    if enough:
+        return min(enough, key=lambda a: estimate_size(a, duration))
+    return max(pool, key=lambda a: a.get('abr') or a.get('tbr') or 0, default=None)
+
+
+def options(info, audio_picker=_pick_audio):
+    """
+    Every downloadable combination in the info dict: progressive formats on
+    their own, video-only formats merged with the chosen audio track. Each
+    is {'format', 'bytes', 'height', 'kbps', 'phone'}; ones without a size
+    estimate are left out.
+    """
+    duration = info.get('duration')
+    formats = [f for f in info.get('formats') or [] if f.get('format_id') and f.get('protocol') != 'mhtml']
+    audio = audio_picker([f for f in formats if has_audio(f) and not has_video(f)], duration)
+    silent_source = not any(has_audio(f) for f in formats)
+
+    found = []
+    for fmt in formats:
+        if not has_video(fmt) or not fmt.get('height'):
+            continue
+        size = estimate_size(fmt, duration)
+        spec = fmt['format_id']
+        if not has_audio(fmt):
+            if audio:
+                spec += '+' + audio['format_id']
+                audio_size = estimate_size(audio, duration)
+                size = size + audio_size if size and audio_size else None
+            elif not silent_source:
+                continue  # would come out without sound
+        if size:
+            found.append({
+                'format': spec, 'bytes': size, 'height': fmt['height'], 'kbps': _kbps(fmt),
+                'phone': (fmt.get('vcodec') or '').startswith(PHONE_VCODECS),
+            })
+    return found
+
+
+def _best_audio(audios, duration):
+    """ Highest-bitrate audio track with a size estimate. """
+    audios = [a for a in audios if estimate_size(a, duration)]
+    return max(audios, key=lambda a: a.get('abr') or a.get('tbr') or 0, default=None)
+
+
+def best_option(info):
+    """ What the runners' "best" selectors download: highest resolution, then bitrate, with the best audio. """
+    return max(options(info, _best_audio), key=lambda o: (o['height'], o['kbps']), default=None)
+
+
+def select(info, policy=None):
+    """ Applies the policy to a yt-dlp info dict. Returns the chosen option, or None to keep the default. """
+    policy = policy or FORMAT_POLICY
+    found = options(info)
+    if policy == 'best' or not found:
+        return None
+    pool = [o for o in found if o['phone']] or found
+    if policy == 'budget':
+        fitting = [o for o in pool if o['bytes'] <= BYTES_BUDGET]
+        if not fitting:
+            return min(pool, key=lambda o: o['bytes'])
+        return max(fitting, key=lambda o: (o['height'], o['kbps'], -o['bytes']))
+    # Reach the target (or the tallest the source has), then take the smallest
+    height = min(TARGET_HEIGHT, max(o['height'] for o in pool))
+    tall = [o for o in pool if o['height'] >= height]
+    kbps = min(MIN_VIDEO_KBPS, max(o['kbps'] for o in tall))
+    return min((o for o in tall if o['kbps'] >= kbps), key=lambda o: o['bytes'])
+
+
+class Selection:
+    """
+    The format arguments for one download. When the policy picked formats,
+    the probed info JSON is handed to yt-dlp with --load-info-json, so the
+    download doesn't run the extractor a second time. Use as a context
+    manager (or call close()) to remove that file afterwards.
+    """
+
+    def __init__(self, format_spec, extra=(), label="", chosen=None, best=None, info_path=None):
+        self.format = format_spec
+        self.extra = list(extra)
+        self.label = label
+        self.chosen = chosen
+        self.best = best
+        self.info_path = info_path
+
+    @property
+    def args(self):
+        return ['-f', self.format, *self.extra]
+
+    def finished(self, path=None):
+        """ Counts a successful download towards report() (with its real size when the file is known). """
+        if not self.chosen:
+            return
+        actual = os.path.getsize(path) if path and os.path.exists(path) else None
+        with _selections_lock:
+            selections.append({
+                'label': self.label, 'chosen': self.chosen['bytes'], 'height': self.chosen['height'],
+                'best': self.best['bytes'] if self.best else self.chosen['bytes'], 'actual': actual,
+            })
+
+    def close(self):
+        if self.info_path and os.path.exists(self.info_path):
+            os.remove(self.info_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def select_for(url, probe_args=(), default_format='bv*+ba/b', default_extra=(), label=""):
+    """
+    Probes the URL's formats once (yt-dlp -j, paced and retried like any
+    other call) and applies FORMAT_POLICY. Falls back to the runner's own
+    default_format/default_extra when the policy is "best", the probe fails
+    or the formats carry no size information.
+    """
+    default = Selection(default_format, default_extra, label)
+    if FORMAT_POLICY == 'best':
+        return default
+    cmd = [url, '-j', '--no-playlist', *probe_args]
+    result, outcome = throttle.run_with_retries(url, lambda: ytdlp_engine.run(cmd, encoding='utf-8'), label=label)
+    try:
+        info = json.loads(result.stdout.strip().splitlines()[-1]) if result.returncode == 0 else None
+    except (ValueError, IndexError):
+        info = None
+    try:
+        chosen = select(info) if info else None
+    except Exception as e:  # odd format lists must never cost the download itself
+        print(f"   [FORMAT] {label} could not rank formats: {e}")
+        chosen = None
+    if not chosen:
+        reason = f"probe failed ({outcome})" if result.returncode != 0 else "no usable size estimates"
+        print(f"   [FORMAT] {label} {reason}; using the default selector")
+        return default
+
+    best = best_option(info) or chosen
+    fd, info_path = tempfile.mkstemp(prefix='format_probe_', suffix='.info.json')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(info, f)
+    print(f"   [FORMAT] {label} {chosen['height']}p ~{chosen['bytes'] / 1e6:.1f} MB "
+          f"(best: {best['height']}p ~{best['bytes'] / 1e6:.1f} MB)")
+    return Selection(chosen['format'], ['--load-info-json', info_path], label, chosen, best, info_path)
+
+
+def report(since=0):
+    """ Prints the bytes the policy saved against "best" for the downloads recorded from index `since` on. """
+    with _selections_lock:
+        done = selections[since:]
+    if not done:
+        return
+    chosen = sum(s['chosen'] for s in done)
+    best = sum(s['best'] for s in done)
+    saved = best - chosen
+    print(f"\n--- Format policy ({FORMAT_POLICY}): {len(done)} videos, ~{chosen / 1e6:.1f} MB chosen vs "
+          f"~{best / 1e6:.1f} MB best, saved ~{saved / 1e6:.1f} MB ({saved / best * 100 if best else 0:.0f}%) ---")
+    measured = [s for s in done if s['actual']]
+    if measured:
+        print(f"   {len(measured)} files on disk: {sum(s['actual'] for s in measured) / 1e6:.1f} MB")
+
+
+def trim_selections(keep):
+    """ Drops all but the newest `keep` records (long-running service). """
+    with _selections_lock:
+        del selections[:-keep or None]
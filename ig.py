@@ -1,17 +1,40 @@
-import subprocess
 import json
 import os
-import time
 import sys
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
 from selenium.common.exceptions import WebDriverException, TimeoutException
 
+import archive
+import metacache
+import mov
+import segdl
+import telemetry
+import throttle
+import browser
+import formats
+import ytdlp_engine
+
 # --- Configuration ---
 DOWNLOAD_LIMIT = 60      # Maximum number of videos to download
-SCROLL_COUNT = 4         # Number of times to scroll down the page
+MAX_SCROLLS = 200        # Safety cap; scrolling stops once no new videos appear
+METADATA_BATCH_SIZE = 25 # URLs per yt-dlp invocation in the metadata pass
+METADATA_WORKERS = 3     # Batches extracted in parallel
+BROWSER_POOL_SIZE = 3    # Headless browsers used by batch mode (python ig.py pages.txt)
+# "network" reads view counts/captions from the page's own GraphQL responses
+# (Chrome DevTools log) so most videos skip the yt-dlp metadata pass;
+# "dom" only scrapes anchor hrefs and extracts everything with yt-dlp.
+SCRAPE_MODE = os.environ.get("FB_SCRAPE_MODE", "network")
+VIDEO_FORMAT = 'bestvideo*+bestaudio/best'
+# Large progressive videos are fetched as parallel, resumable byte ranges
+# (segdl.py); DASH/HLS goes to yt-dlp with concurrent fragments instead.
+# Only used when the formats.py probe already knows the size, so it never
+# costs a second extraction per video.
+SEGMENTED_DOWNLOADS = True
+# Downloads whose streams MP4 can carry are only remuxed; the rest are
+# transcoded on this many background workers while downloads continue.
+TRANSCODE_WORKERS = 1
 
 # --- Setup ---
 OUTPUT_DIR = "facebook_downloads"
@@ -35,52 +58,45 @@ def check_setup():
         sys.exit(1)
 
 def run_yt_dlp(url, options, silent=False):
-    """Runs yt-dlp as a subprocess."""
-    cmd = ['yt-dlp', url] + options
+    """Downloads with yt-dlp, streaming progress and killing stalled transfers (see ytdlp_engine.download)."""
+    cmd = [url] + options
     cmd.extend(['--cookies', COOKIE_FILE])
 
-    max_retries = 3
-    base_delay = 5
+    # Retries, backoff and per-platform concurrency come from the shared controller
+    deadline = ytdlp_engine.job_deadline()
+    process, outcome = throttle.run_with_retries(
+        url, lambda: ytdlp_engine.download(cmd, label=url, deadline=deadline, encoding='latin-1')
+    )
+    if outcome == throttle.AUTH:
+        raise Exception(f"Authentication Failed: {process.stderr}")
+    if process.returncode != 0:
+        raise Exception(f"yt-dlp failed ({outcome}): {process.stderr}")
+    return process.stdout
 
-    for attempt in range(max_retries):
-        try:
-            process = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                check=True,
-                encoding='latin-1'
-            )
-            return process.stdout
-        except subprocess.CalledProcessError as e:
-            stderr_lower = e.stderr.lower() if e.stderr else ""
-            if "login" in stderr_lower or "private" in stderr_lower:
-                raise Exception(f"Authentication Failed: {e.stderr}")
-            if attempt < max_retries - 1:
-                time.sleep(base_delay * (2 ** attempt))
-            else:
-                raise Exception(f"yt-dlp failed: {e.stderr}")
-
-def scrape_video_urls_with_selenium(facebook_url):
-    """Uses Selenium to extract video links."""
-    print("\nSTEP 1: Scraping video links...")
-    options = Options()
-    options.add_argument("--window-size=1920,1080")
-    options.add_argument("--log-level=3")
+VIDEO_SELECTOR = 'a[href*="/videos/"], a[href*="/reel/"], div[data-video-id]'
+
+def driver_capabilities():
+    return browser.PERFORMANCE_LOGGING if SCRAPE_MODE == "network" else None
+
+def scrape_video_urls_with_selenium(facebook_url, driver=None, sync=None):
+    """
+    Uses Selenium to extract video links. Uses the given (pooled) driver, or starts its own.
+    Returns (urls, records): in network mode records maps URLs to the
+    view_count/description/timestamp captured from the page's API responses.
+    With an archive.ProfileSync only videos newer than the page's watermark
+    are returned and scrolling stops once the feed reaches the ones seen on
+    the last run; the caller commits it after downloading.
+    """
+    print(f"\nSTEP 1: Scraping video links from {facebook_url}...")
+    own_driver = driver is None
 
     try:
-        driver_service = Service(ChromeDriverManager().install())
-        driver = webdriver.Chrome(service=driver_service, options=options)
+        if own_driver:
+            driver = browser.new_driver(headless=False, window_size="1920,1080", capabilities=driver_capabilities())
+        capture = browser.NetworkCapture(driver) if SCRAPE_MODE == "network" else None
+        if capture:
+            driver.get_log('performance')  # drop entries left over from a previous page
         driver.get(facebook_url)
-        time.sleep(60) # Initial wait for content
-
-        last_height = driver.execute_script("return document.body.scrollHeight")
-        for i in range(SCROLL_COUNT):
-            driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-            time.sleep(7)
-            new_height = driver.execute_script("return document.body.scrollHeight")
-            if new_height == last_height: break
-            last_height = new_height
 
         script = """
             let urls = new Set();
@@ -94,36 +110,157 @@ def scrape_video_urls_with_selenium(facebook_url):
             });
             return Array.from(urls);
         """
-        urls = driver.execute_script(script)
-        driver.quit()
-        return urls
+        # Scrolls until the link set stops growing, waiting on new anchors or
+        # network idle after each scroll instead of fixed sleeps
+        collect = (lambda d: capture.poll(d) + d.execute_script(script)) if capture else script
+        # video.php?v=, /videos/ and /reel/ links to one video collapse into one URL
+        urls = browser.scroll_and_collect(driver, VIDEO_SELECTOR, collect, archive.canonical_url,
+                                          max_scrolls=MAX_SCROLLS, sync=sync)
+        records = {
+            url: record for url, record in (capture.records if capture else {}).items()
+            if not (sync and sync.is_known(url, record.get('timestamp')))
+        }
+        return urls, records
+    except WebDriverException:
+        raise  # browser failures reach BrowserPool, which replaces a crashed driver
     except Exception as e:
         print(f"Scraping error: {e}")
-        return []
+        return [], {}
+    finally:
+        if own_driver and driver:
+            driver.quit()
 
-def get_metadata(video_urls):
-    """Step 2: Fetches metadata including descriptions (captions)."""
-    print("\nSTEP 2: Fetching metadata and captions...")
-    video_entries = []
-    options = ['--dump-json']
-    
-    for i, url in enumerate(video_urls):
-        print(f"   -> Processing {i+1}/{len(video_urls)}...", end='\r')
+# Cheap pass: yt-dlp prints just these fields instead of the whole info JSON
+VIEWS_ONLY_TEMPLATE = '%(.{original_url,webpage_url,title,view_count})j'
+
+def fetch_metadata_batch(urls, views_only=False):
+    """
+    Extracts metadata for many URLs in one yt-dlp invocation.
+    Returns (records, errors): records maps each input URL to its JSON
+    record, errors maps each URL that produced no record to
+    {'category': failure class, 'message': yt-dlp's error line}.
+    """
+    cmd = list(urls) + ['--ignore-errors', '--no-playlist', '--cookies', COOKIE_FILE]
+    cmd += ['-O', VIEWS_ONLY_TEMPLATE] if views_only else ['--dump-json']
+
+    # Every URL is a request to Facebook, so the batch costs one token per URL:
+    # run_with_retries takes the first, the rest are taken here
+    for url in urls[1:]:
+        throttle.bucket_for(url).acquire()
+    # One attempt here: fetch_metadata retries only the URLs that need it
+    result, _ = throttle.run_with_retries(
+        urls[0], lambda: ytdlp_engine.run(cmd, encoding='latin-1'), max_attempts=1
+    )
+
+    records = {}
+    for line in result.stdout.splitlines():
         try:
-            stdout = run_yt_dlp(url, options, silent=True)
-            data = json.loads(stdout)
-            
-            # Capture description for the caption file
-            video_entries.append({
-                'url': data.get('webpage_url'),
-                'title': data.get('title', 'Untitled Video'),
-                'view_count': data.get('view_count', 0) or 0,
-                'description': data.get('description', 'No caption provided.')
-            })
-        except:
+            data = json.loads(line)
+        except json.JSONDecodeError:
             continue
+        records[data.get('original_url') or data.get('webpage_url')] = data
+
+    error_lines = [l for l in result.stderr.splitlines() if l.startswith('ERROR')]
+    errors = {url: error_for_url(url, error_lines) for url in urls if url not in records}
+    return records, errors
+
+def error_for_url(url, error_lines):
+    """yt-dlp reports "ERROR: [facebook] <id>: reason"; match a line back to its URL by the id."""
+    message = 'no metadata returned'
+    for line in error_lines:
+        parts = line.split(':', 2)
+        if len(parts) == 3 and parts[1].split() and parts[1].split()[-1] in url:
+            message = line[:200]
+            break
+    return {'category': throttle.classify_error(message), 'message': message}
+
+def fetch_metadata(urls, views_only=False):
+    """
+    Splits URLs into METADATA_BATCH_SIZE batches run on METADATA_WORKERS
+    parallel extractors. URLs that failed with a retryable error class are
+    re-batched after a jittered backoff, up to throttle.MAX_ATTEMPTS times.
+    """
+    records, errors = {}, {}
+    pending = list(urls)
+    for attempt in range(throttle.MAX_ATTEMPTS):
+        batches = [pending[i:i + METADATA_BATCH_SIZE] for i in range(0, len(pending), METADATA_BATCH_SIZE)]
+        results = throttle.run_pool(
+            batches, lambda i, batch: fetch_metadata_batch(batch, views_only), METADATA_WORKERS
+        )
+        for result in results:
+            if result:
+                records.update(result[0])
+                errors.update(result[1])
+
+        for url in records:
+            errors.pop(url, None)
+        pending = [u for u, e in errors.items() if e['category'] in throttle.RETRYABLE]
+        if not pending or attempt == throttle.MAX_ATTEMPTS - 1:
+            break
+        worst = max((errors[u]['category'] for u in pending), key=lambda c: throttle.RETRY_BASE_DELAY[c])
+        delay = throttle.retry_delay(attempt, worst)
+        print(f"   [RETRY] {len(pending)} URLs ({worst}) in {delay:.0f}s")
+        time.sleep(delay)
+    return records, errors
+
+def report_errors(errors):
+    for url, error in errors.items():
+        print(f"   [METADATA ERROR] {error['category']}: {url}: {error['message']}")
+
+def get_metadata(video_urls, cache=None):
+    """Step 2: Fetches view counts for every URL (cheap pass, captions come later)."""
+    cache = cache or metacache.MetadataCache()
+    video_entries = []
+    to_fetch = []
+    for url in video_urls:
+        cached = cache.get(metacache.cache_key(url), ('title', 'view_count'))
+        if cached:
+            video_entries.append({'url': url, 'title': cached['title'],
+                                  'view_count': cached['view_count'], 'description': None})
+        else:
+            to_fetch.append(url)
+
+    print(f"\nSTEP 2: Fetching view counts for {len(to_fetch)} videos ({len(video_entries)} cached)...")
+    records, errors = fetch_metadata(to_fetch, views_only=True) if to_fetch else ({}, {})
+    report_errors(errors)
+
+    for url, data in records.items():
+        entry = {
+            'url': data.get('webpage_url') or url,
+            'title': data.get('title') or 'Untitled Video',
+            'view_count': data.get('view_count', 0) or 0,
+            'description': None
+        }
+        cache.put(metacache.cache_key(url), {'title': entry['title'], 'view_count': entry['view_count']})
+        video_entries.append(entry)
             
-    print(f"\nExtracted metadata for {len(video_entries)} videos.")
+    print(f"\nExtracted metadata for {len(video_entries)} videos ({len(errors)} failed).")
+    cache.report()
+    return video_entries
+
+def add_descriptions(video_entries, cache=None):
+    """Step 3b: Full metadata pass for the selected videos still missing a caption."""
+    cache = cache or metacache.MetadataCache()
+    for video in video_entries:
+        if video['description'] is None:
+            cached = cache.get(metacache.cache_key(video['url']), ('description',))
+            if cached:
+                video['description'] = cached['description']
+
+    missing = [v for v in video_entries if v['description'] is None]
+    if not missing:
+        return video_entries
+    print(f"\nFetching captions for {len(missing)} of the top {len(video_entries)} videos...")
+    records, errors = fetch_metadata([v['url'] for v in missing])
+    report_errors(errors)
+    for video in missing:
+        data = records.get(video['url'], {})
+        # Capture description for the caption file
+        video['description'] = data.get('description') or 'No caption provided.'
+        if data:
+            cache.put(metacache.cache_key(video['url']), {
+                field: data.get(field) for field in ('title', 'description', 'view_count', 'timestamp', 'duration')
+            })
     return video_entries
 
 def filter_and_sort(video_entries):
@@ -131,15 +268,102 @@ def filter_and_sort(video_entries):
     sorted_videos = sorted(video_entries, key=lambda x: x['view_count'], reverse=True)
     return sorted_videos[:DOWNLOAD_LIMIT]
 
-def download_videos(final_list):
+def download_video(url, output_dir, index_str):
+    """Downloads one video without re-encoding it, in the formats.py policy's formats. Returns the file path, or None."""
+    with formats.select_for(url, ['--cookies', COOKIE_FILE], VIDEO_FORMAT, label=index_str) as selection:
+        path = download_selected(url, output_dir, index_str, selection)
+        if path:
+            selection.finished(path)
+        return path
+
+def download_selected(url, output_dir, index_str, selection):
+    """Segmented download for large videos the format probe sized, yt-dlp otherwise."""
+    output_template = os.path.join(output_dir, f"viral_{index_str}_%(title)s.%(ext)s")
+    large = selection.chosen and selection.chosen['bytes'] >= segdl.MIN_SEGMENTED_BYTES
+    try:
+        if SEGMENTED_DOWNLOADS and large:
+            # Resolves from the probe's --load-info-json, not from Facebook again
+            segmented = segdl.download(url, selection.format, output_template,
+                                      ['--cookies', COOKIE_FILE, *selection.extra], label=index_str,
+                                      cookie_file=COOKIE_FILE)
+            if segmented:
+                return segmented
+            if segmented is False:
+                print(f"    -> WARNING: Segmented download interrupted; run again to resume.")
+                return None
+    except Exception as e:
+        print(f"    -> WARNING: Segmented download unavailable, using yt-dlp: {e}")
+
+    options = [
+        '-o', output_template,
+        *selection.args,
+        '--concurrent-fragments', str(segdl.FRAGMENT_CONCURRENCY),
+        # Stream-copy merge: MP4 when the codecs fit, MKV otherwise. No re-encode here.
+        '--merge-output-format', 'mp4/mkv',
+        '--print', 'after_move:filepath',
+    ]
+    try:
+        stdout = run_yt_dlp(url, options, silent=True)
+    except Exception as e:
+        print(f"    -> WARNING: Failed to download video: {e}")
+        return None
+    # run_yt_dlp decodes as latin-1; file paths are UTF-8
+    lines = [line.strip().encode('latin-1').decode('utf-8', 'replace') for line in stdout.splitlines()]
+    paths = [line for line in lines if line and os.path.exists(line)]
+    return paths[-1] if paths else None
+
+def convert_to_mp4(path, mode, codec_args, reason, threads=0):
+    """Writes path's streams into an MP4 next to it (mode/codec_args from mov.plan_conversion)."""
+    base = os.path.splitext(path)[0]
+    target, tmp = base + '.mp4', base + '.converting.mp4'
+    cmd = ['ffmpeg', '-i', path] + codec_args + ['-threads', str(threads), '-movflags', '+faststart', tmp, '-y']
+    with telemetry.span(mode, file=os.path.basename(path), bytes=os.path.getsize(path)) as span:
+        returncode, stderr, cpu_seconds = mov.run_ffmpeg(cmd)
+        span.set(outcome='success' if returncode == 0 else 'failed', cpu_seconds=round(cpu_seconds, 3))
+    if returncode != 0:
+        print(f"    -> WARNING: {mode} of {os.path.basename(path)} failed: {stderr.strip()[-200:]}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    os.replace(tmp, target)
+    if path != target:
+        os.remove(path)
+    print(f"    -> {mode.capitalize()} done: {os.path.basename(target)} ({reason}, {cpu_seconds:.1f} cpu-s)")
+    return True
+
+def finish_as_mp4(path, transcodes, pending):
+    """
+    Uses mov.py's compatibility rules: compatible streams are remuxed (or
+    just the audio re-encoded) right away, incompatible video is queued on
+    the transcode pool so the next download can start.
+    """
+    try:
+        mode, codec_args, reason, _ = mov.plan_conversion(path)
+    except Exception as e:
+        print(f"    -> WARNING: Could not probe {os.path.basename(path)}, left as downloaded: {e}")
+        return
+    if mode == 'transcode':
+        threads = max(1, (os.cpu_count() or 1) // TRANSCODE_WORKERS)
+        pending.append(transcodes.submit(convert_to_mp4, path, mode, codec_args, reason, threads))
+        print(f"    -> Queued for transcode ({reason})")
+    elif mode == 'remux' and path.lower().endswith('.mp4'):
+        print(f"    -> Already MP4-compatible, no conversion needed.")
+    else:
+        convert_to_mp4(path, mode, codec_args, reason)
+
+def download_videos(final_list, output_dir=OUTPUT_DIR):
     """Step 4: Downloads videos and saves captions to .txt files."""
     print("\n" + "="*60)
     print(f"STEP 4: Downloading {len(final_list)} videos and saving captions...")
     print("="*60)
 
-    if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
 
+    # Transcodes run here in the background so they never hold up the next download
+    transcodes = ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS)
+    pending = []
+    downloaded = []
     for i, video in enumerate(final_list):
         index_str = f"{i+1:02d}"
         print(f"\n[{index_str}/{len(final_list)}] Processing: {video['title'][:40]}...")
@@ -147,7 +371,7 @@ def download_videos(final_list):
         # 1. Save the Caption to a Text File
         # We use a clean filename that matches the video prefix
         txt_filename = f"viral_{index_str}_caption.txt"
-        txt_path = os.path.join(OUTPUT_DIR, txt_filename)
+        txt_path = os.path.join(output_dir, txt_filename)
         
         try:
             with open(txt_path, "w", encoding="utf-8") as f:
@@ -161,38 +385,144 @@ def download_videos(final_list):
             print(f"    -> WARNING: Could not save caption: {e}")
 
         # 2. Download the Video
-        output_template = os.path.join(OUTPUT_DIR, f"viral_{index_str}_%(title)s.%(ext)s")
-        options = [
-            '-o', output_template,
-            '-f', 'bestvideo*+bestaudio/best',
-            '--recode-video', 'mp4',
-        ]
-        
-        try:
-            run_yt_dlp(video['url'], options, silent=True)
-            print(f"    -> Video download complete.")
-        except Exception as e:
-            print(f"    -> WARNING: Failed to download video: {e}")
+        path = download_video(video['url'], output_dir, index_str)
+        if path:
+            print(f"    -> Video download complete: {os.path.basename(path)}")
+            downloaded.append((video['url'], path))
+            # 3. Make it an MP4: remux now, or queue a transcode and move on
+            finish_as_mp4(path, transcodes, pending)
 
-def main():
-    check_setup()
-    facebook_url = input("Enter Facebook Page URL: ").strip()
-    if not facebook_url: return
+    remaining = sum(1 for future in pending if not future.done())
+    if remaining:
+        print(f"\nWaiting for {remaining} background transcodes...")
+    for future in pending:
+        future.result()
+    transcodes.shutdown()
+
+    # Recorded once converted, so profile watermarks only move past videos on disk
+    store = archive.Archive()
+    try:
+        for url, path in downloaded:
+            final = path if os.path.exists(path) else os.path.splitext(path)[0] + '.mp4'
+            if os.path.exists(final):
+                store.mark_done(*archive.video_key(url), url, final)
+    finally:
+        store.close()
 
+def normalize_page_url(facebook_url):
     if "web.facebook.com" in facebook_url:
         facebook_url = facebook_url.replace("web.facebook.com", "www.facebook.com")
+    return facebook_url
+
+def page_output_dir(facebook_url):
+    """Batch mode keeps each page's viral_NN files in their own folder."""
+    path, _, query = facebook_url.partition('?')
+    slug = path.rstrip('/').split('/')[-1] or 'page'
+    # profile.php?id=N pages differ only by their id
+    profile_id = parse_qs(query).get('id', [''])[0]
+    if profile_id:
+        slug = f"{os.path.splitext(slug)[0]}_{profile_id}"
+    return os.path.join(OUTPUT_DIR, slug)
+
+def entries_from_records(records):
+    """Turns captured network records that carry a view count into metadata entries, one per video."""
+    entries = []
+    keys = set()
+    for url, record in records.items():
+        # permalink_url, video.php?v= and /videos/<id> forms of one video share a key
+        key = archive.video_key(url)
+        if record.get('view_count') is None or key in keys:
+            continue
+        keys.add(key)
+        caption = record.get('description')
+        entries.append({
+            'url': url,
+            'title': (caption or 'Untitled Video').splitlines()[0][:80],
+            'view_count': record['view_count'],
+            'description': caption
+        })
+    return entries
+
+def process_page(urls, records=None, output_dir=OUTPUT_DIR, sync=None):
+    """
+    Steps 2-4 for one page's scraped URLs. Captured records skip the metadata pass.
+    Videos the filter leaves out are settled on the archive.ProfileSync.
+    """
+    cache = metacache.MetadataCache()
+    all_videos = entries_from_records(records or {})
+    # Matched by (platform, video id): the page's links and the API's URLs differ in form
+    known = {archive.video_key(v['url']) for v in all_videos}
+    missing = [u for u in urls if archive.video_key(u) not in known]
+    if all_videos:
+        print(f"\nSTEP 2: {len(all_videos)} view counts captured from network traffic.")
+    if missing:
+        all_videos += get_metadata(missing, cache)
+    viral_videos = add_descriptions(filter_and_sort(all_videos), cache)
+    if sync:
+        chosen = {archive.video_key(v['url']) for v in viral_videos}
+        for video in all_videos:
+            if archive.video_key(video['url']) not in chosen:
+                sync.settle(video['url'])
+    transfers_before = len(ytdlp_engine.transfers)
+    selections_before = len(formats.selections)
+    download_videos(viral_videos, output_dir)
+    ytdlp_engine.report_transfers(transfers_before)
+    formats.report(selections_before)
+
+def batch_main(pages_file):
+    """Scrapes every page in the file through a pool of headless browsers, then processes each."""
+    pages = [normalize_page_url(p) for p in browser.read_profiles(pages_file)]
+    print(f"Batch mode: {len(pages)} pages, {BROWSER_POOL_SIZE} headless browsers")
+
+    pool = browser.BrowserPool(
+        BROWSER_POOL_SIZE, headless=True, window_size="1920,1080", capabilities=driver_capabilities()
+    )
+    store = archive.Archive()
+    syncs = {page: archive.ProfileSync(store, page) for page in pages}
+    try:
+        results = pool.map(lambda driver, url: scrape_video_urls_with_selenium(url, driver, syncs[url]), pages)
+    finally:
+        pool.close()
+
+    try:
+        for page, result in zip(pages, results):
+            urls, records = result or ([], {})
+            if not urls:
+                print(f"[{page}] No video links found. Skipping.")
+                continue
+            try:
+                process_page(urls, records, page_output_dir(page), syncs[page])
+                # Only after the downloads: failed or skipped videos stay behind the watermark
+                syncs[page].commit()
+            except Exception as e:
+                print(f"\n[PROGRAM ERROR] {page}: {e}")
+    finally:
+        store.close()
+    print(f"\n\nBATCH COMPLETE. Check '{OUTPUT_DIR}' for files.")
+
+def main():
+    check_setup()
+    if len(sys.argv) > 1:
+        batch_main(sys.argv[1])
+        return
+
+    facebook_url = normalize_page_url(input("Enter Facebook Page URL: ").strip())
+    if not facebook_url: return
 
+    store = archive.Archive()
     try:
-        all_urls = scrape_video_urls_with_selenium(facebook_url)
+        sync = archive.ProfileSync(store, facebook_url)
+        all_urls, records = scrape_video_urls_with_selenium(facebook_url, sync=sync)
         if not all_urls: return
         
-        all_videos = get_metadata(all_urls)
-        viral_videos = filter_and_sort(all_videos)
-        download_videos(viral_videos)
+        process_page(all_urls, records, sync=sync)
+        sync.commit()
         
         print(f"\n\nPROCESS COMPLETE. Check '{OUTPUT_DIR}' for files.")
     except Exception as e:
         print(f"\n[PROGRAM ERROR]: {e}")
+    finally:
+        store.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,11 +1,17 @@
-import subprocess
 import os
 import sys
 
+import archive
+import formats
+import throttle
+import ytdlp_engine
+
 # --- Configuration ---
 INPUT_FILE = "links.txt"
 OUTPUT_DIR = "projector"
 COOKIE_FILE = os.path.join(os.getcwd(), 'cookies.txt')
+CONCURRENCY = throttle.CONCURRENCY
+PLATFORM = 'instagram'
 
 def check_setup():
     """Validates that necessary files and folders exist."""
@@ -20,19 +26,28 @@ def check_setup():
         os.makedirs(OUTPUT_DIR)
         print(f"[INFO] Created directory: {OUTPUT_DIR}")
 
-def run_yt_dlp(url, index):
+def run_yt_dlp(url, index, store=None):
     """
     Downloads Instagram video using yt-dlp.
+    Links already marked done in the archive (with the file still on disk) are skipped.
     """
+    platform, video_id = archive.video_key(url)
+    # Also covers videos another runner already saved (hardlinked in, not re-extracted)
+    existing = store.reuse(platform, video_id, OUTPUT_DIR, f"video_{index}_{video_id}") if store else None
+    if existing:
+        print(f"   [SKIP] {index}: {video_id} already in archive ({existing})")
+        return True
+
     # Naming format: monitors_2/video_1_ID.mp4
     output_template = os.path.join(OUTPUT_DIR, f"video_{index}_%(id)s.%(ext)s")
-    
+    access_args = ['--cookies', COOKIE_FILE, '--ies', 'instagram']
+    # Smallest formats meeting the phone target (formats.py); the old "best" selector otherwise
+    selection = formats.select_for(url, access_args, 'bv*+ba/best', ['--format-sort', 'res,br,fps'],
+                                   label=f"Link {index}")
+
     cmd = [
-        'yt-dlp',
-        '--cookies', COOKIE_FILE,
-        '--ies', 'instagram',
-        '-f', 'bv*+ba/best',
-        '--format-sort', 'res,br,fps',
+        *access_args,
+        *selection.args,
         '--merge-output-format', 'mp4',
         '-o', output_template,
         '--no-playlist',
@@ -40,42 +55,65 @@ def run_yt_dlp(url, index):
     ]
 
     try:
-        # Run the command
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        # Paced, adaptively limited and retried by the shared controller
+        deadline = ytdlp_engine.job_deadline()
+        result, outcome = throttle.run_with_retries(
+            url, lambda: ytdlp_engine.download(cmd, label=f"Link {index}", deadline=deadline), label=f"Link {index}"
+        )
         if result.returncode == 0:
             print(f"   [SUCCESS] {index}: Downloaded {url}")
+            output = archive.find_output(OUTPUT_DIR, f"video_{index}_", video_id)
+            if store and output:
+                store.mark_done(platform, video_id, url, output)
+            selection.finished(output)
             return True
         else:
             # Check if it's a private video/login issue
             error_msg = result.stderr.split('\n')[0]
-            print(f"   [FAILED] {index}: {error_msg}")
+            if store:
+                store.mark_failed(platform, video_id, url, result.stderr)
+            print(f"   [FAILED] {index} ({outcome}): {error_msg}")
             return False
     except Exception as e:
         print(f"   [ERROR] Runtime error on link {index}: {e}")
         return False
+    finally:
+        selection.close()
 
-def main():
+def main(concurrency=None):
     check_setup()
 
     # Read links from file
     with open(INPUT_FILE, "r") as f:
         # filter(None, ...) removes empty lines
         links = [line.strip() for line in f if line.strip()]
+    # /p/, /reel/ and profile-scoped reel links to one video become one link
+    links, duplicates = archive.unique_links(links)
+    if duplicates:
+        print(f"[INFO] Dropped {duplicates} duplicate links (same video as an earlier line)")
 
     if not links:
         print(f"[IDLE] No links found in {INPUT_FILE}. Exiting.")
         return
 
-    print(f"--- Starting Batch Download ({len(links)} links) ---\n")
-    
-    success_count = 0
-    for i, link in enumerate(links, start=1):
-        if run_yt_dlp(link, i):
-            success_count += 1
+    concurrency = concurrency or CONCURRENCY
+    print(f"--- Starting Batch Download ({len(links)} links, {concurrency} workers) ---\n")
+
+    # Anything already sitting in OUTPUT_DIR counts as fetched, whatever its index
+    store = archive.Archive()
+    imported = store.import_dir(OUTPUT_DIR, PLATFORM)
+    if imported:
+        print(f"[INFO] Imported {imported} existing files from '{OUTPUT_DIR}' into the archive")
+
+    results = throttle.run_pool(links, lambda i, link: run_yt_dlp(link, i, store), concurrency)
+    store.close()
+    success_count = sum(1 for r in results if r)
+    ytdlp_engine.report_transfers()
+    formats.report()
 
     print(f"\n--- FINISHED ---")
     print(f"Total processed: {len(links)}")
     print(f"Successfully saved to '{OUTPUT_DIR}': {success_count}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else None)
\ No newline at end of file
@@ -1,16 +1,19 @@
-import subprocess
 import os
-import time
 import sys
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.common.by import By
+import threading
+
+import archive
+import browser
+import formats
+import throttle
+import ytdlp_engine
+from pipeline import Pipeline, Stage
 
 # --- Configuration ---
 DOWNLOAD_LIMIT = 60
-SCROLL_COUNT = 10
+MAX_SCROLLS = 200  # Safety cap; scrolling stops by itself once no new links appear
+BROWSER_POOL_SIZE = 3  # Headless browsers used by batch mode (python instagram.py profiles.txt)
+DOWNLOAD_WORKERS = throttle.CONCURRENCY  # Downloads running while the page is still scrolling
 OUTPUT_DIR = "ig_downloads_fixed"
 COOKIE_FILE = os.path.join(os.getcwd(), 'cookies.txt')
 
@@ -19,19 +22,27 @@ def check_setup():
         print("[ERROR] cookies.txt is missing! Instagram will block these requests.")
         sys.exit(1)
 
-def run_yt_dlp(url, index):
+def run_yt_dlp(url, index, store=None):
     """
     High-quality Instagram download using bestvideo+bestaudio.
     Forces Instagram extractor and sorts by best resolution, bitrate, and fps.
+    Reels already in the archive (from any runner) are hardlinked in instead.
     """
+    platform, video_id = archive.video_key(url)
+    existing = store.reuse(platform, video_id, OUTPUT_DIR, f"reel_{index}_{video_id}") if store else None
+    if existing:
+        print(f"   [SKIP] Already in archive: {existing}")
+        return True
+
     output_template = os.path.join(OUTPUT_DIR, f"reel_{index}_%(id)s.%(ext)s")
-    
+    access_args = ['--cookies', COOKIE_FILE, '--ies', 'instagram']
+    # Smallest formats meeting the phone target (formats.py); the old "best" selector otherwise
+    selection = formats.select_for(url, access_args, 'bv*+ba/best', ['--format-sort', 'res,br,fps'],
+                                   label=f"Reel {index}")
+
     cmd = [
-    'yt-dlp',
-    '--cookies', COOKIE_FILE,
-    '--ies', 'instagram',
-    '-f', 'bv*+ba/best',
-    '--format-sort', 'res,br,fps',
+    *access_args,
+    *selection.args,
     '--merge-output-format', 'mp4',
     '-o', output_template,
     '--no-playlist',
@@ -40,68 +51,205 @@ def run_yt_dlp(url, index):
 
 
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        deadline = ytdlp_engine.job_deadline()
+        result, outcome = throttle.run_with_retries(
+            url, lambda: ytdlp_engine.download(cmd, label=f"Reel {index}", deadline=deadline)
+        )
         if result.returncode == 0:
             print(f"   [SUCCESS] Downloaded: {url}")
+            output = archive.find_output(OUTPUT_DIR, f"reel_{index}_", video_id)
+            if store and output:
+                store.mark_done(platform, video_id, url, output)
+            selection.finished(output)
             return True
         else:
-            print(f"   [FAILED] yt-dlp Error: {result.stderr[:150]}...")
+            if store:
+                store.mark_failed(platform, video_id, url, result.stderr)
+            print(f"   [FAILED] yt-dlp Error ({outcome}): {result.stderr[:150]}...")
             return False
     except Exception as e:
         print(f"   [ERROR] Runtime error: {e}")
         return False
+    finally:
+        selection.close()
 
-def scrape_clean_links(profile_url):
-    print(f"\nSTEP 1: Scraping and Cleaning Links...")
-    options = Options()
-    options.add_argument("--window-size=1200,800")
-    
-    driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
-    driver.get(profile_url)
-    time.sleep(7)
+LINK_SELECTOR = "a[href*='/reel/'], a[href*='/p/']"
+# 🔥 Use JS to extract hrefs directly (no stale elements)
+COLLECT_LINKS_JS = f"""
+    return Array.from(document.querySelectorAll("{LINK_SELECTOR}")).map(a => a.href);
+"""
+
+def clean_link(href):
+    # /p/<id> and /<user>/reel/<id> links to one reel end up as the same URL
+    return archive.canonical_url(href.split('?')[0]) if href else None
 
-    found_links = set()
+def scrape_clean_links(profile_url, driver=None, sync=None):
+    """
+    Scrapes one profile. Uses the given (pooled) driver, or starts and quits its own.
+    With an archive.ProfileSync only reels newer than the profile's watermark
+    are returned and the scroll stops once it reaches the ones seen on the
+    last run; the caller commits it after downloading.
+    """
+    print(f"\nSTEP 1: Scraping and Cleaning Links from {profile_url}...")
+    own_driver = driver is None
+    if own_driver:
+        driver = browser.new_driver(headless=False, window_size="1200,800")
+    try:
+        driver.get(profile_url)
+        # Waits on the page itself (new anchors / network idle) instead of fixed sleeps
+        return browser.scroll_and_collect(driver, LINK_SELECTOR, COLLECT_LINKS_JS, clean_link, MAX_SCROLLS, sync)
+    finally:
+        if own_driver:
+            driver.quit()
 
-    for i in range(SCROLL_COUNT):
-        # 🔥 Use JS to extract hrefs directly (no stale elements)
-        links = driver.execute_script("""
-            return Array.from(document.querySelectorAll("a[href*='/reel/'], a[href*='/p/']"))
-                .map(a => a.href);
-        """)
+def download_links(links, sync=None):
+    """
+    STEP 2: downloads up to DOWNLOAD_LIMIT of the scraped links. Returns the
+    success count. Links past the limit are settled on the archive.ProfileSync.
+    """
+    print(f"\nSTEP 2: Starting High-Quality Downloads...")
+    count = 0
+    store = archive.Archive()
+    try:
+        for i, link in enumerate(links):
+            if count >= DOWNLOAD_LIMIT:
+                for skipped in links[i:] if sync else []:
+                    sync.settle(skipped)
+                break
+            if run_yt_dlp(link, count + 1, store):
+                count += 1
+    finally:
+        store.close()
+    return count
 
-        for href in links:
-            if href:
-                clean_url = href.split('?')[0].rstrip('/')
-                found_links.add(clean_url)
+class DownloadBudget:
+    """ Lets worker threads share DOWNLOAD_LIMIT without overshooting it. """
 
-        print(f"   Scroll {i+1}: Found {len(found_links)} unique items")
+    def __init__(self, limit):
+        self.limit = limit
+        self.done = 0
+        self.in_flight = 0
+        self.attempts = 0
+        self.cond = threading.Condition()
+        self.full = threading.Event()
 
-        driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-        time.sleep(5)
+    def claim(self):
+        """ Waits for a free slot. Returns the file index to use, or None once the limit is reached. """
+        with self.cond:
+            while not self.full.is_set() and self.done + self.in_flight >= self.limit:
+                self.cond.wait()
+            if self.full.is_set():
+                return None
+            self.in_flight += 1
+            self.attempts += 1
+            return self.attempts
 
-    driver.quit()
-    return list(found_links)
+    def release(self, success):
+        with self.cond:
+            self.in_flight -= 1
+            if success:
+                self.done += 1
+                if self.done >= self.limit:
+                    self.full.set()
+            self.cond.notify_all()
+
+def stream_profile(profile_url):
+    """
+    Scrapes and downloads at the same time: each new reel link goes to the
+    download workers as soon as it appears, while the page keeps scrolling.
+    Scraping stops once DOWNLOAD_LIMIT downloads have succeeded.
+    Returns (links seen, successful downloads).
+    """
+    print(f"\nSTEP 1+2: Scraping {profile_url} and downloading as links appear...")
+    budget = DownloadBudget(DOWNLOAD_LIMIT)
+    seen = 0
+    store = archive.Archive()
+    sync = archive.ProfileSync(store, profile_url)
+
+    def produce(driver):
+        nonlocal seen
+        links = browser.iter_scrolled_links(driver, LINK_SELECTOR, COLLECT_LINKS_JS, clean_link, MAX_SCROLLS, sync)
+        try:
+            for link in links:
+                if budget.full.is_set():
+                    print(f"   Reached {DOWNLOAD_LIMIT} downloads. Stopping scraper.")
+                    sync.settle(link)
+                    break
+                seen += 1
+                yield link
+        finally:
+            links.close()
+
+    def download(link):
+        index = budget.claim()
+        if index is None:
+            sync.settle(link)
+            return None
+        success = run_yt_dlp(link, index, store)
+        budget.release(success)
+        return link if success else None
+
+    driver = browser.new_driver(headless=False, window_size="1200,800")
+    try:
+        driver.get(profile_url)
+        # The Selenium driver stays on this thread; only the downloads fan out
+        pipeline = Pipeline([Stage("download", download, workers=DOWNLOAD_WORKERS)])
+        pipeline.run(produce(driver))
+        # Only after the downloads ran: a crash mid-way leaves the old watermark
+        sync.commit()
+    finally:
+        driver.quit()
+        store.close()
+    pipeline.report()
+    ytdlp_engine.report_transfers()
+    formats.report()
+    return seen, budget.done
+
+def batch_main(profiles_file):
+    """ Scrapes every profile in the file through a pool of headless browsers, then downloads each. """
+    profiles = browser.read_profiles(profiles_file)
+    print(f"Batch mode: {len(profiles)} profiles, {BROWSER_POOL_SIZE} headless browsers")
+
+    store = archive.Archive()
+    syncs = {profile: archive.ProfileSync(store, profile) for profile in profiles}
+    pool = browser.BrowserPool(BROWSER_POOL_SIZE, headless=True, window_size="1200,800")
+    try:
+        results = pool.map(lambda driver, url: scrape_clean_links(url, driver, syncs[url]), profiles)
+    finally:
+        pool.close()
+
+    total = 0
+    try:
+        for profile, links in zip(profiles, results):
+            if not links:
+                print(f"[{profile}] No links found (login wall?). Skipping.")
+                continue
+            print(f"\n[{profile}] {len(links)} links")
+            total += download_links(links, syncs[profile])
+            # Only after the downloads: failed or skipped reels stay behind the watermark
+            syncs[profile].commit()
+    finally:
+        store.close()
+    ytdlp_engine.report_transfers()
+    formats.report()
+    print(f"\nFINISHED: {total} videos from {len(profiles)} profiles saved to '{OUTPUT_DIR}'")
 
 def main():
     check_setup()
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
+
+    if len(sys.argv) > 1:
+        batch_main(sys.argv[1])
+        return
     
     target = input("Enter IG Profile URL: ").strip()
-    links = scrape_clean_links(target)
+    seen, count = stream_profile(target)
     
-    if not links:
+    if not seen:
         print("No links found. Please check if your browser window shows a 'Login' wall.")
         return
 
-    print(f"\nSTEP 2: Starting High-Quality Downloads...")
-    count = 0
-    for i, link in enumerate(links):
-        if count >= DOWNLOAD_LIMIT:
-            break
-        if run_yt_dlp(link, count + 1):
-            count += 1
-
     print(f"\nFINISHED: {count} videos saved to '{OUTPUT_DIR}'")
 
 if __name__ == "__main__":
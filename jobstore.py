@@ -0,0 +1,256 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+# --- Configuration ---
+# "sqlite://<path>" (e.g. sqlite:///mnt/shared/jobs.sqlite3) or a plain path.
+# Several hosts can share one SQLite file on a network volume; set
+# JOBS_JOURNAL_MODE=DELETE there, WAL needs shared memory and only works
+# when every worker is on the same machine.
+JOBS_STORE = os.environ.get("JOBS_STORE", os.environ.get("JOBS_DB", "jobs.sqlite3"))
+JOURNAL_MODE = os.environ.get("JOBS_JOURNAL_MODE", "WAL")
+BUSY_TIMEOUT = 30      # seconds a writer waits for another process's lock
+# A claimed job is reclaimable this long after its last renewal
+LEASE_SECONDS = float(os.environ.get("JOBS_LEASE_SECONDS", "120"))
+# Lease expiry is stamped and checked with each host's own clock, so hosts
+# sharing a store must be NTP-synced; a lease only counts as expired this
+# much past its deadline, so a host whose clock runs ahead by less than
+# that can't take over a live lease.
+CLOCK_SKEW = float(os.environ.get("JOBS_CLOCK_SKEW", "30"))
+MAX_CLAIMS = 3         # leases a job may lose (worker crashed / hung) before it is failed
+# ---------------------
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+ACTIVE = (QUEUED, RUNNING)
+
+COLUMNS = ('id', 'kind', 'payload', 'key', 'status', 'result', 'error', 'attempts', 'parent',
+           'created_at', 'started_at', 'finished_at', 'lease_owner', 'lease_token', 'lease_expires')
+LEASE_COLUMNS = (('lease_owner', 'TEXT'), ('lease_token', 'TEXT'), ('lease_expires', 'REAL'))
+
+
+def worker_id():
+    """ 'host:pid', the lease owner name of this process. """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobStore:
+    """
+    Persistent FIFO job queue in SQLite, shared by any number of worker
+    threads and processes (and hosts, on a shared volume). Workers claim
+    jobs in batches under a time-limited lease and keep renewing it while
+    they work. Leases that run out (crashed or cut-off worker) are taken
+    over by the next claim. Only the holder of the current lease token can
+    complete a job, so each job is completed exactly once.
+    """
+
+    def __init__(self, path=JOBS_STORE):
+        self.path = path
+        self.lock = threading.Lock()
+        # Autocommit; writes that must be atomic open their own transaction
+        self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self.db.execute(f"PRAGMA journal_mode={JOURNAL_MODE}")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id          INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind        TEXT NOT NULL,
+                payload     TEXT NOT NULL,
+                key         TEXT,
+                status      TEXT NOT NULL,
+                result      TEXT,
+                error       TEXT,
+                attempts    INTEGER NOT NULL DEFAULT 0,
+                parent      INTEGER,
+                created_at  REAL,
+                started_at  REAL,
+                finished_at REAL
+            )
+        """)
+        existing = {row[1] for row in self.db.execute("PRAGMA table_info(jobs)")}
+        if 'lease_token' not in existing:  # queue created before leases: running jobs become reclaimable
+            for column, column_type in LEASE_COLUMNS:
+                self.db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+            self.db.execute("UPDATE jobs SET lease_expires = 0 WHERE status = ?", (RUNNING,))
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)")
+
+    def _write(self, fn):
+        """ Runs fn() inside one IMMEDIATE transaction (a single writer across all processes). """
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn()
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return result
+
+    def submit(self, kind, payload, key=None, parent=None, reuse_done=False):
+        """
+        Queues a job and returns its id. With a key (e.g. 'tiktok:<video id>')
+        a job that is still queued or running for the same key (or, with
+        reuse_done, already done) is returned instead of adding a second one.
+        """
+        statuses = ACTIVE + (DONE,) if reuse_done else ACTIVE
+
+        def insert():
+            if key is not None:
+                row = self.db.execute(
+                    f"SELECT id FROM jobs WHERE key = ? AND status IN ({', '.join('?' * len(statuses))}) "
+                    "ORDER BY id LIMIT 1", (key, *statuses)
+                ).fetchone()
+                if row:
+                    return row[0]
+            return self.db.execute(
+                "INSERT INTO jobs (kind, payload, key, status, parent, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload), key, QUEUED, parent, time.time())
+            ).lastrowid
+        return self._write(insert)
+
+    def claim(self, owner=None, limit=1, lease=LEASE_SECONDS):
+        """
+        Leases up to `limit` of the oldest queued jobs, plus jobs whose lease
+        ran out more than CLOCK_SKEW ago, to `owner`. Returns them with one shared 'lease_token'
+        (empty list if there is nothing to do). Jobs that already lost
+        MAX_CLAIMS leases are failed instead of handed out again.
+        """
+        owner = owner or worker_id()
+        token = uuid.uuid4().hex
+
+        def take():
+            now = time.time()
+            expired = now - CLOCK_SKEW
+            self.db.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ?, lease_token = NULL "
+                "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (FAILED, f"lease expired {MAX_CLAIMS} times (worker crashed or hung)", now, RUNNING, expired, MAX_CLAIMS)
+            )
+            rows = self.db.execute(
+                "SELECT id FROM jobs WHERE status = ? OR (status = ? AND lease_expires < ?) ORDER BY id LIMIT ?",
+                (QUEUED, RUNNING, expired, limit)
+            ).fetchall()
+            ids = [row[0] for row in rows]
+            self.db.executemany(
+                "UPDATE jobs SET status = ?, started_at = ?, attempts = attempts + 1, "
+                "lease_owner = ?, lease_token = ?, lease_expires = ? WHERE id = ?",
+                [(RUNNING, now, owner, token, now + lease, job_id) for job_id in ids]
+            )
+            return ids
+        return [self.get(job_id) for job_id in self._write(take)]
+
+    def renew(self, token, lease=LEASE_SECONDS):
+        """ Extends the lease of every job still held under `token`. Returns how many it still holds. """
+        with self.lock:
+            return self.db.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE lease_token = ? AND status = ?",
+                (time.time() + lease, token, RUNNING)
+            ).rowcount
+
+    def release(self, job_id, token):
+        """ Hands a claimed but unstarted job back to the queue (e.g. on shutdown). """
+        with self.lock:
+            return self.db.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts - 1, lease_owner = NULL, lease_token = NULL, "
+                "lease_expires = NULL WHERE id = ? AND lease_token = ? AND status = ?",
+                (QUEUED, job_id, token, RUNNING)
+            ).rowcount == 1
+
+    def finish(self, job_id, result=None, token=None):
+        """ Completes a job. False if `token` no longer holds its lease (someone else took it over). """
+        return self._close(job_id, DONE, json.dumps(result), None, token)
+
+    def fail(self, job_id, error, token=None):
+        return self._close(job_id, FAILED, None, (error or '')[:500], token)
+
+    def _close(self, job_id, status, result, error, token):
+        sql = ("UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, lease_token = NULL "
+               "WHERE id = ? AND status = ?")
+        args = [status, result, error, time.time(), job_id, RUNNING]
+        if token is not None:
+            sql += " AND lease_token = ?"
+            args.append(token)
+        with self.lock:
+            return self.db.execute(sql, args).rowcount == 1
+
+    def requeue_owners(self, owners):
+        """ Puts jobs leased to the given (known dead) workers straight back in the queue. Returns how many. """
+        owners = list(owners)
+        if not owners:
+            return 0
+        with self.lock:
+            return self.db.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts - 1, lease_owner = NULL, lease_token = NULL, "
+                f"lease_expires = NULL WHERE status = ? AND lease_owner IN ({', '.join('?' * len(owners))})",
+                (QUEUED, RUNNING, *owners)
+            ).rowcount
+
+    def leases(self):
+        """ {owner: [running job ids]} for every worker currently holding jobs. """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT lease_owner, id FROM jobs WHERE status = ? ORDER BY id", (RUNNING,)
+            ).fetchall()
+        held = {}
+        for owner, job_id in rows:
+            held.setdefault(owner, []).append(job_id)
+        return held
+
+    def _job(self, row):
+        job = dict(zip(COLUMNS, row))
+        job['payload'] = json.loads(job['payload'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.db.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return self._job(row) if row else None
+
+    def list(self, status=None, parent=None, limit=100):
+        """ Newest jobs first, optionally only one status or the children of one job. """
+        where, args = [], []
+        if status:
+            where.append("status = ?")
+            args.append(status)
+        if parent is not None:
+            where.append("parent = ?")
+            args.append(parent)
+        sql = f"SELECT {', '.join(COLUMNS)} FROM jobs"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        with self.lock:
+            rows = self.db.execute(sql + " ORDER BY id DESC LIMIT ?", (*args, limit)).fetchall()
+        return [self._job(row) for row in rows]
+
+    def counts(self):
+        """ {status: number of jobs}. """
+        with self.lock:
+            return dict(self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# Job store backends by URL scheme. Another backend (e.g. a database server
+# every host can reach) only needs the JobStore methods above.
+BACKENDS = {'sqlite': JobStore}
+
+
+def open_store(spec=JOBS_STORE):
+    """ Opens the job store named by 'scheme://location' (a plain path means SQLite). """
+    scheme, sep, location = spec.partition('://')
+    if not sep:
+        return JobStore(spec)
+    if scheme not in BACKENDS:
+        raise ValueError(f"no job store backend for '{scheme}' (have: {', '.join(BACKENDS)})")
+    return BACKENDS[scheme](location)
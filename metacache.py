@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import archive
+
+# --- Configuration ---
+CACHE_DIR = os.environ.get("METADATA_CACHE_DIR", ".metadata_cache")
+MAX_BYTES = 64 * 1024 * 1024  # LRU-evict beyond this much cached JSON
+# Seconds each field stays fresh. Counters move fast, descriptive fields barely move.
+FIELD_TTLS = {
+    'view_count': 3600,
+    'like_count': 3600,
+    'comment_count': 3600,
+    'entries': 3600,  # whole-profile scans are ranked by views
+    'title': 30 * 86400,
+    'description': 30 * 86400,
+    'upload_date': 365 * 86400,
+    'timestamp': 365 * 86400,
+    'duration': 365 * 86400,
+}
+DEFAULT_TTL = 86400
+EVICT_EVERY = 50  # puts between LRU size checks
+# ---------------------
+
+
+def cache_key(url):
+    """ Canonical key: 'platform:video_id' when the URL carries an ID, else the cleaned URL. """
+    platform, video_id = archive.video_key(url)
+    return f"{platform}:{video_id}"
+
+
+class MetadataCache:
+    """
+    On-disk cache of extractor JSON. Each key is stored in its own file named
+    by the key's sha256; each field remembers when it was fetched so it can
+    expire on its own TTL. File mtimes double as the LRU clock.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.puts = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def _load(self, key):
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, key, fields):
+        """
+        Returns {field: value} if every requested field is cached and fresh,
+        otherwise None (counted as a miss, or as stale if the key exists).
+        """
+        entry = self._load(key)
+        now = time.time()
+        if entry is None:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        values = {}
+        for field in fields:
+            cached = entry['fields'].get(field)
+            if cached is None or now - cached[1] > FIELD_TTLS.get(field, DEFAULT_TTL):
+                with self.lock:
+                    self.stale += 1
+                return None
+            values[field] = cached[0]
+
+        with self.lock:
+            self.hits += 1
+        try:
+            os.utime(self._path(key))  # mark as recently used
+        except OSError:
+            pass
+        return values
+
+    def put(self, key, data):
+        """ Stores/refreshes the given fields for a key. None values are skipped. """
+        now = time.time()
+        with self.lock:
+            entry = self._load(key) or {'key': key, 'fields': {}}
+            for field, value in data.items():
+                if value is not None:
+                    entry['fields'][field] = [value, now]
+            tmp = self._path(key) + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp, self._path(key))
+            self.puts += 1
+            check_size = self.puts % EVICT_EVERY == 0
+        if check_size:
+            self._evict()
+
+    def _evict(self):
+        """ Drops least-recently-used files until the cache fits in max_bytes. """
+        with self.lock:
+            files = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            for _, size, path in sorted(files):
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def report(self):
+        self._evict()
+        lookups = self.hits + self.misses + self.stale
+        rate = 100 * self.hits / lookups if lookups else 0
+        print(f"[CACHE] {self.hits} hits, {self.stale} stale, {self.misses} misses ({rate:.0f}% hit rate)")
@@ -1,9 +1,184 @@
 import subprocess
+import json
 import os
+import threading
+
+import telemetry
+import throttle
 
 # --- Configuration ---
 INPUT_DIR = "videos_to_convert"
 OUTPUT_DIR = "iphone_ready_videos"
+# Rough x264 'slow' cost (CPU-seconds per second of video) used to estimate
+# savings when this run has no transcodes of its own to measure.
+DEFAULT_TRANSCODE_CPU_PER_SECOND = 2.0
+# x264 stops scaling at a few threads on short vertical clips, so run
+# several ffmpeg jobs side by side and give each a slice of the cores.
+THREADS_PER_JOB = int(os.environ.get("FFMPEG_THREADS_PER_JOB", "4"))
+MAX_JOBS = int(os.environ.get("FFMPEG_MAX_JOBS", "0"))  # 0 = cores // THREADS_PER_JOB
+
+# What QuickTime / iPhone plays without re-encoding
+IPHONE_VIDEO_CODECS = {'h264', 'hevc'}
+IPHONE_H264_PROFILES = {'Baseline', 'Constrained Baseline', 'Main', 'High'}
+IPHONE_MAX_LEVEL = 52  # 5.2
+IPHONE_PIX_FMTS = {'yuv420p', 'yuvj420p'}
+IPHONE_AUDIO_CODECS = {'aac', 'alac', 'mp3'}
+
+def probe(input_path):
+    """ Returns (video stream, audio stream, duration) as reported by ffprobe. """
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'stream=codec_type,codec_name,profile,level,pix_fmt:format=duration',
+        '-of', 'json', input_path
+    ]
+    info = json.loads(subprocess.run(cmd, check=True, capture_output=True, text=True).stdout)
+    streams = info.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+    duration = float(info.get('format', {}).get('duration') or 0)
+    return video, audio, duration
+
+def video_compatible(video):
+    if not video or video.get('codec_name') not in IPHONE_VIDEO_CODECS:
+        return False
+    if video.get('pix_fmt') not in IPHONE_PIX_FMTS:
+        return False
+    if video.get('codec_name') == 'h264':
+        if video.get('profile') not in IPHONE_H264_PROFILES:
+            return False
+        if (video.get('level') or 0) > IPHONE_MAX_LEVEL:
+            return False
+    return True
+
+def audio_compatible(audio):
+    return audio is None or audio.get('codec_name') in IPHONE_AUDIO_CODECS
+
+def plan_conversion(input_path):
+    """
+    Decides how to convert one file. Returns (mode, ffmpeg codec args, reason, duration):
+    'remux' copies both streams, 'audio' copies video and re-encodes audio,
+    'transcode' re-encodes everything.
+    """
+    video, audio, duration = probe(input_path)
+    describe = lambda s: (
+        'none' if not s else s.get('codec_name') if s.get('codec_type') == 'audio'
+        else f"{s.get('codec_name')}/{s.get('profile')}/{s.get('pix_fmt')}/L{s.get('level')}"
+    )
+
+    if video_compatible(video):
+        video_args = ['-c:v', 'copy']
+        if video['codec_name'] == 'hevc':
+            video_args += ['-tag:v', 'hvc1']  # QuickTime only opens HEVC tagged hvc1
+        if audio_compatible(audio):
+            return 'remux', video_args + ['-c:a', 'copy'], f"video {describe(video)}, audio {describe(audio)}", duration
+        return 'audio', video_args + ['-c:a', 'aac'], f"audio {describe(audio)} not iPhone-safe", duration
+
+    # -c:v libx264 (H.264 video)
+    # -preset slow (Better quality/compression)
+    # -crf 22 (High quality balance)
+    # -c:a aac (iPhone friendly audio)
+    # -pix_fmt yuv420p (Ensures compatibility with Apple QuickTime)
+    transcode_args = ['-c:v', 'libx264', '-preset', 'slow', '-crf', '22', '-c:a', 'aac', '-pix_fmt', 'yuv420p']
+    return 'transcode', transcode_args, f"video {describe(video)} not iPhone-safe", duration
+
+def run_ffmpeg(cmd):
+    """
+    Runs ffmpeg and returns (returncode, stderr, CPU-seconds the process used).
+    The CPU time is None where os.wait4 doesn't exist (Windows).
+    """
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = []
+    reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()))
+    reader.start()
+    cpu_seconds = None
+    if hasattr(os, 'wait4'):
+        # wait4 reaps this one child and hands back its own rusage
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        cpu_seconds = usage.ru_utime + usage.ru_stime
+    else:
+        process.wait()
+    reader.join()
+    return process.returncode, b''.join(stderr).decode(errors='replace'), cpu_seconds
+
+def output_path_for(filename):
+    # Create output name by swapping extension
+    return os.path.join(OUTPUT_DIR, os.path.splitext(filename)[0] + ".mov")
+
+def is_up_to_date(filename):
+    """ True if the MOV already exists and is newer than its source MP4. """
+    output_path = output_path_for(filename)
+    return (os.path.exists(output_path)
+            and os.path.getmtime(output_path) >= os.path.getmtime(os.path.join(INPUT_DIR, filename)))
+
+def plan_jobs(job_count):
+    """ Returns (parallel jobs, ffmpeg threads per job) for this machine. """
+    cores = os.cpu_count() or 1
+    jobs = MAX_JOBS or max(1, cores // THREADS_PER_JOB)
+    jobs = max(1, min(jobs, job_count))
+    return jobs, max(1, cores // jobs)
+
+def convert_file(filename, threads=0):
+    """ Converts one file. Returns its decision record for the summary. """
+    input_path = os.path.join(INPUT_DIR, filename)
+    output_path = output_path_for(filename)
+    output_filename = os.path.basename(output_path)
+
+    try:
+        mode, codec_args, reason, duration = plan_conversion(input_path)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        print(f"Error probing {filename}: {getattr(e, 'stderr', e)}")
+        return None
+    print(f"Converting: {filename} -> {output_filename} [{mode}: {reason}]")
+
+    # Written under a temp name in the same directory and renamed only on
+    # success, so a failed or interrupted run never leaves a "newer" MOV behind
+    partial_path = os.path.splitext(output_path)[0] + ".partial.mov"
+    cmd = ['ffmpeg', '-i', input_path] + codec_args + [
+        '-threads', str(threads),
+        '-movflags', '+faststart',
+        partial_path,
+        '-y' # Overwrite if exists
+    ]
+    try:
+        with telemetry.span('convert', mode=mode, file=filename, bytes=os.path.getsize(input_path)) as span:
+            returncode, stderr, cpu_seconds = run_ffmpeg(cmd)
+            span.set(outcome='success' if returncode == 0 else 'failed')
+            if cpu_seconds is not None:
+                span.set(cpu_seconds=round(cpu_seconds, 3))
+        if returncode == 0:
+            os.replace(partial_path, output_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    if returncode != 0:
+        print(f"Error converting {filename}: {stderr}")
+    else:
+        print(f"Successfully converted {filename}")
+    return {'file': filename, 'mode': mode, 'reason': reason, 'duration': duration,
+            'cpu': cpu_seconds, 'ok': returncode == 0}
+
+def print_summary(decisions):
+    """ Prints the per-file decisions and an estimate of CPU time saved by not transcoding. """
+    print("\n--- Conversion decisions ---")
+    for d in decisions:
+        status = 'ok' if d['ok'] else 'FAILED'
+        cpu = f"{d['cpu']:7.1f}" if d['cpu'] is not None else "    n/a"
+        print(f"   {d['mode']:<9} {cpu} cpu-s  {d['duration']:7.1f}s  {status:<6} {d['file']}  ({d['reason']})")
+
+    transcoded = [d for d in decisions
+                  if d['mode'] == 'transcode' and d['ok'] and d['duration'] and d['cpu'] is not None]
+    if transcoded:
+        cpu_per_second = sum(d['cpu'] for d in transcoded) / sum(d['duration'] for d in transcoded)
+        basis = "measured this run"
+    else:
+        cpu_per_second = DEFAULT_TRANSCODE_CPU_PER_SECOND
+        basis = "default estimate"
+
+    skipped = [d for d in decisions if d['mode'] != 'transcode' and d['ok']]
+    saved = sum(d['duration'] * cpu_per_second - (d['cpu'] or 0) for d in skipped)
+    print(f"\n{len(skipped)}/{len(decisions)} files avoided a full transcode, "
+          f"saving ~{max(saved, 0):.1f} CPU-seconds ({cpu_per_second:.2f} cpu-s per video second, {basis}).")
 
 def convert_to_iphone_mov():
     # Create output directory if it doesn't exist
@@ -17,38 +192,21 @@ def convert_to_iphone_mov():
         print(f"No MP4 files found in {INPUT_DIR}")
         return
 
-    print(f"Found {len(files)} videos. Starting conversion...")
-
-    for filename in files:
-        input_path = os.path.join(INPUT_DIR, filename)
-        # Create output name by swapping extension
-        output_filename = os.path.splitext(filename)[0] + ".mov"
-        output_path = os.path.join(OUTPUT_DIR, output_filename)
-
-        print(f"Converting: {filename} -> {output_filename}")
-
-        # FFmpeg command:
-        # -c:v libx264 (H.264 video)
-        # -preset slow (Better quality/compression)
-        # -crf 22 (High quality balance)
-        # -c:a aac (iPhone friendly audio)
-        # -pix_fmt yuv420p (Ensures compatibility with Apple QuickTime)
-        cmd = [
-            'ffmpeg', '-i', input_path,
-            '-c:v', 'libx264',
-            '-preset', 'slow',
-            '-crf', '22',
-            '-c:a', 'aac',
-            '-pix_fmt', 'yuv420p',
-            output_path,
-            '-y' # Overwrite if exists
-        ]
-
-        try:
-            subprocess.run(cmd, check=True, capture_output=True)
-            print(f"Successfully converted {filename}")
-        except subprocess.CalledProcessError as e:
-            print(f"Error converting {filename}: {e.stderr.decode()}")
+    fresh = [f for f in files if is_up_to_date(f)]
+    files = [f for f in files if f not in fresh]
+    if fresh:
+        print(f"Skipping {len(fresh)} videos whose MOV is newer than the source.")
+    if not files:
+        print("Everything is already converted.")
+        return
+
+    # Largest first, so the last job to finish is a short one
+    files.sort(key=lambda f: os.path.getsize(os.path.join(INPUT_DIR, f)), reverse=True)
+    jobs, threads = plan_jobs(len(files))
+    print(f"Found {len(files)} videos. Starting conversion ({jobs} parallel jobs x {threads} threads)...")
+
+    results = throttle.run_pool(files, lambda i, f: convert_file(f, threads), jobs)
+    print_summary([d for d in results if d])
 
 if __name__ == "__main__":
     # Ensure the input folder exists for the user to put files in
@@ -56,4 +214,4 @@ if __name__ == "__main__":
         os.makedirs(INPUT_DIR)
         print(f"Created '{INPUT_DIR}' folder. Put your MP4s there and run again.")
     else:
-        convert_to_iphone_mov()
\ No newline at end of file
+        convert_to_iphone_mov()
@@ -0,0 +1,113 @@
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of a Pipeline. fn(item) returns the item to hand to the next
+    stage, or None to drop it (failed / skipped).
+    """
+
+    def __init__(self, name, fn, workers=1, queue_size=None):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        # Bounded input queue: a full queue blocks the previous stage, which
+        # is what keeps e.g. temp downloads from piling up ahead of ffmpeg.
+        self.queue = queue.Queue(maxsize=queue_size if queue_size is not None else self.workers * 2)
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.dropped = 0
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0  # time spent waiting for room downstream
+        self.max_depth = 0
+        self.depth_samples = 0
+        self.depth_total = 0
+
+    def put(self, item):
+        self.queue.put(item)
+        depth = self.queue.qsize()
+        with self.lock:
+            self.max_depth = max(self.max_depth, depth)
+            self.depth_samples += 1
+            self.depth_total += depth
+
+    def record(self, seconds, kept):
+        with self.lock:
+            self.processed += 1
+            self.busy_seconds += seconds
+            if not kept:
+                self.dropped += 1
+
+
+class Pipeline:
+    """ Runs items through a chain of Stages, each with its own worker threads. """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.results = []
+        self.results_lock = threading.Lock()
+
+    def _worker(self, index):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            item = stage.queue.get()
+            if item is _DONE:
+                return
+            started = time.monotonic()
+            try:
+                out = stage.fn(item)
+            except Exception as e:
+                print(f"   [ERROR] {stage.name} stage crashed: {e}")
+                out = None
+            stage.record(time.monotonic() - started, out is not None)
+            if out is None:
+                continue
+            if next_stage is None:
+                with self.results_lock:
+                    self.results.append(out)
+            else:
+                waited = time.monotonic()
+                next_stage.put(out)
+                with stage.lock:
+                    stage.blocked_seconds += time.monotonic() - waited
+
+    def run(self, items):
+        """ Feeds items into the first stage and blocks until every stage drains. Returns the final outputs. """
+        started = time.monotonic()
+        threads = []
+        for index, stage in enumerate(self.stages):
+            workers = [threading.Thread(target=self._worker, args=(index,), daemon=True)
+                       for _ in range(stage.workers)]
+            for t in workers:
+                t.start()
+            threads.append(workers)
+
+        for item in items:
+            self.stages[0].put(item)
+
+        # Shut stages down in order so every item upstream has been handed on
+        for stage, workers in zip(self.stages, threads):
+            for _ in workers:
+                stage.queue.put(_DONE)
+            for t in workers:
+                t.join()
+
+        self.elapsed = time.monotonic() - started
+        return self.results
+
+    def report(self):
+        """ Prints per-stage throughput, timing and queue depth. """
+        print(f"\n--- Pipeline report ({self.elapsed:.1f}s wall) ---")
+        for stage in self.stages:
+            avg_depth = stage.depth_total / stage.depth_samples if stage.depth_samples else 0
+            avg_time = stage.busy_seconds / stage.processed if stage.processed else 0
+            print(
+                f"   {stage.name:<10} workers={stage.workers} done={stage.processed - stage.dropped}/{stage.processed} "
+                f"busy={stage.busy_seconds:.1f}s avg={avg_time:.2f}s blocked={stage.blocked_seconds:.1f}s "
+                f"queue max={stage.max_depth} avg={avg_depth:.1f}"
+            )
@@ -0,0 +1,290 @@
+import http.cookiejar
+import json
+import os
+import queue
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import telemetry
+import throttle
+import ytdlp_engine
+
+# --- Configuration ---
+MIN_SEGMENTED_BYTES = 50 * 1024 * 1024  # smaller videos aren't worth the extra connections
+PIECE_SIZE = 8 * 1024 * 1024            # unit of work and of resume bookkeeping
+INITIAL_SEGMENTS = 2                    # parallel range requests to start with
+MAX_SEGMENTS = 8
+ADAPT_INTERVAL = 3.0   # seconds of throughput measured before deciding to add a connection
+ADAPT_GAIN = 1.1       # keep adding connections while each one raises throughput by 10%+
+# yt-dlp's own concurrency for DASH/HLS fragments (-N); fragment state is kept by --continue
+FRAGMENT_CONCURRENCY = int(os.environ.get("FRAGMENT_CONCURRENCY", "4"))
+READ_SIZE = 256 * 1024
+REQUEST_TIMEOUT = 30
+PIECE_RETRIES = 3
+STATE_SAVE_INTERVAL = 1.0
+# ---------------------
+
+PROGRESSIVE_PROTOCOLS = ('http', 'https')
+
+
+def resolve(url, format_spec, output_template, extra_args=()):
+    """
+    Asks yt-dlp for the formats it would download (without downloading).
+    Returns the info dict: 'requested_formats' (video + audio) or the single
+    format's own url/protocol, plus the final 'filename' for output_template.
+    """
+    cmd = [url, '-j', '--no-playlist', '-f', format_spec, '-o', output_template,
+           '--merge-output-format', 'mp4', *extra_args]
+    result, outcome = throttle.run_with_retries(url, lambda: ytdlp_engine.run(cmd, encoding='utf-8'))
+    if result.returncode != 0:
+        raise Exception(f"yt-dlp could not resolve formats ({outcome}): {result.stderr.strip()[:200]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def plan(info):
+    """
+    Returns the formats to fetch in segments, or None when yt-dlp should do
+    the download itself (fragmented DASH/HLS, unknown or small size).
+    """
+    formats = info.get('requested_formats') or [info]
+    if any(f.get('protocol') not in PROGRESSIVE_PROTOCOLS or not f.get('url') for f in formats):
+        return None
+    size = sum(f.get('filesize') or f.get('filesize_approx') or 0 for f in formats)
+    return formats if size >= MIN_SEGMENTED_BYTES else None
+
+
+def cookie_opener(cookie_file=None):
+    """ URL opener carrying the cookies.txt jar yt-dlp gets with --cookies (none if the file is missing). """
+    jar = http.cookiejar.MozillaCookieJar()
+    if cookie_file and os.path.exists(cookie_file):
+        jar.load(cookie_file, ignore_discard=True, ignore_expires=True)
+        for cookie in jar:
+            if cookie.expires == 0:  # session cookie in yt-dlp's cookies.txt, not an expired one
+                cookie.expires, cookie.discard = None, True
+    return urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+
+
+def _request(fmt, start, end=None, opener=None):
+    headers = dict(fmt.get('http_headers') or {})
+    headers['Range'] = f"bytes={start}-{'' if end is None else end}"
+    request = urllib.request.Request(fmt['url'], headers=headers)
+    return (opener or urllib.request.build_opener()).open(request, timeout=REQUEST_TIMEOUT)
+
+
+def remote_size(fmt, opener=None):
+    """ Total size if the server honours byte ranges, else None. """
+    with _request(fmt, 0, 0, opener) as response:
+        content_range = response.headers.get('Content-Range', '')
+        if response.status != 206 or '/' not in content_range:
+            return None
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+
+
+class SegmentedDownload:
+    """
+    Downloads one progressive format as PIECE_SIZE byte ranges over several
+    connections into a preallocated .part file. Bytes completed per piece are
+    persisted to a .segdl.json file next to it, so an interrupted run picks
+    up where it stopped. Connections are added one at a time while each
+    addition still raises throughput by ADAPT_GAIN.
+    """
+
+    def __init__(self, fmt, path, size, label="", opener=None):
+        self.fmt = fmt
+        self.opener = opener
+        self.path = path
+        self.size = size
+        self.label = label or os.path.basename(path)
+        self.part_path = path + '.segdl.part'  # not yt-dlp's .part, which it would try to continue
+        self.state_path = path + '.segdl.json'
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()  # the workers share one file object (seek + write)
+        self.pieces = [(start, min(start + PIECE_SIZE, size) - 1) for start in range(0, size, PIECE_SIZE)]
+        self.done = self._load_state()
+        self.pending = queue.Queue()
+        for index, (start, end) in enumerate(self.pieces):
+            if self.done.get(index, 0) < end - start + 1:
+                self.pending.put(index)
+        self.failures = {}
+        self.error = None
+        self.received = 0  # bytes fetched by this run (not counting resumed ones)
+
+    def _load_state(self):
+        """ Resumes only if the saved state is for the same format and size, and the .part file is still there. """
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if (state['format_id'] == self.fmt.get('format_id') and state['size'] == self.size
+                    and os.path.getsize(self.part_path) == self.size):
+                return {int(k): v for k, v in state['done'].items()}
+        except (OSError, ValueError, KeyError):
+            pass
+        with open(self.part_path, 'wb') as f:
+            f.truncate(self.size)  # sparse; each piece is written at its own offset
+        return {}
+
+    def _save_state(self):
+        with self.lock:
+            state = {'format_id': self.fmt.get('format_id'), 'size': self.size, 'done': dict(self.done)}
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+
+    def _fetch_piece(self, part, index):
+        start, end = self.pieces[index]
+        offset = start + self.done.get(index, 0)
+        with _request(self.fmt, offset, end, self.opener) as response:
+            if response.status != 206:
+                raise urllib.error.HTTPError(self.fmt['url'], response.status, "range ignored", response.headers, None)
+            while offset <= end:
+                chunk = response.read(min(READ_SIZE, end - offset + 1))
+                if not chunk:
+                    raise urllib.error.URLError(f"connection closed at byte {offset}")
+                with self.write_lock:
+                    part.seek(offset)
+                    part.write(chunk)
+                    part.flush()  # written out before self.done (and the saved state) counts it
+                offset += len(chunk)
+                with self.lock:
+                    self.done[index] = offset - start
+                    self.received += len(chunk)
+
+    def _worker(self, part):
+        while self.error is None:
+            try:
+                index = self.pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self._fetch_piece(part, index)
+            except (OSError, urllib.error.URLError) as e:
+                with self.lock:
+                    self.failures[index] = self.failures.get(index, 0) + 1
+                    if self.failures[index] >= PIECE_RETRIES:
+                        self.error = f"piece {index} failed {PIECE_RETRIES} times: {e}"
+                        return
+                self.pending.put(index)
+
+    def run(self):
+        """ Returns True once every piece is on disk and the file is renamed into place. """
+        resumed = sum(self.done.values())
+        if resumed:
+            print(f"   [SEGMENTS] {self.label}: resuming at {resumed / 1e6:.1f}/{self.size / 1e6:.1f} MB")
+        part = open(self.part_path, 'r+b')
+        threads = []
+        try:
+            def add_worker():
+                t = threading.Thread(target=self._worker, args=(part,), daemon=True)
+                t.start()
+                threads.append(t)
+
+            for _ in range(min(INITIAL_SEGMENTS, self.pending.qsize())):
+                add_worker()
+
+            growing, best_rate = True, 0.0
+            last_bytes, last_check, last_save = 0, time.monotonic(), time.monotonic()
+            while any(t.is_alive() for t in threads):
+                time.sleep(0.2)
+                now = time.monotonic()
+                if now - last_save >= STATE_SAVE_INTERVAL:
+                    self._save_state()
+                    last_save = now
+                if now - last_check < ADAPT_INTERVAL:
+                    continue
+                rate = (self.received - last_bytes) / (now - last_check)
+                last_bytes, last_check = self.received, now
+                active = sum(t.is_alive() for t in threads)
+                if growing and rate > best_rate * ADAPT_GAIN and active < MAX_SEGMENTS and not self.pending.empty():
+                    best_rate = rate
+                    add_worker()
+                    print(f"   [SEGMENTS] {self.label}: {rate / 1e6:.2f} MB/s, now {active + 1} connections")
+                else:
+                    growing = False  # the last connection didn't pay off: keep the current count
+        finally:
+            part.close()
+            self._save_state()
+
+        if self.error or sum(self.done.values()) < self.size:
+            print(f"   [SEGMENTS] {self.label}: stopped, progress saved ({self.error or 'incomplete'})")
+            return False
+        os.replace(self.part_path, self.path)
+        os.remove(self.state_path)
+        return True
+
+
+def merge(paths, output):
+    """
+    Stream-copies separate video/audio files into one container: `output`
+    if its format takes the streams, else an MKV next to it (like yt-dlp's
+    --merge-output-format mp4/mkv). Only if neither copy works are the
+    streams re-encoded to H.264/AAC in `output`. Returns the merged path, or None.
+    """
+    cmd = ['ffmpeg', '-v', 'error']
+    for path in paths:
+        cmd += ['-i', path]
+    for i in range(len(paths)):
+        cmd += ['-map', f'{i}:0']
+    for target in (output, os.path.splitext(output)[0] + '.mkv'):
+        if subprocess.run(cmd + ['-c', 'copy', target, '-y'], capture_output=True, text=True).returncode == 0:
+            return target
+    print(f"   [SEGMENTS] stream copy failed, re-encoding into {os.path.basename(output)}")
+    if subprocess.run(cmd + ['-c:v', 'libx264', '-c:a', 'aac', output, '-y'], capture_output=True, text=True).returncode == 0:
+        return output
+    return None
+
+
+def download(url, format_spec, output_template, extra_args=(), label="", cookie_file=None):
+    """
+    Segmented download of a large progressive video. Returns the output
+    path (an .mkv if the streams don't fit the requested container), False
+    if it failed (partial state is kept for the next run), or None when the
+    video isn't a candidate and yt-dlp should download it (use
+    FRAGMENT_CONCURRENCY with -N for DASH/HLS). Range requests carry the
+    cookie_file jar, like yt-dlp's --cookies.
+    """
+    info = resolve(url, format_spec, output_template, extra_args)
+    formats = plan(info)
+    if not formats:
+        return None
+    output = info.get('filename') or info.get('_filename')
+    if not output:
+        # The in-process engine doesn't fill in the output name; leave the file to yt-dlp
+        print(f"   [SEGMENTS] {label}: yt-dlp reported no output filename, downloading normally")
+        return None
+    opener = cookie_opener(cookie_file)
+    base = os.path.splitext(output)[0]
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+
+    started = time.time()
+    paths, total = [], 0
+    for fmt in formats:
+        size = remote_size(fmt, opener)
+        if size is None:
+            return None  # no range support: let yt-dlp stream it
+        path = output if len(formats) == 1 else f"{base}.f{fmt.get('format_id')}.{fmt.get('ext')}"
+        if os.path.exists(path):  # finished by an earlier run that stopped before merging
+            paths.append(path)
+            total += size
+            continue
+        segment = SegmentedDownload(fmt, path, size, label=f"{label} f{fmt.get('format_id')}".strip(), opener=opener)
+        if not segment.run():
+            telemetry.record('transfer', started, time.time(), url, bytes=total, outcome='failed', mode='segmented')
+            return False
+        paths.append(path)
+        total += size
+    telemetry.record('transfer', started, time.time(), url, bytes=total, mode='segmented')
+
+    if len(paths) > 1:
+        merged = merge(paths, output)
+        if not merged:
+            print(f"   [SEGMENTS] {label}: merge failed, parts kept for the next run")
+            return False
+        for path in paths:
+            os.remove(path)
+        return merged
+    return output
@@ -0,0 +1,418 @@
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import app
+import app_date
+import archive
+import formats
+import insta_filter
+import jobstore
+import mov
+import throttle
+import ytdlp_engine
+
+# --- Configuration ---
+SERVICE_HOST = os.environ.get("SERVICE_HOST", "127.0.0.1")  # local only: the API has no auth
+SERVICE_PORT = int(os.environ.get("SERVICE_PORT", "8787"))
+WORKERS = throttle.CONCURRENCY  # jobs running at once (per-host pacing still applies)
+IDLE_POLL = 1.0         # seconds between queue checks while idle; submits wake a worker at once
+BROWSER_POOL_SIZE = 2   # headless browsers kept open for Instagram/Facebook scrape jobs
+TRANSCODE_WORKERS = 1   # background transcodes for Facebook downloads (see ig.py)
+TRANSFER_HISTORY = 1000 # download records kept in memory (ytdlp_engine.transfers)
+CLAIM_BATCH = 1         # jobs leased per claim; shard.py workers take bigger batches
+# ---------------------
+
+JOB_KINDS = ('download', 'scrape', 'convert')
+PLATFORMS = ('tiktok', 'instagram', 'facebook')  # what run_download / run_scrape can route
+JOB_STATUSES = (jobstore.QUEUED, jobstore.RUNNING, jobstore.DONE, jobstore.FAILED)
+MAX_LIST_LIMIT = 1000   # most jobs one GET /jobs returns
+
+
+class Service:
+    """
+    Keeps everything a one-shot run pays for at startup alive between jobs:
+    imported runners, the archive connection, yt-dlp sessions and throttle
+    state, and (once a scrape needs them) the browsers. Workers lease jobs
+    from the persistent queue in jobstore.py, which other services or
+    shard.py nodes may share; the leases are renewed while jobs run.
+    """
+
+    def __init__(self, workers=WORKERS, batch=CLAIM_BATCH):
+        self.workers = max(1, workers)
+        self.batch = max(1, batch)
+        self.jobs = jobstore.open_store()
+        self.owner = jobstore.worker_id()
+        self.claimed = queue.Queue()  # leased to us, not started yet
+        self.claim_lock = threading.Lock()
+        self.held = {}  # job id -> lease token, for every job leased to us
+        self.held_lock = threading.Lock()
+        self.store = archive.Archive()
+        self.browsers = {}  # platform -> browser.BrowserPool, started on first use
+        self.browsers_lock = threading.Lock()
+        self.transcodes = ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS)
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.threads = []
+        self.busy = 0
+        self.busy_lock = threading.Lock()
+        self.started = time.time()
+        self.handlers = {'download': self.run_download, 'scrape': self.run_scrape, 'convert': self.run_convert}
+
+    # --- Submitting ---
+
+    def submit(self, kind, payload, parent=None):
+        """ Validates and queues one job. Returns its id (an existing one for a video already queued). """
+        payload, key = self._prepare(kind, payload)
+        job_id = self.jobs.submit(kind, payload, key=key, parent=parent)
+        self.wake.set()
+        return job_id
+
+    def _prepare(self, kind, payload):
+        """ Checks one job's payload. Returns (normalised payload, dedupe key); ValueError if it can't run. """
+        if kind not in JOB_KINDS:
+            raise ValueError(f"unknown job kind '{kind}' (expected one of {', '.join(JOB_KINDS)})")
+        key = None
+        if kind == 'convert':
+            if not payload.get('file'):
+                raise ValueError("convert jobs need a 'file' in the mov.py input folder")
+            payload = {'file': os.path.basename(payload['file'])}
+        else:
+            url = payload.get('url')
+            if not isinstance(url, str) or not url.strip():
+                raise ValueError(f"{kind} jobs need a 'url'")
+            payload = dict(payload, url=archive.canonical_url(url.strip()))
+            platform = archive.platform_of(payload['url'])
+            if platform not in PLATFORMS:
+                raise ValueError(f"unsupported URL '{url}' (expected a {', '.join(PLATFORMS)} link)")
+            if kind == 'download':
+                key = ':'.join(archive.video_key(payload['url']))
+        return payload, key
+
+    def _next_job(self):
+        """ The next leased job, claiming a new batch when ours is used up. None if the queue is empty. """
+        with self.claim_lock:
+            if self.claimed.empty():
+                for job in self.jobs.claim(self.owner, self.batch):
+                    with self.held_lock:
+                        self.held[job['id']] = job['lease_token']
+                    self.claimed.put(job)
+            try:
+                return self.claimed.get_nowait()
+            except queue.Empty:
+                return None
+
+    def _renew_leases(self):
+        while not self.stopping.wait(jobstore.LEASE_SECONDS / 3):
+            with self.held_lock:
+                tokens = set(self.held.values())
+            for token in tokens:
+                self.jobs.renew(token)
+
+    def _complete(self, job, result=None, error=None):
+        """ Records the outcome under our lease. Returns False if the lease was lost and the record dropped. """
+        token = job['lease_token']
+        if error is None:
+            recorded = self.jobs.finish(job['id'], result, token)
+        else:
+            recorded = self.jobs.fail(job['id'], error, token)
+        with self.held_lock:
+            self.held.pop(job['id'], None)
+        if not recorded:
+            print(f"[LEASE] Job {job['id']} was taken over by another worker; this result is not recorded")
+        return recorded
+
+    # --- Job handlers: each returns the job's result dict or raises ---
+
+    def run_download(self, job):
+        url, index = job['payload']['url'], job['id']
+        platform, video_id = archive.video_key(url)
+        if platform == 'tiktok':
+            if self.store.is_done(platform, video_id):
+                return {'path': self.store.get(platform, video_id)['output_path'], 'skipped': True}
+            out = app.download_link({'index': index, 'link': url, 'total': '-', 'store': self.store})
+            if out and out.get('remux'):
+                out = app.remux_to_mov(out)
+            if not out:
+                raise Exception("TikTok download failed")
+            return {'path': out['final_mov']}
+        if platform == 'instagram':
+            os.makedirs(insta_filter.OUTPUT_DIR, exist_ok=True)
+            if not insta_filter.run_yt_dlp(url, index, self.store):
+                raise Exception("Instagram download failed")
+            entry = self.store.get(platform, video_id)
+            return {'path': entry and entry['output_path']}
+        if platform == 'facebook':
+            import ig  # needs selenium installed, so only loaded for Facebook jobs
+            os.makedirs(ig.OUTPUT_DIR, exist_ok=True)
+            path = ig.download_video(url, ig.OUTPUT_DIR, str(index))
+            if not path:
+                raise Exception("Facebook download failed")
+            pending = []
+            ig.finish_as_mp4(path, self.transcodes, pending)
+            for future in pending:
+                future.result()
+            mp4 = os.path.splitext(path)[0] + '.mp4'
+            return {'path': mp4 if os.path.exists(mp4) else path}
+        raise ValueError(f"no downloader for {platform} URLs")
+
+    def browser_pool(self, platform, **driver_kwargs):
+        import browser
+        with self.browsers_lock:
+            if platform not in self.browsers:
+                self.browsers[platform] = browser.BrowserPool(BROWSER_POOL_SIZE, headless=True, **driver_kwargs)
+            return self.browsers[platform]
+
+    def run_scrape(self, job):
+        """
+        Scrapes a profile and queues a download job per new video (children of
+        this job). Facebook pages run ig.py's own view filter + download steps.
+        """
+        url = job['payload']['url']
+        platform = archive.platform_of(url)
+        # Download jobs run after this one, so the watermark committed here only
+        # moves past videos already in the archive; the next scrape of the
+        # profile catches up once the queued ones are done
+        if platform == 'tiktok':
+            sync = archive.ProfileSync(self.store, url)
+            links = [entry['url'] for entry in app_date.filter_and_sort(app_date.get_metadata(url, sync))]
+        elif platform == 'instagram':
+            import instagram
+            sync = archive.ProfileSync(self.store, url)
+            with self.browser_pool(platform, window_size="1200,800").driver() as driver:
+                links = instagram.scrape_clean_links(url, driver, sync)
+            for skipped in links[instagram.DOWNLOAD_LIMIT:]:
+                sync.settle(skipped)
+            links = links[:instagram.DOWNLOAD_LIMIT]
+        elif platform == 'facebook':
+            import ig
+            page = ig.normalize_page_url(url)
+            sync = archive.ProfileSync(self.store, page)
+            pool = self.browser_pool(platform, window_size="1920,1080", capabilities=ig.driver_capabilities())
+            with pool.driver() as driver:
+                urls, records = ig.scrape_video_urls_with_selenium(page, driver, sync)
+            ig.process_page(urls, records, ig.page_output_dir(url), sync)
+            sync.commit()
+            return {'found': len(urls)}
+        else:
+            raise ValueError(f"no scraper for {platform} profiles")
+        jobs = [self.submit('download', {'url': link}, parent=job['id']) for link in links]
+        sync.commit()
+        return {'found': len(links), 'jobs': jobs}
+
+    def run_convert(self, job):
+        decision = mov.convert_file(job['payload']['file'])
+        if not decision or not decision['ok']:
+            raise Exception(f"conversion of {job['payload']['file']} failed")
+        return {'path': mov.output_path_for(decision['file']), 'mode': decision['mode']}
+
+    # --- Workers ---
+
+    def _worker(self):
+        while not self.stopping.is_set():
+            job = self._next_job()
+            if job is None:
+                self.wake.wait(IDLE_POLL)
+                self.wake.clear()
+                continue
+            with self.busy_lock:
+                self.busy += 1
+            print(f"[JOB {job['id']}] {job['kind']} started: {job['payload']}")
+            started = time.monotonic()
+            try:
+                result = self.handlers[job['kind']](job)
+            except Exception as e:
+                if self._complete(job, error=str(e)):
+                    print(f"[JOB {job['id']}] FAILED after {time.monotonic() - started:.1f}s: {e}")
+            else:
+                if self._complete(job, result):
+                    print(f"[JOB {job['id']}] DONE in {time.monotonic() - started:.1f}s: {result}")
+            finally:
+                with self.busy_lock:
+                    self.busy -= 1
+                ytdlp_engine.trim_transfers(TRANSFER_HISTORY)
+                formats.trim_selections(TRANSFER_HISTORY)
+
+    def _dead_local_owners(self):
+        """ Lease owners on this host whose process is gone (no need to wait for their leases to run out). """
+        host = self.owner.rsplit(':', 1)[0]
+        dead = []
+        for owner in self.jobs.leases():
+            owner_host, _, pid = (owner or '').rpartition(':')
+            if owner_host != host or not pid.isdigit() or owner == self.owner:
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                dead.append(owner)
+            except PermissionError:
+                pass  # alive, run by another user
+        return dead
+
+    def start(self):
+        requeued = self.jobs.requeue_owners(self._dead_local_owners())
+        if requeued:
+            print(f"[INFO] Re-queued {requeued} jobs left by a worker on this host that is no longer running")
+        for _ in range(self.workers):
+            t = threading.Thread(target=self._worker, daemon=True)
+            t.start()
+            self.threads.append(t)
+        threading.Thread(target=self._renew_leases, daemon=True).start()
+
+    def stop(self):
+        """ Lets running jobs finish, then releases browsers and connections. """
+        self.stopping.set()
+        self.wake.set()
+        if self.busy:
+            print(f"[INFO] Waiting for {self.busy} running jobs to finish...")
+        for t in self.threads:
+            t.join()
+        # Leased but never started: hand back now instead of letting the leases run out
+        while not self.claimed.empty():
+            job = self.claimed.get_nowait()
+            self.jobs.release(job['id'], job['lease_token'])
+        self.transcodes.shutdown()
+        for pool in self.browsers.values():
+            pool.close()
+        self.store.close()
+        self.jobs.close()
+
+    def status(self):
+        return {
+            'jobs': self.jobs.counts(),
+            'workers': self.workers,
+            'busy': self.busy,
+            'leases': self.jobs.leases(),
+            'uptime_seconds': round(time.time() - self.started, 1),
+        }
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        """
+        POST /jobs        {"kind": "download", "url": ...} or {"kind": ..., "urls": [...]}
+        GET  /jobs        ?status=failed&parent=<id>&limit=N
+        GET  /jobs/<id>
+        GET  /status
+        """
+
+        def _send(self, code, body):
+            data = json.dumps(body, default=str).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            path, query = parsed.path.rstrip('/'), parse_qs(parsed.query)
+            if path == "/status":
+                self._send(200, service.status())
+            elif path == "/jobs":
+                parent = query.get('parent', [None])[0]
+                status = query.get('status', [None])[0]
+                try:
+                    parent = int(parent) if parent else None
+                    limit = min(max(int(query.get('limit', ['100'])[0]), 1), MAX_LIST_LIMIT)
+                    if status is not None and status not in JOB_STATUSES:
+                        raise ValueError(f"unknown status '{status}' (expected one of {', '.join(JOB_STATUSES)})")
+                except ValueError as e:
+                    self._send(400, {'error': str(e)})
+                    return
+                self._send(200, service.jobs.list(status=status, parent=parent, limit=limit))
+            elif path.startswith("/jobs/") and path[len("/jobs/"):].isdigit():
+                job = service.jobs.get(int(path[len("/jobs/"):]))
+                self._send(200, job) if job else self._send(404, {'error': 'no such job'})
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if urlparse(self.path).path.rstrip('/') != "/jobs":
+                self._send(404, {'error': 'not found'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+                kind = body.pop('kind', 'download')
+                urls = body.pop('urls', None)
+                if urls is not None and not (isinstance(urls, list) and urls
+                                             and all(isinstance(url, str) and url.strip() for url in urls)):
+                    raise ValueError("'urls' must be a list of non-empty URL strings")
+                payloads = [dict(body, url=url) for url in urls] if urls is not None else [body]
+                # Check the whole batch first so a bad entry doesn't leave half of it queued
+                for payload in payloads:
+                    service._prepare(kind, payload)
+                ids = [service.submit(kind, payload) for payload in payloads]
+            except (ValueError, TypeError, AttributeError) as e:
+                self._send(400, {'error': str(e)})
+                return
+            self._send(202, {'jobs': ids})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(workers=WORKERS):
+    """ Runs the daemon until SIGINT/SIGTERM. """
+    service = Service(workers)
+    server = ThreadingHTTPServer((SERVICE_HOST, SERVICE_PORT), make_handler(service))
+    server.daemon_threads = True
+    # serve_forever() has to be stopped from another thread
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    service.start()
+    print(f"[INFO] Download service on http://{SERVICE_HOST}:{SERVICE_PORT} "
+          f"({service.workers} workers, queue in {service.jobs.path})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print("[INFO] Shutting down...")
+    server.server_close()
+    service.stop()
+
+
+def call(method, path, body=None):
+    """ Talks to a running service. Returns the decoded JSON reply. """
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(f"http://{SERVICE_HOST}:{SERVICE_PORT}{path}", data=data, method=method,
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return json.loads(e.read() or b'{}')
+
+
+USAGE = """Usage:
+    python service.py [workers]              run the service
+    python service.py submit <url> [...]     queue downloads
+    python service.py scrape <profile url>   queue a profile scrape (downloads follow as child jobs)
+    python service.py convert <file>         queue a MOV conversion of a file in mov.py's input folder
+    python service.py status [job id]        service or job status"""
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if not args or args[0].isdigit():
+        serve(int(args[0]) if args else WORKERS)
+    elif args[0] == 'submit' and len(args) > 1:
+        print(json.dumps(call("POST", "/jobs", {'kind': 'download', 'urls': args[1:]}), indent=2))
+    elif args[0] == 'scrape' and len(args) == 2:
+        print(json.dumps(call("POST", "/jobs", {'kind': 'scrape', 'url': args[1]}), indent=2))
+    elif args[0] == 'convert' and len(args) == 2:
+        print(json.dumps(call("POST", "/jobs", {'kind': 'convert', 'file': args[1]}), indent=2))
+    elif args[0] == 'status':
+        print(json.dumps(call("GET", f"/jobs/{args[1]}" if len(args) > 1 else "/status"), indent=2))
+    else:
+        print(USAGE)
+        sys.exit(1)
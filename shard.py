@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+
+import archive
+import jobstore
+import service
+
+# --- Configuration ---
+# Point every host at the same store, e.g. JOBS_STORE=sqlite:///mnt/shared/jobs.sqlite3
+# (with JOBS_JOURNAL_MODE=DELETE on network filesystems, see jobstore.py).
+# Leases expire by each host's own clock: keep the hosts NTP-synced (JOBS_CLOCK_SKEW)
+LINKS_FILE = "links.txt"
+BATCH_SIZE = 8      # links leased per claim: fewer round trips to the shared store
+WORKERS = service.WORKERS
+IDLE_EXIT = 10      # seconds a node waits with nothing queued or running anywhere before exiting
+STATUS_INTERVAL = 30
+# ---------------------
+
+
+def load(path=LINKS_FILE):
+    """
+    Queues every link in the file once. Variants of one video collapse into
+    one job, and videos already queued, running or done are not added again,
+    so the same file can be loaded from several hosts or re-loaded later.
+    """
+    if not os.path.exists(path):
+        print(f"[ERROR] {path} not found.")
+        sys.exit(1)
+    with open(path) as f:
+        links, duplicates = archive.unique_links([line.strip() for line in f if line.strip()])
+    jobs = jobstore.open_store()
+    before = jobs.counts()
+    for link in links:
+        jobs.submit('download', {'url': link}, key=':'.join(archive.video_key(link)), reuse_done=True)
+    added = sum(jobs.counts().values()) - sum(before.values())
+    jobs.close()
+    print(f"[INFO] {added} new jobs from {len(links)} links in {path} "
+          f"({duplicates} duplicate links, {len(links) - added} already known)")
+
+
+def work(workers=WORKERS):
+    """
+    Runs one worker node: leases BATCH_SIZE links at a time from the shared
+    store until nothing is queued or running anywhere. Jobs of a node that
+    crashed are picked up once their leases expire.
+    """
+    node = service.Service(workers, batch=BATCH_SIZE)
+    print(f"[INFO] Worker node {node.owner}: {node.workers} workers, batches of {BATCH_SIZE}, store {node.jobs.path}")
+    node.start()
+    idle_since, last_status = None, time.monotonic()
+    try:
+        while True:
+            time.sleep(1)
+            counts = node.jobs.counts()
+            pending = counts.get(jobstore.QUEUED, 0) + counts.get(jobstore.RUNNING, 0)
+            if time.monotonic() - last_status >= STATUS_INTERVAL:
+                print(f"[STATUS] {counts}")
+                last_status = time.monotonic()
+            if pending or node.busy:
+                idle_since = None
+            elif idle_since is None:
+                idle_since = time.monotonic()
+            elif time.monotonic() - idle_since >= IDLE_EXIT:
+                break
+    except KeyboardInterrupt:
+        print("[INFO] Interrupted; unstarted jobs go back to the queue")
+    node.stop()
+    print(f"[INFO] Worker node {node.owner} finished")
+
+
+def status():
+    jobs = jobstore.open_store()
+    counts = jobs.counts()
+    print(f"Jobs: {counts}")
+    for owner, ids in sorted(jobs.leases().items()):
+        print(f"   {owner}: {len(ids)} leased ({', '.join(map(str, ids[:10]))}{' ...' if len(ids) > 10 else ''})")
+    for job in jobs.list(status=jobstore.FAILED, limit=10):
+        print(f"   [FAILED] {job['id']} {job['payload'].get('url') or job['payload']}: {job['error']}")
+    jobs.close()
+
+
+USAGE = """Usage:
+    python shard.py load [links file]    queue the links (default links.txt)
+    python shard.py work [workers]       run a worker node until the queue is drained
+    python shard.py status               progress, leases held per worker, recent failures"""
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ['load']:
+        load(args[1] if len(args) > 1 else LINKS_FILE)
+    elif args[:1] == ['work']:
+        work(int(args[1]) if len(args) > 1 else WORKERS)
+    elif args[:1] == ['status']:
+        status()
+    else:
+        print(USAGE)
+        sys.exit(1)
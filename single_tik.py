@@ -1,32 +1,37 @@
-import subprocess
 import os
 
+import formats
+import throttle
+import ytdlp_engine
+
 # --- Configuration ---
 OUTPUT_DIR = "single_downloads"
 COOKIE_FILE = os.path.join(os.getcwd(), 'cookies.txt')
 # ---------------------
 
-def run_yt_dlp(url, options):
+def access_args():
     """
-    Runs yt-dlp with impersonation to bypass TikTok blocks.
+    Impersonation (to bypass TikTok blocks) and cookies, without the URL.
     """
     # Using 'chrome' impersonation to avoid extraction errors
-    cmd = ['yt-dlp', '--impersonate', 'chrome', url] + options
-    
+    args = ['--impersonate', 'chrome']
     if os.path.exists(COOKIE_FILE):
-        cmd.extend(['--cookies', COOKIE_FILE])
+        args.extend(['--cookies', COOKIE_FILE])
+    return args
 
-    try:
-        process = subprocess.run(
-            cmd, 
-            capture_output=True, 
-            text=True, 
-            check=True, 
-            encoding='utf-8'
-        )
-        return process.stdout
-    except subprocess.CalledProcessError as e:
-        raise Exception(f"yt-dlp failed: {e.stderr}")
+def run_yt_dlp(url, options):
+    """
+    Runs yt-dlp with impersonation to bypass TikTok blocks.
+    """
+    cmd = [url] + options + access_args()
+
+    deadline = ytdlp_engine.job_deadline()
+    process, outcome = throttle.run_with_retries(
+        url, lambda: ytdlp_engine.download(cmd, label=url, deadline=deadline, encoding='utf-8')
+    )
+    if process.returncode != 0:
+        raise Exception(f"yt-dlp failed ({outcome}): {process.stderr}")
+    return process.stdout
 
 def download_single_video(url):
     """
@@ -41,17 +46,23 @@ def download_single_video(url):
     # Simple template for single files
     output_template = os.path.join(OUTPUT_DIR, "%(title)s_%(id)s.%(ext)s")
 
+    # Smallest formats meeting the phone target (formats.py), else the MP4 "best" selector
+    selection = formats.select_for(url, access_args(), 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]')
     options = [
         '-o', output_template,
-        '-f', 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]',
+        *selection.args,
         '--no-playlist' # Ensures it only grabs the video even if it's part of a set
     ]
 
     try:
         run_yt_dlp(url, options)
+        selection.finished()
         print("Done! Check the 'single_downloads' folder.")
+        formats.report()
     except Exception as e:
         print(f"\n[ERROR] Failed to download: {e}")
+    finally:
+        selection.close()
 
 def main():
     print("--- TikTok Single Video Downloader ---")
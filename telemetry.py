@@ -0,0 +1,150 @@
+import atexit
+import json
+import os
+import threading
+import time
+
+import archive
+
+# --- Configuration ---
+# JSONL file receiving one span per line. Unset (and no METRICS_TEXTFILE) = disabled.
+TRACE_FILE = os.environ.get("TRACE_FILE")
+# Prometheus node-exporter textfile, e.g. /var/lib/node_exporter/textfile_collector/tikdownloader.prom
+METRICS_TEXTFILE = os.environ.get("METRICS_TEXTFILE")
+METRICS_PREFIX = "tikdownloader"
+FLUSH_EVERY = 100  # spans between textfile rewrites (it is also written at exit)
+# ---------------------
+
+ENABLED = bool(TRACE_FILE or METRICS_TEXTFILE)
+
+_lock = threading.Lock()
+_trace = None
+_totals = {}  # (stage, platform, outcome) -> [count, seconds, bytes]
+_spans = 0
+_started = time.time()
+
+
+class _NullSpan:
+    """ What span() hands out while telemetry is off: every call is a no-op. """
+
+    def set(self, **tags):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """ Times one stage of one job. Tags can be added while it runs with set(). """
+
+    def __init__(self, stage, tags):
+        self.stage = stage
+        self.tags = tags
+
+    def set(self, **tags):
+        self.tags.update(tags)
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and 'outcome' not in self.tags:
+            self.tags['outcome'] = 'error'
+        record(self.stage, self.start, time.time(), **self.tags)
+        return False
+
+
+def url_tags(url):
+    """ platform/video_id tags for a URL (no network work). """
+    if not url:
+        return {}
+    platform, video_id = archive.video_key(url)
+    return {'platform': platform, 'video_id': video_id}
+
+
+def span(stage, url=None, **tags):
+    """
+    Context manager timing one stage (spawn, extract, transfer, remux, ...).
+    With telemetry disabled this returns a shared no-op object, so callers
+    can leave their spans in place at practically no cost.
+    """
+    if not ENABLED:
+        return _NULL_SPAN
+    return Span(stage, {**url_tags(url), **tags})
+
+
+def record(stage, start, end, url=None, **tags):
+    """ Records a span measured by the caller (wall-clock start/end in seconds). """
+    global _trace, _spans
+    if not ENABLED:
+        return
+    tags = {**url_tags(url), **tags}
+    tags.setdefault('outcome', 'success')
+    seconds = max(0.0, end - start)
+    with _lock:
+        if TRACE_FILE:
+            if _trace is None:
+                _trace = open(TRACE_FILE, 'a', encoding='utf-8')
+            _trace.write(json.dumps({'stage': stage, 'start': round(start, 6), 'seconds': round(seconds, 6),
+                                     'pid': os.getpid(), **tags}, default=str) + '\n')
+        key = (stage, tags.get('platform', ''), tags['outcome'])
+        totals = _totals.setdefault(key, [0, 0.0, 0])
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += tags.get('bytes') or 0
+        _spans += 1
+        flush_now = _spans % FLUSH_EVERY == 0
+    if flush_now:
+        flush()
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def write_textfile(path):
+    """ Writes per-stage totals in Prometheus text format, atomically (node-exporter may read at any time). """
+    metrics = (
+        ('stage_spans', 0, 'Spans recorded per stage since the run started.'),
+        ('stage_seconds', 1, 'Wall-clock seconds spent per stage since the run started.'),
+        ('stage_bytes', 2, 'Bytes handled per stage since the run started.'),
+    )
+    with _lock:
+        totals = dict(_totals)
+    lines = []
+    for name, column, help_text in metrics:
+        lines.append(f"# HELP {METRICS_PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {METRICS_PREFIX}_{name} gauge")
+        for (stage, platform, outcome), values in sorted(totals.items()):
+            labels = f'stage="{_label(stage)}",platform="{_label(platform)}",outcome="{_label(outcome)}"'
+            lines.append(f"{METRICS_PREFIX}_{name}{{{labels}}} {values[column]}")
+    lines.append(f"# HELP {METRICS_PREFIX}_run_start_timestamp_seconds When the run that wrote this file started.")
+    lines.append(f"# TYPE {METRICS_PREFIX}_run_start_timestamp_seconds gauge")
+    lines.append(f"{METRICS_PREFIX}_run_start_timestamp_seconds {_started:.0f}")
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp, path)
+
+
+@atexit.register
+def flush():
+    """ Flushes the trace file and rewrites the metrics textfile. """
+    if not ENABLED:
+        return
+    with _lock:
+        if _trace is not None:
+            _trace.flush()
+    if METRICS_TEXTFILE:
+        try:
+            write_textfile(METRICS_TEXTFILE)
+        except OSError as e:
+            print(f"[telemetry] Could not write {METRICS_TEXTFILE}: {e}")
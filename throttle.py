@@ -0,0 +1,242 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+import telemetry
+
+# --- Configuration ---
+# Per-host request budget: (requests per second, burst size).
+# The burst lets a fresh run start a few jobs straight away, the rate is
+# what the platform tolerates over a long batch without flagging us.
+HOST_BUDGETS = {
+    "tiktok.com": (0.5, 3),
+    "instagram.com": (0.4, 2),
+}
+DEFAULT_BUDGET = (1.0, 2)
+RATE_LIMIT_PENALTY = 30  # seconds the whole host backs off after a 429
+CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", "4"))
+# Adaptive concurrency per platform: (start, max). It grows by one slot per
+# window of successes and halves on rate-limit/blocking errors.
+PLATFORM_CONCURRENCY = {
+    "tiktok.com": (2, 8),
+    "instagram.com": (2, 6),
+    "facebook.com": (2, 6),
+}
+DEFAULT_CONCURRENCY = (2, 8)
+MAX_ATTEMPTS = 3
+# Base retry delay per failure class (seconds, doubled per attempt, jittered)
+RETRY_BASE_DELAY = {"rate_limited": 30, "blocked": 60, "transient": 5}
+MAX_RETRY_DELAY = 300
+# ---------------------
+
+# yt-dlp failure classes
+SUCCESS = "success"
+RATE_LIMITED = "rate_limited"
+BLOCKED = "blocked"
+AUTH = "auth"
+NOT_FOUND = "not_found"
+TRANSIENT = "transient"
+TIMEOUT = "timeout"  # job ran out of its overall deadline; not worth retrying
+RETRYABLE = {RATE_LIMITED, BLOCKED, TRANSIENT}
+
+# Checked in order; the first class with a matching phrase wins
+ERROR_PATTERNS = [
+    (TIMEOUT, ("deadline exceeded",)),
+    (RATE_LIMITED, ("http error 429", "too many requests", "rate-limit", "rate limit", "please wait a few minutes")),
+    (AUTH, ("login required", "log in", "login", "sign in", "private", "cookies", "authentication", "not logged")),
+    (NOT_FOUND, ("http error 404", "not found", "unavailable", "has been removed", "does not exist",
+                 "no video formats", "unsupported url")),
+    (BLOCKED, ("http error 403", "forbidden", "unable to extract", "blocked", "captcha", "checkpoint",
+               "your ip address")),
+]
+
+
+class TokenBucket:
+    """ Thread-safe token bucket. acquire() blocks until a token is free. """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """ Takes one token, sleeping just long enough for it to refill. Returns seconds waited. """
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def penalize(self, seconds):
+        """ Pushes the bucket into debt so nobody on this host starts for `seconds`. """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def host_key(url):
+    """ Maps a URL to the budget key it is charged against (e.g. 'tiktok.com'). """
+    host = (urlparse(url).hostname or "").lower()
+    for key in HOST_BUDGETS:
+        if host == key or host.endswith("." + key):
+            return key
+    return host
+
+
+def bucket_for(url):
+    """ Returns the shared TokenBucket for the URL's host. """
+    key = host_key(url)
+    with _buckets_lock:
+        if key not in _buckets:
+            rate, burst = HOST_BUDGETS.get(key, DEFAULT_BUDGET)
+            _buckets[key] = TokenBucket(rate, burst)
+        return _buckets[key]
+
+
+def classify_error(stderr):
+    """ Maps yt-dlp error output to one of the failure classes (TRANSIENT if nothing matches). """
+    lines = (stderr or "").splitlines()
+    # Judge by the ERROR lines so WARNING chatter (e.g. about cookies) can't misclassify
+    text = "\n".join([l for l in lines if "ERROR" in l] or lines).lower()
+    for category, phrases in ERROR_PATTERNS:
+        if any(phrase in text for phrase in phrases):
+            return category
+    return TRANSIENT
+
+
+def report_rate_limit(url):
+    """ Backs the URL's host off for RATE_LIMIT_PENALTY seconds. """
+    bucket_for(url).penalize(RATE_LIMIT_PENALTY)
+
+
+def retry_delay(attempt, category):
+    """ Exponential backoff with jitter: half fixed, half random, so parallel workers don't retry in lockstep. """
+    delay = min(MAX_RETRY_DELAY, RETRY_BASE_DELAY.get(category, RETRY_BASE_DELAY[TRANSIENT]) * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency gate for one platform. acquire() blocks while `limit`
+    jobs are in flight. Each success adds 1/limit (so +1 slot per window of
+    successes); a rate-limit or block halves the limit, at most once per
+    cooldown so one burst of errors counts as a single signal.
+    """
+
+    def __init__(self, initial, maximum, minimum=1, decrease=0.5, cooldown=10):
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.active = 0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, outcome):
+        with self.cond:
+            self.active -= 1
+            if outcome == SUCCESS:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif outcome in (RATE_LIMITED, BLOCKED):
+                now = time.monotonic()
+                if now - self.last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self.last_decrease = now
+            self.cond.notify_all()
+
+
+_limiters = {}
+
+
+def limiter_for(url):
+    """ Returns the shared AdaptiveLimiter for the URL's platform. """
+    key = host_key(url)
+    with _buckets_lock:
+        if key not in _limiters:
+            initial, maximum = PLATFORM_CONCURRENCY.get(key, DEFAULT_CONCURRENCY)
+            _limiters[key] = AdaptiveLimiter(initial, maximum)
+        return _limiters[key]
+
+
+def run_with_retries(url, call, max_attempts=MAX_ATTEMPTS, label=""):
+    """
+    Runs call() (returning a CompletedProcess-like result) under the URL's
+    platform limiter and request budget. Failures are classified; rate
+    limits and blocks shrink the platform's concurrency and push its token
+    bucket into debt, and retryable classes are retried with jittered backoff.
+    Returns (result, outcome) where outcome is SUCCESS or the failure class.
+    """
+    limiter = limiter_for(url)
+    with telemetry.span('job', url) as job:
+        for attempt in range(max_attempts):
+            # Time spent in the anti-bot gates is traced separately from the work itself
+            with telemetry.span('limiter_wait', url):
+                limiter.acquire()
+            outcome = TRANSIENT
+            try:
+                with telemetry.span('throttle_wait', url):
+                    bucket_for(url).acquire()
+                result = call()
+                outcome = SUCCESS if result.returncode == 0 else classify_error(result.stderr)
+            finally:
+                limiter.release(outcome)
+            job.set(outcome=outcome, attempts=attempt + 1)
+
+            if outcome == SUCCESS:
+                return result, outcome
+            if outcome in (RATE_LIMITED, BLOCKED):
+                report_rate_limit(url)
+            if outcome not in RETRYABLE or attempt == max_attempts - 1:
+                return result, outcome
+
+            delay = retry_delay(attempt, outcome)
+            print(f"   [RETRY] {label or url}: {outcome}, attempt {attempt + 2}/{max_attempts} in {delay:.0f}s")
+            with telemetry.span('backoff', url, outcome=outcome):
+                time.sleep(delay)
+
+
+def run_pool(items, worker, concurrency=None):
+    """
+    Runs worker(index, item) for every item on a bounded thread pool.
+    index starts at 1 to match the numbering the scripts print.
+    Returns the results in input order.
+    """
+    concurrency = max(1, concurrency or CONCURRENCY)
+    results = [None] * len(items)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {pool.submit(worker, i, item): i for i, item in enumerate(items, start=1)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i - 1] = future.result()
+            except Exception as e:
+                print(f"   [ERROR] Worker crashed on item {i}: {e}")
+                results[i - 1] = False
+    return results
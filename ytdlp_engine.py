@@ -0,0 +1,451 @@
+import atexit
+import collections
+import json
+import os
+import signal
+import subprocess
+import threading
+import time
+
+import telemetry
+import throttle
+
+# --- Configuration ---
+# "subprocess" spawns one yt-dlp process per call (the original behaviour).
+# "inprocess" keeps long-lived YoutubeDL sessions per platform so the
+# extractor import, cookie parsing and HTTP connections are paid once a run.
+ENGINE = os.environ.get("YTDLP_ENGINE", "subprocess")
+YTDLP_BIN = os.environ.get("YTDLP_BIN", "yt-dlp")
+# Downloads with no progress for this long are killed (and retried as transient)
+STALL_TIMEOUT = float(os.environ.get("YTDLP_STALL_TIMEOUT", "60"))
+# Overall wall-clock budget for one job, retries included
+JOB_DEADLINE = float(os.environ.get("YTDLP_JOB_DEADLINE", "1800"))
+PROGRESS_INTERVAL = 10  # seconds between live progress lines per download
+# ---------------------
+
+_yt_dlp_module = None
+_sessions = {}       # (platform, options key) -> list of idle YoutubeDL instances
+_cookie_jars = {}    # platform -> shared cookie jar
+_sessions_lock = threading.Lock()
+
+
+def _load_yt_dlp():
+    """ Imports yt_dlp lazily. Returns None if it isn't installed. """
+    global _yt_dlp_module
+    if _yt_dlp_module is None:
+        try:
+            import yt_dlp
+            _yt_dlp_module = yt_dlp
+        except ImportError:
+            _yt_dlp_module = False
+    return _yt_dlp_module or None
+
+
+class _CaptureLogger:
+    """ yt-dlp logger that keeps warnings/errors of the current call as stderr text. """
+
+    def __init__(self):
+        self.lines = []
+
+    def debug(self, msg):
+        pass
+
+    def info(self, msg):
+        pass
+
+    def warning(self, msg):
+        self.lines.append(msg)
+
+    def error(self, msg):
+        self.lines.append(msg)
+
+
+def _options_key(ydl_opts):
+    """ Sessions are shared between calls that differ only in their output template. """
+    opts = {k: v for k, v in ydl_opts.items() if k not in ("outtmpl", "logger")}
+    return json.dumps(opts, sort_keys=True, default=repr)
+
+
+def _checkout(platform, ydl_opts):
+    """ Takes an idle session for these options, creating one if needed. """
+    yt_dlp = _load_yt_dlp()
+    key = (platform, _options_key(ydl_opts))
+    with _sessions_lock:
+        idle = _sessions.setdefault(key, [])
+        if idle:
+            ydl = idle.pop()
+            ydl.params["outtmpl"] = ydl_opts.get("outtmpl", ydl.params.get("outtmpl"))
+            return key, ydl
+
+    logger = _CaptureLogger()
+    ydl = yt_dlp.YoutubeDL({**ydl_opts, "logger": logger, "quiet": True, "noprogress": True})
+    with _sessions_lock:
+        jar = _cookie_jars.get(platform)
+        if jar is None:
+            _cookie_jars[platform] = ydl.cookiejar
+        else:
+            # cookiejar is a cached property: seeding it shares one parsed
+            # cookies.txt (and any cookies the site sets) across sessions.
+            ydl.__dict__["cookiejar"] = jar
+    return key, ydl
+
+
+def _checkin(key, ydl):
+    with _sessions_lock:
+        _sessions[key].append(ydl)
+
+
+def _run_inprocess(args):
+    yt_dlp = _load_yt_dlp()
+    try:
+        parsed = yt_dlp.parse_options(args)
+    except SystemExit as e:
+        return subprocess.CompletedProcess(args, e.code or 2, "", f"ERROR: bad yt-dlp options: {args}")
+
+    ydl_opts = dict(parsed.ydl_opts)
+    dump_json = ydl_opts.pop("forcejson", False)
+    templates = (ydl_opts.pop("forceprint", None) or {}).get("video", [])
+    if dump_json or templates:
+        ydl_opts.pop("simulate", None)
+
+    stdout, returncode = [], 0
+    logger_lines = []
+    for url in parsed.urls:
+        key, ydl = _checkout(throttle.host_key(url), ydl_opts)
+        logger = ydl.params["logger"]
+        logger.lines = []
+        try:
+            if dump_json or templates:
+                info = ydl.extract_info(url, download=False)
+                entries = info.get("entries") if info and info.get("_type") == "playlist" else [info]
+                for entry in entries or []:
+                    if not entry:
+                        continue
+                    if dump_json:
+                        stdout.append(json.dumps(ydl.sanitize_info(entry)))
+                    # -O/--print templates are evaluated the same way the CLI does
+                    stdout.extend(ydl.evaluate_outtmpl(t, entry) for t in templates)
+            elif ydl.download([url]):
+                returncode = 1
+        except yt_dlp.utils.DownloadError:
+            returncode = 1
+        except Exception as e:
+            logger.lines.append(f"ERROR: {e}")
+            returncode = 1
+        finally:
+            logger_lines.extend(logger.lines)
+            _checkin(key, ydl)
+
+    return subprocess.CompletedProcess(
+        args, returncode, "\n".join(stdout) + ("\n" if stdout else ""), "\n".join(logger_lines)
+    )
+
+
+def _run_subprocess(args, encoding):
+    return subprocess.run(
+        [YTDLP_BIN] + list(args), capture_output=True, text=True, encoding=encoding
+    )
+
+
+def run(args, check=False, encoding="utf-8"):
+    """
+    Runs yt-dlp with command-line style args (without the program name).
+    Returns a subprocess.CompletedProcess either way, so callers keep
+    checking returncode/stdout/stderr exactly as with subprocess.run.
+    Falls back to the subprocess path when yt_dlp isn't importable.
+    """
+    url = next((a for a in reversed(args) if a.startswith("http")), None)
+    with telemetry.span('metadata', url, engine=ENGINE) as span:
+        # A saved info JSON (--load-info-json) is replayed by the CLI, not re-extracted here
+        if ENGINE == "inprocess" and "--load-info-json" not in args and _load_yt_dlp():
+            result = _run_inprocess(list(args))
+        else:
+            result = _run_subprocess(args, encoding)
+        if telemetry.ENABLED:
+            span.set(outcome='success' if result.returncode == 0 else throttle.classify_error(result.stderr))
+
+    if check and result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+    return result
+
+
+def _stream_inprocess(args):
+    yt_dlp = _load_yt_dlp()
+    parsed = yt_dlp.parse_options(args)
+    ydl_opts = dict(parsed.ydl_opts)
+    ydl_opts.pop("forcejson", None)
+    ydl_opts.pop("simulate", None)
+
+    for url in parsed.urls:
+        key, ydl = _checkout(throttle.host_key(url), ydl_opts)
+        logger = ydl.params["logger"]
+        logger.lines = []
+        try:
+            # process=False keeps the playlist's entries as the extractor's
+            # own lazy generator, so pages are only fetched as we consume them
+            info = ydl.extract_info(url, download=False, process=False)
+            entries = info.get("entries") if info and info.get("_type") == "playlist" else [info]
+            for entry in entries or []:
+                if entry:
+                    yield json.dumps(ydl.sanitize_info(entry))
+        except yt_dlp.utils.DownloadError:
+            raise subprocess.CalledProcessError(1, args, None, "\n".join(logger.lines))
+        finally:
+            _checkin(key, ydl)
+
+
+def _stream_subprocess(args, encoding):
+    process = subprocess.Popen(
+        [YTDLP_BIN] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        text=True, encoding=encoding, bufsize=1
+    )
+    # Drain stderr on the side so a chatty extractor can't block on a full pipe
+    stderr_tail = collections.deque(maxlen=50)
+    drain = threading.Thread(target=lambda: stderr_tail.extend(process.stderr), daemon=True)
+    drain.start()
+
+    finished = False
+    try:
+        for line in process.stdout:
+            yield line.rstrip("\n")
+        finished = True
+    finally:
+        if not finished and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        process.wait()
+        drain.join(timeout=1)
+
+    if finished and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args, None, "".join(stderr_tail))
+
+
+def stream(args, encoding="utf-8"):
+    """
+    Yields yt-dlp's stdout (e.g. --dump-json records) one line at a time.
+    Closing the generator early stops the extraction: the child process is
+    terminated, or the in-process playlist generator is simply abandoned.
+    Raises CalledProcessError if yt-dlp fails before we stop it.
+    """
+    if ENGINE == "inprocess" and _load_yt_dlp():
+        return _stream_inprocess(list(args))
+    return _stream_subprocess(args, encoding)
+
+
+# One machine-readable line per progress callback:
+# status, downloaded bytes, total (or estimate), speed (B/s), eta (s). Missing fields print NA.
+PROGRESS_PREFIX = "[progress]"
+PROGRESS_TEMPLATE = (
+    "download:" + PROGRESS_PREFIX + " %(progress.status)s %(progress.downloaded_bytes)s "
+    "%(progress.total_bytes,progress.total_bytes_estimate)s %(progress.speed)s %(progress.eta)s"
+)
+
+# Post-processor output: the transfer is over and ffmpeg may run silently for a while
+POSTPROCESSOR_TAGS = ("[Merger]", "[VideoConvertor]", "[VideoRemuxer]", "[FixupM3u8]", "[FixupM4a]",
+                      "[FixupStretched]", "[FixupDuplicateMoov]", "[ExtractAudio]", "[ffmpeg]", "[EmbedThumbnail]")
+
+transfers = []  # one dict per finished download() call, for batch summaries
+_transfers_lock = threading.Lock()
+
+
+def _number(field):
+    try:
+        return float(field)
+    except ValueError:
+        return None
+
+
+def parse_progress(line):
+    """ Parses a PROGRESS_TEMPLATE line into a dict, or returns None for any other output. """
+    parts = line.split()
+    if len(parts) != 6 or parts[0] != PROGRESS_PREFIX:
+        return None
+    status, downloaded, total, speed, eta = parts[1], *map(_number, parts[2:])
+    return {'status': status, 'downloaded': downloaded, 'total': total, 'speed': speed, 'eta': eta}
+
+
+def job_deadline(seconds=None):
+    """ Absolute monotonic deadline for a job starting now; pass it to every download() attempt. """
+    return time.monotonic() + (seconds or JOB_DEADLINE)
+
+
+def _format_progress(label, done, progress):
+    text = f"   [PROGRESS] {label}: {done / 1e6:.1f}"
+    if progress['total']:
+        text += f"/{(progress['total'] + done - (progress['downloaded'] or 0)) / 1e6:.1f}"
+    text += " MB"
+    if progress['speed']:
+        text += f" at {progress['speed'] / 1e6:.2f} MB/s"
+    if progress['eta'] is not None:
+        text += f", ETA {progress['eta']:.0f}s"
+    return text
+
+
+def download(args, label="", deadline=None, stall_timeout=None, encoding="utf-8"):
+    """
+    Runs a yt-dlp download, reading structured progress line by line instead
+    of waiting for the process to exit. The child is killed if no output
+    arrives for stall_timeout seconds (reported as a transient error, so
+    run_with_retries requeues it) or once the job deadline passes (reported
+    as "deadline exceeded", which is not retried). Post-processing is only
+    bound by the deadline. Always a child process, even with the in-process
+    engine, because only a process can be killed mid-transfer. Returns a
+    CompletedProcess like run(); the job's bytes, duration and outcome are
+    appended to `transfers`, and its spawn/extract/transfer/postprocess
+    phases are traced through telemetry.
+    """
+    stall_timeout = stall_timeout or STALL_TIMEOUT
+    deadline = deadline or job_deadline()
+    label = label or (args[-1] if args else "")
+    cmd = [YTDLP_BIN, "--newline", "--progress", "--progress-template", PROGRESS_TEMPLATE] + list(args)
+    started = time.monotonic()
+    if started >= deadline:
+        return subprocess.CompletedProcess(cmd, 1, "", f"ERROR: job deadline exceeded before {label} started")
+
+    # Wall-clock phase boundaries for the trace: spawned, first/last progress, post-processing
+    phases = {'start': time.time()}
+    # Own process group: the ffmpeg child (downloader/merger) shares our pipes
+    # and has to die with yt-dlp, or reading stdout blocks until it exits
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding=encoding, bufsize=1,
+        start_new_session=os.name == 'posix'
+    )
+    phases['spawned'] = time.time()
+    state = {'active': started, 'killed': None, 'postprocessing': False}
+    reading = threading.Event()
+    reading.set()
+    stderr_tail = collections.deque(maxlen=50)
+
+    def drain_stderr():
+        for line in process.stderr:
+            stderr_tail.append(line)
+            state['active'] = time.monotonic()
+
+    def watchdog():
+        # Until stdout closes, not just until yt-dlp exits: a surviving child keeps it open
+        while reading.is_set():
+            now = time.monotonic()
+            if now >= deadline:
+                state['killed'] = f"ERROR: job deadline exceeded after {now - started:.0f}s"
+            elif not state['postprocessing'] and now - state['active'] > stall_timeout:
+                state['killed'] = f"ERROR: download stalled: no progress for {stall_timeout:.0f}s"
+            if state['killed']:
+                _kill_tree(process)
+                return
+            time.sleep(min(1.0, stall_timeout / 4))
+
+    threads = [threading.Thread(target=drain_stderr, daemon=True), threading.Thread(target=watchdog, daemon=True)]
+    for t in threads:
+        t.start()
+
+    stdout = []
+    finished_bytes = 0   # video and audio are separate files: sum the finished ones
+    done, last_printed = 0, started
+    try:
+        for line in process.stdout:
+            progress = parse_progress(line)
+            if progress is None:
+                stdout.append(line)
+                state['postprocessing'] = line.startswith(POSTPROCESSOR_TAGS)
+                state['active'] = time.monotonic()
+                if state['postprocessing']:
+                    phases.setdefault('postprocess', time.time())
+                continue
+            phases.setdefault('transfer', time.time())
+            phases['transferred'] = time.time()
+            current = progress['downloaded'] or 0
+            if progress['status'] == 'finished':
+                finished_bytes += current
+                current = 0
+            if finished_bytes + current > done:
+                done = finished_bytes + current
+                state['active'] = time.monotonic()
+            if state['active'] - last_printed >= PROGRESS_INTERVAL:
+                last_printed = state['active']
+                print(_format_progress(label, done, progress))
+    except BaseException:
+        # Ctrl+C no longer reaches the child in its own session
+        _kill_tree(process)
+        raise
+    finally:
+        reading.clear()
+    process.wait()
+    for t in threads:
+        t.join(timeout=1)
+    stderr = "".join(stderr_tail) + (state['killed'] or "")
+    returncode = process.returncode if not state['killed'] else -9
+
+    seconds = time.monotonic() - started
+    outcome = 'success' if returncode == 0 else throttle.classify_error(stderr)
+    with _transfers_lock:
+        transfers.append({
+            'label': label, 'bytes': done, 'seconds': seconds,
+            'speed': done / seconds if seconds else 0.0, 'outcome': outcome,
+        })
+    if telemetry.ENABLED:
+        _trace_phases(phases, time.time(), args, done, outcome)
+    return subprocess.CompletedProcess(cmd, returncode, "".join(stdout), stderr)
+
+
+def _kill_tree(process):
+    """ Kills yt-dlp together with the ffmpeg/downloader processes it started. """
+    if os.name == 'posix':
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            process.kill()
+    else:
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], capture_output=True)
+        process.kill()
+
+
+def _trace_phases(phases, end, args, size, outcome):
+    url = next((a for a in reversed(args) if a.startswith("http")), None)
+    telemetry.record('spawn', phases['start'], phases['spawned'], url, outcome=outcome)
+    telemetry.record('extract', phases['spawned'], phases.get('transfer', end), url, outcome=outcome)
+    if 'transfer' in phases:
+        telemetry.record('transfer', phases['transfer'], phases['transferred'], url, bytes=size, outcome=outcome)
+    if 'postprocess' in phases:
+        telemetry.record('postprocess', phases['postprocess'], end, url, outcome=outcome)
+
+
+def report_transfers(since=0):
+    """ Prints per-job throughput for the downloads recorded from index `since` on. """
+    with _transfers_lock:
+        jobs = transfers[since:]
+    if not jobs:
+        return
+    total_bytes = sum(j['bytes'] for j in jobs)
+    busy = sum(j['seconds'] for j in jobs)
+    ok = [j for j in jobs if j['outcome'] == 'success']
+    print(f"\n--- Transfer report: {len(ok)}/{len(jobs)} attempts ok, {total_bytes / 1e6:.1f} MB, "
+          f"{total_bytes / busy / 1e6 if busy else 0:.2f} MB/s per job ---")
+    slowest = sorted(ok, key=lambda j: j['speed'])[:3]
+    for j in slowest:
+        print(f"   slowest: {j['label']} {j['bytes'] / 1e6:.1f} MB in {j['seconds']:.1f}s ({j['speed'] / 1e6:.2f} MB/s)")
+    for j in jobs:
+        if j['outcome'] != 'success':
+            print(f"   {j['outcome']}: {j['label']} after {j['seconds']:.1f}s")
+
+
+def trim_transfers(keep):
+    """ Drops all but the newest `keep` transfer records, so a long-running service doesn't grow forever. """
+    with _transfers_lock:
+        del transfers[:-keep or None]
+
+
+@atexit.register
+def close():
+    """ Closes every cached session (and with it their pooled connections). """
+    with _sessions_lock:
+        for idle in _sessions.values():
+            for ydl in idle:
+                try:
+                    ydl.close()
+                except Exception:
+                    pass
+        _sessions.clear()
+        _cookie_jars.clear()